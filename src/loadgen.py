@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Modbus load generator
+
+Drives a mix of FC3/FC4/FC6/FC16 requests at a ModbusSim instance and
+reports throughput, latency percentiles and error rates.
+
+Over TCP every connection sends its next request as soon as the previous
+one is answered. Over RTU a single master polls the bus, either through a
+serial device or through a local pty pair the simulator is attached to.
+With --spawn the simulator is started in a child process so it does not
+share the interpreter with the generator.
+
+    python3 loadgen.py --spawn --mode tcp --connections 10 --duration 10
+    python3 loadgen.py --spawn --mode rtu --duration 10 --save baseline.json
+    python3 loadgen.py --spawn --mode rtu --duration 10 --baseline baseline.json
+    python3 loadgen.py --mode tcp --host 10.0.0.5 --port 5005 --mix fc3=90,fc16=10
+
+Results are saved with --save and compared with --baseline, which exits
+with status 1 when throughput, p99 latency or the error rate regressed by
+more than --tolerance.
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import tty
+
+from array import array
+
+import serial
+
+from modbus_tk.utils import calculate_crc
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler())
+LOGGER.setLevel(logging.INFO)
+
+# name in --mix -> function code
+FUNCTIONS = {
+    'fc3': 3,
+    'fc4': 4,
+    'fc6': 6,
+    'fc16': 16,
+}
+
+# block type read or written by every function code and its first address
+ADDRESSES = {
+    3: 40001,
+    4: 30001,
+    6: 40001,
+    16: 40001,
+}
+
+MBAP = struct.Struct('>HHHB')
+CRC = struct.Struct('>H')
+
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+
+class LoadGenError(Exception):
+    pass
+
+
+def parse_mix(text):
+    '''
+    Parses fc3=70,fc4=20,fc6=5,fc16=5 into [(function_code, weight)]
+    '''
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in FUNCTIONS:
+            raise LoadGenError('Unknown function %s, use one of %s' % (name, ', '.join(sorted(FUNCTIONS))))
+        mix.append((FUNCTIONS[name.strip()], float(weight or 1)))
+    return mix
+
+
+def parse_slave_ids(text):
+    '''
+    Parses 1-10 or 1,2,5 (or a mix of both) into a list of slave ids
+    '''
+    slave_ids = []
+    for item in text.split(','):
+        first, _, last = item.partition('-')
+        slave_ids.extend(range(int(first), int(last or first) + 1))
+    return slave_ids
+
+
+class RequestMix(object):
+    '''
+    Builds random requests following the weights of a mix
+    '''
+
+    def __init__(self, mix, slave_ids, registers, quantity, seed=None):
+        self.functions = [function_code for (function_code, weight) in mix]
+        self.weights = [weight for (function_code, weight) in mix]
+        self.slave_ids = slave_ids
+        self.registers = registers
+        self.quantity = min(quantity, registers)
+        self.random = random.Random(seed)
+
+    def next(self):
+        '''
+        Returns (slave_id, function_code, request pdu, length of a normal
+        response pdu)
+        '''
+        function_code = self.random.choices(self.functions, self.weights)[0]
+        slave_id = self.random.choice(self.slave_ids)
+        if function_code == 6:
+            address = ADDRESSES[6] + self.random.randrange(self.registers)
+            value = self.random.randrange(0x10000)
+            return slave_id, function_code, struct.pack('>BHH', 6, address, value), 5
+
+        address = ADDRESSES[function_code] + self.random.randrange(self.registers - self.quantity + 1)
+        if function_code == 16:
+            values = [self.random.randrange(0x10000) for _ in range(self.quantity)]
+            pdu = struct.pack('>BHHB%dH' % (self.quantity, ), 16, address, self.quantity,
+                              2 * self.quantity, *values)
+            return slave_id, function_code, pdu, 5
+        return slave_id, function_code, struct.pack('>BHH', function_code, address, self.quantity), \
+            2 + 2 * self.quantity
+
+
+class Results(object):
+    '''
+    Latencies and outcomes of the requests of a run
+    '''
+
+    def __init__(self):
+        self.latencies = array('d')
+        self.requests = 0
+        self.by_function = {}
+        # exception code -> count
+        self.exceptions = {}
+        self.timeouts = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def add(self, function_code, latency):
+        self.requests += 1
+        self.by_function[function_code] = self.by_function.get(function_code, 0) + 1
+        self.latencies.append(latency)
+
+    def add_exception(self, function_code, exception_code, latency):
+        self.add(function_code, latency)
+        self.exceptions[exception_code] = self.exceptions.get(exception_code, 0) + 1
+
+    def add_timeout(self, function_code):
+        self.requests += 1
+        self.by_function[function_code] = self.by_function.get(function_code, 0) + 1
+        self.timeouts += 1
+
+    def add_error(self, function_code):
+        self.requests += 1
+        self.by_function[function_code] = self.by_function.get(function_code, 0) + 1
+        self.errors += 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        self.requests += other.requests
+        for (function_code, count) in other.by_function.items():
+            self.by_function[function_code] = self.by_function.get(function_code, 0) + count
+        for (exception_code, count) in other.exceptions.items():
+            self.exceptions[exception_code] = self.exceptions.get(exception_code, 0) + count
+        self.timeouts += other.timeouts
+        self.errors += other.errors
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        exceptions = sum(self.exceptions.values())
+        failed = exceptions + self.timeouts + self.errors
+        latency = {}
+        if latencies:
+            latency['mean'] = 1000 * sum(latencies) / len(latencies)
+            latency['max'] = 1000 * latencies[-1]
+            for (name, fraction) in PERCENTILES:
+                # nearest rank
+                latency[name] = 1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+        return {
+            'requests': self.requests,
+            'duration': self.elapsed,
+            'throughput': self.requests / self.elapsed if self.elapsed else 0.0,
+            'latency_ms': latency,
+            'by_function': dict(('fc%d' % (function_code, ), count)
+                                for (function_code, count) in sorted(self.by_function.items())),
+            'exceptions': dict((str(code), count) for (code, count) in sorted(self.exceptions.items())),
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'error_rate': float(failed) / self.requests if self.requests else 0.0,
+        }
+
+
+class Budget(object):
+    '''
+    Tells the workers when to stop: after a duration or a number of requests
+    '''
+
+    def __init__(self, duration=None, requests=None):
+        self.deadline = time.perf_counter() + duration if duration else None
+        self.remaining = requests
+
+    def take(self):
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return False
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+        return True
+
+
+async def tcp_worker(host, port, mix, budget, results, timeout):
+    transaction_id = 0
+    reader = writer = None
+    while budget.take():
+        slave_id, function_code, pdu, response_length = mix.next()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            transaction_id = (transaction_id + 1) & 0xffff
+            start = time.perf_counter()
+            writer.write(MBAP.pack(transaction_id, 0, len(pdu) + 1, slave_id) + pdu)
+            header = await asyncio.wait_for(reader.readexactly(MBAP.size), timeout)
+            (response_id, protocol, length, unit) = MBAP.unpack(header)
+            response = await asyncio.wait_for(reader.readexactly(length - 1), timeout)
+            latency = time.perf_counter() - start
+        except asyncio.TimeoutError:
+            results.add_timeout(function_code)
+            # the connection may still deliver the late answer, start over.
+            # There is none yet when connecting timed out
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        except (OSError, asyncio.IncompleteReadError) as e:
+            LOGGER.debug('tcp request failed: %s', e)
+            results.add_error(function_code)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.01)
+            continue
+
+        if response_id != transaction_id or unit != slave_id or not response:
+            results.add_error(function_code)
+        elif response[0] == function_code | 0x80:
+            results.add_exception(function_code, response[1] if len(response) > 1 else 0, latency)
+        elif response[0] != function_code or len(response) != response_length:
+            results.add_error(function_code)
+        else:
+            results.add(function_code, latency)
+    if writer is not None:
+        writer.close()
+
+
+def run_tcp(args, mixes):
+    results = [Results() for _ in mixes]
+    budget = Budget(args.duration, args.requests)
+
+    async def run():
+        await asyncio.gather(*[tcp_worker(args.host, args.port, mix, budget, result, args.timeout)
+                               for (mix, result) in zip(mixes, results)])
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    total = Results()
+    for result in results:
+        total.merge(result)
+    total.elapsed = time.perf_counter() - start
+    return total
+
+
+class PtyPort(object):
+    '''
+    The master side of a pty with the read/write calls of a serial port
+    '''
+
+    def __init__(self, fd, timeout):
+        self.fd = fd
+        self.timeout = timeout
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+    def read(self, size):
+        data = b''
+        deadline = time.perf_counter() + self.timeout
+        while len(data) < size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                break
+            data += os.read(self.fd, size - len(data))
+        return data
+
+    def reset_input_buffer(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 1024)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def run_rtu(args, mix, port):
+    results = Results()
+    budget = Budget(args.duration, args.requests)
+    start = time.perf_counter()
+    while budget.take():
+        slave_id, function_code, pdu, response_length = mix.next()
+        frame = struct.pack('>B', slave_id) + pdu
+        request_start = time.perf_counter()
+        port.write(frame + CRC.pack(calculate_crc(frame)))
+        response = port.read(2)
+        if len(response) == 2 and response[1] == function_code | 0x80:
+            response += port.read(3)
+        elif len(response) == 2:
+            response += port.read(response_length + 1)
+        latency = time.perf_counter() - request_start
+
+        if len(response) < 5:
+            results.add_timeout(function_code)
+            port.reset_input_buffer()
+        elif response[0] != slave_id or CRC.unpack(response[-2:])[0] != calculate_crc(response[:-2]):
+            results.add_error(function_code)
+            port.reset_input_buffer()
+        elif response[1] == function_code | 0x80:
+            results.add_exception(function_code, response[2], latency)
+        elif len(response) != response_length + 3:
+            results.add_error(function_code)
+        else:
+            results.add(function_code, latency)
+        if args.gap:
+            time.sleep(args.gap)
+    results.elapsed = time.perf_counter() - start
+    return results
+
+
+def serve(options, ready):
+    '''
+    Runs a simulator in a child process until it is terminated
+    '''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from modbussim.modbussim import ModbusSim
+
+    logging.disable(logging.CRITICAL)
+    if options['mode'] == 'rtu':
+        sim = ModbusSim(mode='rtu', port=options['serial'], baud=options['baud'],
+                        register_store=options['register_store'])
+    else:
+        sim = ModbusSim(mode='tcp', port=options['port'], hostname=options['host'],
+                        tcp_engine=options['tcp_engine'], register_store=options['register_store'])
+    sim.slaves = {}
+    for slave_id in options['slave_ids']:
+        sim.add_slave(slave_id, options['registers'], options['registers'])
+    sim.server.start()
+    ready.set()
+    signal.pause()
+
+
+def spawn(args, serial_name=None):
+    options = {
+        'mode': args.mode,
+        'host': args.host,
+        'port': args.port,
+        'serial': serial_name,
+        'baud': args.baud,
+        'tcp_engine': args.tcp_engine,
+        'register_store': args.register_store,
+        'slave_ids': parse_slave_ids(args.slaves),
+        'registers': args.registers,
+    }
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve, args=(options, ready), daemon=True)
+    process.start()
+    if not ready.wait(30):
+        process.terminate()
+        raise LoadGenError('Simulator did not start')
+    if args.mode == 'tcp':
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection((args.host, args.port), 1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    process.terminate()
+                    raise LoadGenError('Simulator is not listening on %s:%d' % (args.host, args.port))
+                time.sleep(0.05)
+    return process
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(summary, baseline, tolerance):
+    '''
+    Returns the regressions of summary against a baseline summary
+    '''
+    regressions = []
+    if summary['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append('throughput %.0f req/s, baseline %.0f req/s' %
+                           (summary['throughput'], baseline['throughput']))
+    p99 = summary['latency_ms'].get('p99')
+    baseline_p99 = baseline['latency_ms'].get('p99')
+    if p99 is not None and baseline_p99 is not None and p99 > baseline_p99 * (1 + tolerance):
+        regressions.append('p99 latency %.3f ms, baseline %.3f ms' % (p99, baseline_p99))
+    if summary['error_rate'] > baseline['error_rate'] + tolerance / 100.0:
+        regressions.append('error rate %.4f, baseline %.4f' % (summary['error_rate'], baseline['error_rate']))
+    return regressions
+
+
+def report(summary):
+    latency = summary['latency_ms']
+    print('requests   %d in %.2f s' % (summary['requests'], summary['duration']))
+    print('throughput %.0f req/s' % (summary['throughput'], ))
+    if latency:
+        print('latency    mean %.3f ms  %s  max %.3f ms' %
+              (latency['mean'], '  '.join('%s %.3f ms' % (name, latency[name]) for (name, _) in PERCENTILES),
+               latency['max']))
+    print('mix        %s' % (', '.join('%s %d' % item for item in sorted(summary['by_function'].items())), ))
+    print('errors     %.4f (exceptions %s, timeouts %d, errors %d)' %
+          (summary['error_rate'], summary['exceptions'] or 0, summary['timeouts'], summary['errors']))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Modbus load generator for ModbusSim')
+    parser.add_argument('-m', '--mode', type=str, choices=('tcp', 'rtu'), default='tcp', help='modbus mode')
+    parser.add_argument('-t', '--host', type=str, default='127.0.0.1', help='IP hostname or address in TCP mode')
+    parser.add_argument('-P', '--port', type=int, default=5005, help='IP port in TCP mode')
+    parser.add_argument('-s', '--serial', type=str, default=None,
+                        help='serial port in RTU mode, a local pty pair is used with --spawn when not given')
+    parser.add_argument('-b', '--baud', type=int, default=115200, help='baud rate in RTU mode')
+    parser.add_argument('--spawn', action='store_true', help='start a simulator in a child process')
+    parser.add_argument('-e', '--tcp_engine', type=str, choices=('select', 'asyncio'), default='select',
+                        help='TCP engine of the spawned simulator')
+    parser.add_argument('-r', '--register_store', type=str, choices=('list', 'array'), default='list',
+                        help='register store of the spawned simulator')
+    parser.add_argument('--slaves', type=str, default='1', help='slave ids to poll, like 1-10 or 1,3,5')
+    parser.add_argument('--registers', type=int, default=100,
+                        help='input and holding registers of every slave addressed from 30001 and 40001')
+    parser.add_argument('--quantity', type=int, default=10, help='registers read by FC3/FC4 and written by FC16')
+    parser.add_argument('--mix', type=str, default='fc3=70,fc4=20,fc6=5,fc16=5',
+                        help='weights of the function codes')
+    parser.add_argument('-c', '--connections', type=int, default=1, help='concurrent connections in TCP mode')
+    parser.add_argument('-d', '--duration', type=float, default=None, help='seconds to run')
+    parser.add_argument('-n', '--requests', type=int, default=None, help='requests to send')
+    parser.add_argument('--timeout', type=float, default=1.0, help='seconds to wait for a response')
+    parser.add_argument('--gap', type=float, default=0.0, help='seconds of silence between RTU frames')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the request mix')
+    parser.add_argument('--save', type=str, default=None, help='save the results to a JSON baseline file')
+    parser.add_argument('--baseline', type=str, default=None, help='compare the results with a JSON baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative throughput drop or p99 increase reported as a regression')
+    args = parser.parse_args()
+    if args.duration is None and args.requests is None:
+        args.duration = 10.0
+    if args.mode == 'rtu' and not args.serial and not args.spawn:
+        parser.error('RTU mode needs --serial or --spawn')
+    return args
+
+
+def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    slave_ids = parse_slave_ids(args.slaves)
+
+    process = None
+    port = None
+    try:
+        if args.mode == 'rtu':
+            if args.serial:
+                port = serial.Serial(port=args.serial, baudrate=args.baud, timeout=args.timeout)
+                if args.spawn:
+                    process = spawn(args, args.serial)
+            else:
+                master, slave = os.openpty()
+                tty.setraw(master)
+                process = spawn(args, os.ttyname(slave))
+                os.close(slave)
+                port = PtyPort(master, args.timeout)
+            results = run_rtu(args, RequestMix(mix, slave_ids, args.registers, args.quantity, args.seed), port)
+        else:
+            if args.spawn:
+                process = spawn(args)
+            mixes = [RequestMix(mix, slave_ids, args.registers, args.quantity, args.seed + i)
+                     for i in range(args.connections)]
+            results = run_tcp(args, mixes)
+    finally:
+        if port is not None:
+            port.close()
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    summary = results.summary()
+    report(summary)
+
+    run = {
+        'version': get_version(),
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': dict((key, value) for (key, value) in vars(args).items()
+                       if key not in ('save', 'baseline')),
+        'results': summary,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+        print('saved results to %s' % (args.save, ))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline['results'], args.tolerance)
+        print('baseline   %s (%s)' % (args.baseline, baseline.get('version')))
+        for regression in regressions:
+            print('REGRESSION %s' % (regression, ))
+        if regressions:
+            sys.exit(1)
+        print('no regression beyond %.0f%%' % (100 * args.tolerance, ))
+
+
+if __name__ == '__main__':
+    main()
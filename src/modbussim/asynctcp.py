@@ -0,0 +1,147 @@
+# -*- coding: utf_8 -*-
+import asyncio
+import logging
+import struct
+import threading
+
+from modbus_tk.modbus import Databank, Server
+from modbus_tk.modbus_tcp import TcpQuery
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler())
+LOGGER.setLevel(logging.DEBUG)
+
+# transaction id, protocol id, length, unit id
+MBAP_SIZE = 7
+MBAP_LENGTH = struct.Struct('>H')
+MBAP_LENGTH_OFFSET = 4
+# unit id + function code at least, unit id + 253 bytes of pdu at most
+MBAP_MIN_LENGTH = 2
+MBAP_MAX_LENGTH = 254
+
+
+class MbapProtocol(asyncio.Protocol):
+    '''
+    Splits a Modbus TCP byte stream into MBAP frames and hands each one to
+    the server as a memoryview over the receive buffer
+    '''
+
+    def __init__(self, server):
+        self._server = server
+        self._transport = None
+        self._buffer = bytearray()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._server._connections.add(self)
+        LOGGER.debug('%s is connected' % (transport.get_extra_info('peername'),))
+
+    def connection_lost(self, exc):
+        self._server._connections.discard(self)
+        self._transport = None
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+    def data_received(self, data):
+        if not self._buffer:
+            # common case: the chunk holds whole frames, parse it in place
+            consumed = self._process(data)
+            if consumed < len(data):
+                self._buffer += data[consumed:]
+            return
+
+        self._buffer += data
+        consumed = self._process(self._buffer)
+        if consumed:
+            try:
+                del self._buffer[:consumed]
+            except BufferError:
+                # a handler kept a view on the buffer, leave it to them
+                self._buffer = bytearray(self._buffer[consumed:])
+
+    def _process(self, buff):
+        '''
+        Handles every complete frame in buff and returns the number of bytes used
+        '''
+        offset = 0
+        size = len(buff)
+        with memoryview(buff) as view:
+            while self._transport and size - offset >= MBAP_SIZE:
+                (length, ) = MBAP_LENGTH.unpack_from(buff, offset + MBAP_LENGTH_OFFSET)
+                if not MBAP_MIN_LENGTH <= length <= MBAP_MAX_LENGTH:
+                    LOGGER.warning('Invalid MBAP length %d, closing connection' % (length,))
+                    self._transport.close()
+                    return size
+                end = offset + 6 + length
+                if end > size:
+                    break
+                frame = view[offset:end]
+                try:
+                    response = self._server._handle(frame)
+                except Exception as e:
+                    LOGGER.error('Error while handling a request: %s' % (e,))
+                    response = None
+                finally:
+                    frame.release()
+                if response:
+                    self._transport.write(response)
+                offset = end
+        return offset
+
+
+class AsyncTcpServer(Server):
+    '''
+    Modbus TCP server running every connection on a single asyncio event loop
+    '''
+
+    def __init__(self, port=502, address='', databank=None, reuse_port=False, backlog=1024):
+        Server.__init__(self, databank if databank else Databank())
+        self._sa = (address, port)
+        self._reuse_port = reuse_port
+        self._backlog = backlog
+        self._loop = None
+        self._server = None
+        self._connections = set()
+        self._ready = threading.Event()
+
+    def _make_query(self):
+        return TcpQuery()
+
+    def _do_init(self):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            self._loop.create_server(lambda: MbapProtocol(self),
+                                     host=self._sa[0] or None, port=self._sa[1],
+                                     reuse_address=True,
+                                     reuse_port=self._reuse_port or None,
+                                     backlog=self._backlog))
+        LOGGER.info('AsyncTcpServer listening on %s:%s' % self._sa)
+        self._ready.set()
+
+    def _do_run(self):
+        self._loop.run_forever()
+
+    def _do_exit(self):
+        self._server.close()
+        for connection in list(self._connections):
+            connection.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+        self._loop = None
+        self._ready.clear()
+
+    def start(self):
+        Server.start(self)
+        self._ready.wait(5.0)
+
+    def stop(self):
+        # the server thread replaces self._thread on its way out
+        thread = self._thread
+        if thread.is_alive():
+            self._go.clear()
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+            thread.join()
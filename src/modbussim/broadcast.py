@@ -0,0 +1,114 @@
+# -*- coding: utf_8 -*-
+'''
+Broadcast (slave id 0) writes
+
+A broadcast request is decoded once into a BroadcastWrite which every
+slave then applies as a single slice assignment on the block holding the
+written range, instead of each slave parsing the request pdu again and
+writing item by item.
+'''
+import struct
+
+from array import array
+
+from modbus_tk import defines
+
+from .registers import SWAP_BYTES, ArrayBlock
+from .slave import MAX_WRITE_BITS, MAX_WRITE_REGISTERS
+
+
+SINGLE_WRITE = struct.Struct('>HH')
+MULTIPLE_WRITE_HEADER = struct.Struct('>HHB')
+
+
+class BroadcastWrite(object):
+    '''
+    A decoded broadcast write of count items of block_type from address on
+    '''
+
+    def __init__(self, function_code, block_type, address, count, data=None, values=None, response_pdu=None):
+        self.function_code = function_code
+        self.block_type = block_type
+        self.address = address
+        self.count = count
+        # big endian register image of a register write
+        self._data = data
+        # item values of a coil write
+        self._values = values
+        # typecode -> values, converted once and shared by every slave
+        self._converted = {}
+        # response a slave would have sent, without the function code:
+        # single writes echo their address and value, multiple writes give
+        # their address and quantity
+        self.response_pdu = SINGLE_WRITE.pack(address, count) if response_pdu is None else response_pdu
+
+    def values_for(self, block, unsigned):
+        '''
+        Returns the written values in the form block takes them for a slice
+        assignment: an array for ArrayBlocks, a tuple otherwise
+        '''
+        typecode = 'H' if unsigned else 'h'
+        if self._values is not None:
+            key = ('tuple', typecode)
+        elif isinstance(block, ArrayBlock):
+            key = ('array', block._data.typecode)
+        else:
+            key = ('tuple', typecode)
+
+        values = self._converted.get(key)
+        if values is None:
+            if self._values is not None:
+                values = self._values
+            elif key[0] == 'array':
+                values = array(key[1])
+                values.frombytes(self._data)
+                if SWAP_BYTES:
+                    values.byteswap()
+            else:
+                values = struct.unpack('>%d%s' % (self.count, typecode), self._data)
+            self._converted[key] = values
+        return values
+
+
+def parse_broadcast(request_pdu):
+    '''
+    Decodes a broadcast request pdu. Returns a BroadcastWrite, or None if
+    the request is not a write every slave can apply the same way (the
+    caller then falls back on handing the pdu to every slave)
+    '''
+    if len(request_pdu) < 5:
+        return None
+    function_code = request_pdu[0]
+
+    if function_code == defines.WRITE_SINGLE_REGISTER:
+        (address, value) = SINGLE_WRITE.unpack_from(request_pdu, 1)
+        return BroadcastWrite(function_code, defines.HOLDING_REGISTERS, address, 1,
+                              data=bytes(request_pdu[3:5]), response_pdu=bytes(request_pdu[1:5]))
+
+    if function_code == defines.WRITE_SINGLE_COIL:
+        (address, value) = SINGLE_WRITE.unpack_from(request_pdu, 1)
+        if value not in (0, 0xff00):
+            return None
+        return BroadcastWrite(function_code, defines.COILS, address, 1, values=(1 if value else 0, ),
+                              response_pdu=bytes(request_pdu[1:5]))
+
+    if len(request_pdu) < 6:
+        return None
+    (address, quantity, byte_count) = MULTIPLE_WRITE_HEADER.unpack_from(request_pdu, 1)
+
+    if function_code == defines.WRITE_MULTIPLE_REGISTERS:
+        if (quantity <= 0) or (quantity > MAX_WRITE_REGISTERS) or (byte_count != 2 * quantity) \
+                or len(request_pdu) < 6 + byte_count:
+            return None
+        return BroadcastWrite(function_code, defines.HOLDING_REGISTERS, address, quantity,
+                              data=bytes(request_pdu[6:6 + byte_count]))
+
+    if function_code == defines.WRITE_MULTIPLE_COILS:
+        if (quantity <= 0) or (quantity > MAX_WRITE_BITS) or (byte_count != (quantity + 7) // 8) \
+                or len(request_pdu) < 6 + byte_count:
+            return None
+        bits = request_pdu[6:6 + byte_count]
+        values = tuple((bits[i // 8] >> (i % 8)) & 1 for i in range(quantity))
+        return BroadcastWrite(function_code, defines.COILS, address, quantity, values=values)
+
+    return None
@@ -0,0 +1,78 @@
+# -*- coding: utf_8 -*-
+
+
+class ResponseCache(object):
+    '''
+    Encoded read responses of a slave keyed by their request pdu
+    (function code, starting address, quantity).
+
+    Entries remember the register range they were built from so a write
+    only drops the entries it overlaps. Not thread safe on its own, the
+    slave uses it under its data lock.
+    '''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        # request pdu -> response pdu
+        self._responses = {}
+        # block type -> {request pdu: (first address, last address + 1)}
+        self._ranges = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+
+    def get(self, request_pdu):
+        return self._responses.get(request_pdu)
+
+    def put(self, request_pdu, block_type, address, count, response_pdu):
+        if request_pdu not in self._responses and len(self._responses) >= self.max_entries:
+            # evict the oldest entry
+            self._drop(next(iter(self._responses)))
+        self._responses[request_pdu] = response_pdu
+        self._ranges.setdefault(block_type, {})[request_pdu] = (address, address + count)
+
+    def _drop(self, request_pdu):
+        del self._responses[request_pdu]
+        for ranges in self._ranges.values():
+            ranges.pop(request_pdu, None)
+
+    def invalidate(self, block_type, address, count):
+        '''
+        Drops every entry reading a register in [address, address + count)
+        '''
+        ranges = self._ranges.get(block_type)
+        if not ranges:
+            return
+        end = address + count
+        stale = [request_pdu for (request_pdu, (first, last)) in ranges.items()
+                 if first < end and address < last]
+        for request_pdu in stale:
+            del ranges[request_pdu]
+            del self._responses[request_pdu]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self._responses.clear()
+        self._ranges.clear()
+
+    def record(self, hit, elapsed):
+        if hit:
+            self.hits += 1
+            self.hit_time += elapsed
+        else:
+            self.misses += 1
+            self.miss_time += elapsed
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._responses),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': float(self.hits) / requests if requests else 0.0,
+            'mean_hit_us': 1e6 * self.hit_time / self.hits if self.hits else 0.0,
+            'mean_miss_us': 1e6 * self.miss_time / self.misses if self.misses else 0.0,
+        }
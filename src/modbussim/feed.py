@@ -0,0 +1,152 @@
+# -*- coding: utf_8 -*-
+'''
+Register change feed
+
+Slaves publish every write, from a Modbus master, a broadcast or the API,
+to the ChangeFeed of their databank. Each Subscription picks the writes in
+its slave ids and address ranges and coalesces them into the ranges
+changed since the subscriber last looked, so a register written a thousand
+times between two looks is reported once, with its current value.
+
+Publishing never blocks on a subscriber: a subscription holds at most
+max_ranges changed ranges, and when a slow subscriber lets more pile up
+they are dropped and the subscriber is told it overflowed and has to read
+the registers again.
+'''
+import threading
+
+from bisect import bisect_left, bisect_right
+
+
+class FeedError(Exception):
+    pass
+
+
+def parse_ranges(text):
+    '''
+    Returns the (first, last + 1) address ranges of a list such as
+    40001-40100,30001
+    '''
+    ranges = []
+    try:
+        for part in text.split(','):
+            (first, _, last) = part.partition('-')
+            ranges.append((int(first), int(last or first) + 1))
+    except ValueError:
+        raise FeedError('Invalid address ranges: %s' % (text, ))
+    if any(first >= end for (first, end) in ranges):
+        raise FeedError('Invalid address ranges: %s' % (text, ))
+    return ranges
+
+
+class Subscription(object):
+    '''
+    Writes to slave_ids (all slaves for None) within address ranges (all
+    addresses for None) of block_types (all types for None) since the
+    subscriber last called changes
+    '''
+
+    def __init__(self, slave_ids=None, ranges=None, block_types=None, max_ranges=1024):
+        self.slave_ids = slave_ids
+        self.ranges = ranges
+        self.block_types = block_types
+        self.max_ranges = max_ranges
+        # (slave_id, block_type) -> sorted, disjoint [start, end) pairs
+        # flattened as [start, end, start, end, ...]
+        self._pending = {}
+        self._range_count = 0
+        self._overflowed = False
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+
+    def matches(self, slave_id, block_type):
+        return (self.slave_ids is None or slave_id in self.slave_ids) and \
+            (self.block_types is None or block_type in self.block_types)
+
+    def add(self, slave_id, block_type, address, count):
+        if self.ranges is None:
+            parts = ((address, address + count), )
+        else:
+            parts = [(max(address, first), min(address + count, end)) for (first, end) in self.ranges
+                     if first < address + count and address < end]
+        if not parts:
+            return
+        with self._lock:
+            if self._overflowed:
+                return
+            bounds = self._pending.setdefault((slave_id, block_type), [])
+            for (start, end) in parts:
+                self._merge(bounds, start, end)
+            if self._range_count > self.max_ranges:
+                self._pending = {}
+                self._range_count = 0
+                self._overflowed = True
+        # setting an event takes a lock, most writes find it set already
+        if not self._changed.is_set():
+            self._changed.set()
+
+    def _merge(self, bounds, start, end):
+        # the pairs overlapping or touching [start, end) are replaced by
+        # their union
+        i = bisect_left(bounds, start)
+        j = bisect_right(bounds, end)
+        if i % 2:
+            i -= 1
+            start = bounds[i]
+        if j % 2:
+            end = bounds[j]
+            j += 1
+        self._range_count += 1 - (j - i) // 2
+        bounds[i:j] = [start, end]
+
+    def wait(self, timeout=None):
+        '''
+        Waits for changes, returns False if there were none in timeout seconds
+        '''
+        return self._changed.wait(timeout)
+
+    def changes(self):
+        '''
+        Returns the (slave_id, block_type, address, count) changed since the
+        last call, sorted, and whether some were dropped in between
+        '''
+        with self._lock:
+            self._changed.clear()
+            (pending, overflowed) = (self._pending, self._overflowed)
+            self._pending = {}
+            self._range_count = 0
+            self._overflowed = False
+        changes = []
+        for ((slave_id, block_type), bounds) in sorted(pending.items()):
+            for i in range(0, len(bounds), 2):
+                changes.append((slave_id, block_type, bounds[i], bounds[i + 1] - bounds[i]))
+        return (changes, overflowed)
+
+
+class ChangeFeed(object):
+    '''
+    Publishes the writes of the slaves of a databank to the subscriptions
+    '''
+
+    def __init__(self):
+        self._subscriptions = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = self._subscriptions + (subscription, )
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+    def get_subscription_count(self):
+        return len(self._subscriptions)
+
+    def publish(self, slave_id, block_type, address, count):
+        # subscriptions are replaced, never changed in place, so the tuple
+        # can be walked without the lock
+        for subscription in self._subscriptions:
+            if subscription.matches(slave_id, block_type):
+                subscription.add(slave_id, block_type, address, count)
@@ -0,0 +1,153 @@
+# -*- coding: utf_8 -*-
+'''
+Modbus RTU request framing
+
+RTU frames are delimited by 3.5 characters of silence on the line, which
+at high baud rates is shorter than the timers of most operating systems
+can measure. The length of the requests of the common function codes is
+known from their first bytes though, so the reader reads exactly that many
+bytes and checks the CRC. Only requests of other function codes, and
+frames which do not check out, fall back to waiting for the line to go
+silent.
+
+On a bus shared with other slaves the reader also sees their responses,
+which may be shorter than the request they look like. Once a frame has
+started, the rest of it is only read until the line stays silent for the
+inter-frame gap, so a shorter frame ends at its gap instead of taking the
+first bytes of the next request with it.
+'''
+import struct
+import time
+
+from modbus_tk.utils import calculate_crc, calculate_rtu_inter_char
+
+
+# longest RTU frame
+MAX_FRAME = 256
+
+# bits on the line for a character: start, 8 data bits, parity or stop, stop
+CHARACTER_BITS = 11
+
+# scheduling and USB latency allowed on top of the time a frame takes
+FRAME_SLACK = 0.05
+
+# shortest inter-frame gap waited for, operating system timers are not
+# much finer
+MIN_GAP = 0.005
+
+# function code -> request length, slave id and CRC included
+REQUEST_LENGTHS = {
+    1: 8, 2: 8, 3: 8, 4: 8, 5: 8, 6: 8, 8: 8,
+    7: 4, 11: 4, 12: 4, 17: 4,
+    22: 10,
+}
+
+# function code -> length of the request header ending with the byte count
+# of the values which follow
+BYTE_COUNT_HEADERS = {
+    15: 7,
+    16: 7,
+    23: 11,
+}
+
+CRC = struct.Struct('>H')
+
+
+def request_length(header):
+    '''
+    Returns the length of the request starting with header, None when it
+    cannot be told yet or at all. Headers of at least two bytes tell the
+    length of fixed size requests, the others need their byte count
+    '''
+    function_code = header[1]
+    length = REQUEST_LENGTHS.get(function_code)
+    if length is not None:
+        return length
+    count_header = BYTE_COUNT_HEADERS.get(function_code)
+    if count_header is None or len(header) < count_header:
+        return None
+    return count_header + header[count_header - 1] + 2
+
+
+def check_crc(frame):
+    return len(frame) > 2 and CRC.unpack_from(frame, len(frame) - 2)[0] == calculate_crc(frame[:-2])
+
+
+class RtuFrameReader(object):
+    '''
+    Reads requests from a serial port. The port timeout is set long enough
+    for the longest frame, so reads return as soon as the expected bytes
+    are in. The rest of a started frame is read until the line stays silent
+    for the inter-frame gap
+    '''
+
+    def __init__(self, serial):
+        self._serial = serial
+        baudrate = serial.baudrate
+        # silence which ends a frame of unknown length
+        self.silence = 3.5 * calculate_rtu_inter_char(baudrate)
+        # silence after which a started frame is taken as complete
+        self.gap = max(self.silence, MIN_GAP)
+        self.timeout = MAX_FRAME * CHARACTER_BITS / float(baudrate) + FRAME_SLACK
+        serial.inter_byte_timeout = None
+        serial.timeout = self.timeout
+
+    def read(self):
+        '''
+        Returns the next request, b'' when none came within the timeout
+        '''
+        serial = self._serial
+        frame = serial.read(2)
+        if len(frame) < 2:
+            return self.read_until_silence(frame) if frame else frame
+        length = request_length(frame)
+        if length is None and frame[1] in BYTE_COUNT_HEADERS:
+            frame = self.read_rest(frame, BYTE_COUNT_HEADERS[frame[1]])
+            length = request_length(frame)
+            if length is None:
+                # a shorter frame, such as the response of another slave
+                return frame
+        if length is None or length > MAX_FRAME:
+            return self.read_until_silence(frame)
+        frame = self.read_rest(frame, length)
+        # a frame ending at a gap before length is not a request of ours,
+        # the databank drops it
+        if len(frame) < length or check_crc(frame):
+            return frame
+        # not the frame it looked like, take everything up to the silence
+        return self.read_until_silence(frame)
+
+    def read_rest(self, frame, length):
+        '''
+        Reads frame on up to length bytes, stopping short when the line stays
+        silent for the inter-frame gap
+        '''
+        serial = self._serial
+        if serial.in_waiting >= length - len(frame):
+            # the whole frame is in, as on fast lines, no need to time gaps
+            return frame + serial.read(length - len(frame))
+        serial.timeout = self.gap
+        try:
+            while len(frame) < length:
+                # what is already in comes at once, else the next byte
+                # within the gap
+                chunk = serial.read(min(max(serial.in_waiting, 1), length - len(frame)))
+                if not chunk:
+                    break
+                frame += chunk
+        finally:
+            serial.timeout = self.timeout
+        return frame
+
+    def read_until_silence(self, frame):
+        '''
+        Adds what arrives to frame until the line is silent
+        '''
+        serial = self._serial
+        while len(frame) < MAX_FRAME:
+            time.sleep(self.silence)
+            waiting = serial.in_waiting
+            if not waiting:
+                break
+            frame += serial.read(waiting)
+        return frame
@@ -0,0 +1,233 @@
+# -*- coding: utf_8 -*-
+'''
+Animated registers
+
+A generator computes the value of a register from the time it is read at,
+so animating a register costs nothing until a master (or the REST API)
+reads it. Generators are described by JSON specs such as
+
+    {"type": "sine", "amplitude": 500, "offset": 1000, "period": 60}
+    {"type": "ramp", "start": 0, "stop": 100, "period": 10}
+    {"type": "step", "values": [0, 50, 100], "interval": 5}
+    {"type": "noise", "mean": 230, "stddev": 2}
+    {"type": "random_walk", "start": 500, "step": 5, "min": 0, "max": 1000}
+    {"type": "counter", "start": 0, "rate": 10}
+
+Times are in seconds. Values are rounded and clamped to the range of a
+16 bit register.
+'''
+import math
+import random
+import threading
+import time
+
+from bisect import bisect_left, insort
+
+
+class GeneratorError(Exception):
+    pass
+
+
+class Generator(object):
+    '''
+    Base of the generators: value(elapsed) returns the value elapsed seconds
+    after the generator was attached
+    '''
+    # parameter -> default, None when it is required
+    parameters = {}
+
+    def __init__(self, spec):
+        self.spec = dict(spec)
+        for (name, default) in self.parameters.items():
+            value = spec.get(name, default)
+            if value is None:
+                raise GeneratorError('%s generator needs %s' % (spec.get('type'), name))
+            setattr(self, name, value)
+        unknown = set(spec) - set(self.parameters) - set(['type'])
+        if unknown:
+            raise GeneratorError('Unknown %s generator parameters: %s' % (spec.get('type'), ', '.join(sorted(unknown))))
+        self.started = time.monotonic()
+
+    def value(self, elapsed):
+        raise NotImplementedError()
+
+    def register_value(self, now, unsigned=True):
+        '''
+        Returns the register value at monotonic time now
+        '''
+        value = int(round(self.value(now - self.started)))
+        if unsigned:
+            return min(max(value, 0), 0xffff)
+        return min(max(value, -0x8000), 0x7fff)
+
+
+class Sine(Generator):
+    parameters = {'amplitude': 1.0, 'offset': 0.0, 'period': 60.0, 'phase': 0.0}
+
+    def value(self, elapsed):
+        return self.offset + self.amplitude * math.sin(2 * math.pi * elapsed / self.period + self.phase)
+
+
+class Ramp(Generator):
+    '''
+    Goes from start to stop in period seconds, then starts over
+    '''
+    parameters = {'start': 0.0, 'stop': None, 'period': 60.0}
+
+    def value(self, elapsed):
+        return self.start + (self.stop - self.start) * ((elapsed % self.period) / self.period)
+
+
+class Step(Generator):
+    '''
+    Holds each of values for interval seconds, then starts over
+    '''
+    parameters = {'values': None, 'interval': 1.0}
+
+    def value(self, elapsed):
+        return self.values[int(elapsed // self.interval) % len(self.values)]
+
+
+class Noise(Generator):
+    parameters = {'mean': 0.0, 'stddev': 1.0}
+
+    def value(self, elapsed):
+        return random.gauss(self.mean, self.stddev)
+
+
+class RandomWalk(Generator):
+    '''
+    Moves by a gaussian step of standard deviation step per second since
+    the previous read, kept between min and max
+    '''
+    parameters = {'start': 0.0, 'step': 1.0, 'min': 0.0, 'max': 65535.0}
+
+    def __init__(self, spec):
+        Generator.__init__(self, spec)
+        self._last = 0.0
+        self._value = float(self.start)
+
+    def value(self, elapsed):
+        dt = elapsed - self._last
+        if dt > 0:
+            self._value += random.gauss(0.0, self.step * math.sqrt(dt))
+            self._value = min(max(self._value, self.min), self.max)
+            self._last = elapsed
+        return self._value
+
+
+class Counter(Generator):
+    '''
+    Counts up rate times per second from start, wrapping around at 65536
+    '''
+    parameters = {'start': 0, 'rate': 1.0}
+
+    def value(self, elapsed):
+        return (int(self.start + self.rate * elapsed)) % 0x10000
+
+    def register_value(self, now, unsigned=True):
+        value = int(self.value(now - self.started))
+        return value if unsigned or value < 0x8000 else value - 0x10000
+
+
+GENERATORS = {
+    'sine': Sine,
+    'ramp': Ramp,
+    'step': Step,
+    'noise': Noise,
+    'random_walk': RandomWalk,
+    'counter': Counter,
+}
+
+
+def _is_finite(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        # an int too large for a float
+        return False
+
+
+def make_generator(spec):
+    '''
+    Returns the generator described by a spec, raises GeneratorError when
+    the spec is invalid
+    '''
+    if not isinstance(spec, dict) or spec.get('type') not in GENERATORS:
+        raise GeneratorError('Generator type must be one of %s' % (', '.join(sorted(GENERATORS)), ))
+    generator = GENERATORS[spec['type']](spec)
+    for (name, value) in generator.spec.items():
+        if name == 'type':
+            continue
+        if name == 'values':
+            if not isinstance(value, list) or not value or \
+                    not all(_is_finite(item) for item in value):
+                raise GeneratorError('values must be a non empty list of finite numbers')
+        elif not _is_finite(value):
+            raise GeneratorError('%s must be a finite number' % (name, ))
+    for name in ('period', 'interval'):
+        if name in generator.parameters and getattr(generator, name) <= 0:
+            raise GeneratorError('%s must be positive' % (name, ))
+    return generator
+
+
+class GeneratorIndex(object):
+    '''
+    Generators of a slave by block type and address, sorted so the ones in
+    a range of addresses are found with a bisect
+    '''
+
+    def __init__(self):
+        # block type -> sorted addresses
+        self._addresses = {}
+        # (block type, address) -> generator
+        self._generators = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._generators)
+
+    def set(self, block_type, address, generator):
+        with self._lock:
+            if (block_type, address) not in self._generators:
+                insort(self._addresses.setdefault(block_type, []), address)
+            self._generators[(block_type, address)] = generator
+
+    def remove(self, block_type, address):
+        with self._lock:
+            if self._generators.pop((block_type, address), None) is None:
+                return False
+            addresses = self._addresses[block_type]
+            del addresses[bisect_left(addresses, address)]
+            return True
+
+    def remove_range(self, block_type, address, count):
+        for (generator_address, generator) in self.find(block_type, address, count):
+            self.remove(block_type, generator_address)
+
+    def clear(self):
+        with self._lock:
+            self._addresses = {}
+            self._generators = {}
+
+    def find(self, block_type, address, count=1):
+        '''
+        Returns (address, generator) of the generators of block_type in
+        [address, address + count)
+        '''
+        addresses = self._addresses.get(block_type)
+        if not addresses:
+            return []
+        with self._lock:
+            i = bisect_left(addresses, address)
+            found = []
+            while i < len(addresses) and addresses[i] < address + count:
+                found.append((addresses[i], self._generators[(block_type, addresses[i])]))
+                i += 1
+            return found
+
+    def items(self):
+        with self._lock:
+            return sorted(self._generators.items())
@@ -0,0 +1,349 @@
+# -*- coding: utf_8 -*-
+'''
+Write-ahead journal of register writes
+
+A journal keeps the registers of a simulator across restarts without
+dumping all of them on every change. Its directory holds:
+
+    base-<seq>.snap     a snapshot of every slave
+    incr-<seq>.snap     a snapshot of the slaves written since the previous
+                        snapshot, with their layout and all their registers
+    declared-<seq>.json the slaves declared but not made yet when the
+                        snapshot of the same seq was taken, with their layout
+    journal-<seq>.log   the writes made since the snapshot of the same seq
+
+A background thread follows the change feed of the simulator. Every
+commit_interval it appends the ranges written since its last commit, with
+their current values, to the journal and syncs them in one go, so the
+Modbus thread never waits on the disk and a register written many times
+in between is stored once. Every compact_interval, or as soon as slaves
+are added, declared or removed, it starts a new journal after an incremental
+snapshot of the slaves written or added meanwhile; every full_every
+compactions, or once slaves were removed, a base snapshot replaces all the
+files before it.
+
+Restoring loads the latest base snapshot and the incremental snapshots
+after it, declares the slaves declared at the latest one, then replays the
+journals from the latest snapshot on. Records
+are checksummed, a record torn by a crash ends the replay of its file.
+'''
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from modbus_tk.exceptions import MissingKeyError, OutOfModbusBlockError
+
+from .feed import Subscription
+
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'MBJL'
+VERSION = 1
+
+FILE_HEADER = struct.Struct('>4sH')
+# a record is the checksum of the rest of it, then the length of its data,
+# the slave id, block type, starting address and count of the values the
+# data holds, then the data
+CHECKSUM = struct.Struct('>I')
+RECORD = struct.Struct('>IBBHI')
+
+# seconds to wait before trying again after a failure
+RETRY_INTERVAL = 1.0
+
+FILE_NAME = re.compile(r'^(base|incr|declared|journal)-(\d{8})\.(snap|json|log)$')
+
+# kind -> extension of the files of a kind
+EXTENSIONS = {
+    'base': 'snap',
+    'incr': 'snap',
+    'declared': 'json',
+    'journal': 'log',
+}
+
+
+class JournalError(Exception):
+    pass
+
+
+class Journal(object):
+    '''
+    Journal of the register writes of sim kept in directory
+    '''
+
+    def __init__(self, sim, directory, commit_interval=0.05, compact_interval=60.0, full_every=16,
+                 max_ranges=65536):
+        self.sim = sim
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.compact_interval = compact_interval
+        self.full_every = full_every
+        self.max_ranges = max_ranges
+        self._subscription = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._file = None
+        self._seq = 0
+        # slaves written since the last snapshot, the slaves it held and the
+        # entries of the ones declared then
+        self._dirty = set()
+        self._known = set()
+        self._known_declared = {}
+        self._incremental_count = 0
+        self._overflowed = False
+        # workers write registers this process does not hear of, only full
+        # snapshots catch their writes
+        self._full_only = getattr(sim.server, 'workers', 0) > 0
+        self.stats = {'records': 0, 'bytes': 0, 'commits': 0, 'incremental_snapshots': 0,
+                      'base_snapshots': 0, 'last_commit_seconds': 0.0, 'failed': False, 'failures': 0,
+                      'last_error': None}
+
+    def _files(self, kind):
+        '''
+        Returns the sorted (seq, path) of the files of a kind
+        '''
+        files = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            match = FILE_NAME.match(name)
+            if match and match.group(1) == kind:
+                files.append((int(match.group(2)), os.path.join(self.directory, name)))
+        return sorted(files)
+
+    def _path(self, kind, seq):
+        return os.path.join(self.directory, '%s-%08d.%s' % (kind, seq, EXTENSIONS[kind]))
+
+    def exists(self):
+        '''
+        Returns True if the directory holds a journal to restore
+        '''
+        return len(self._files('base')) > 0
+
+    def restore(self):
+        '''
+        Replaces the slaves of the simulator with the ones of the journal
+        '''
+        start = time.perf_counter()
+        bases = self._files('base')
+        if not bases:
+            raise JournalError('No base snapshot in %s' % (self.directory, ))
+        (latest, path) = bases[-1]
+        self.sim.load_snapshot_file(path)
+        base = latest
+        for (seq, path) in self._files('incr'):
+            if seq > base:
+                self.sim.load_snapshot_file(path, incremental=True)
+                latest = seq
+        # declared before the replay, which makes the ones written since
+        declared = self._path('declared', latest)
+        if os.path.exists(declared):
+            self._declare(declared)
+        records = 0
+        for (seq, path) in self._files('journal'):
+            if seq >= latest:
+                records += self._replay(path)
+        LOGGER.info('Restored %d slaves and replayed %d journal records from %s in %.2f s' %
+                    (len(self.sim.slaves), records, self.directory, time.perf_counter() - start))
+
+    def _declare(self, path):
+        with open(path, 'rb') as f:
+            self.sim.declare_entries(json.loads(f.read().decode('utf-8')))
+
+    def _get_declared(self):
+        return self.sim.server.get_db().get_declared_entries()
+
+    def _replay(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < FILE_HEADER.size or FILE_HEADER.unpack_from(data, 0) != (MAGIC, VERSION):
+            LOGGER.warning('Skipped journal %s, it has no valid header' % (path, ))
+            return 0
+        view = memoryview(data)
+        offset = FILE_HEADER.size
+        records = 0
+        while offset + CHECKSUM.size + RECORD.size <= len(data):
+            (checksum, ) = CHECKSUM.unpack_from(data, offset)
+            (length, slave_id, block_type, address, count) = RECORD.unpack_from(data, offset + CHECKSUM.size)
+            start = offset + CHECKSUM.size + RECORD.size
+            end = start + length
+            if end > len(data) or zlib.crc32(view[offset + CHECKSUM.size:end]) != checksum:
+                break
+            self._apply(slave_id, block_type, address, count, view[start:end])
+            records += 1
+            offset = end
+        if offset != len(data):
+            LOGGER.warning('Journal %s ends with %d bytes of a torn record' % (path, len(data) - offset))
+        view.release()
+        return records
+
+    def _apply(self, slave_id, block_type, address, count, data):
+        try:
+            slave = self.sim.server.get_slave(slave_id)
+        except MissingKeyError:
+            return
+        route = slave.route(address, count, block_type)
+        if route is not None:
+            slave.set_bytes(route[0], address, data, count)
+
+    def start(self):
+        '''
+        Writes a base snapshot of the current slaves and starts journaling
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        files = self._files('base') + self._files('incr') + self._files('journal')
+        self._seq = max([seq for (seq, path) in files] or [0])
+        self._subscription = self.sim.server.get_db().change_feed.subscribe(
+            Subscription(max_ranges=self.max_ranges))
+        self._compact(True)
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+        LOGGER.info('Journaling register writes to %s' % (self.directory, ))
+
+    def close(self):
+        '''
+        Commits the last writes and stops journaling
+        '''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self._commit()
+        except Exception as e:
+            self._fail(e)
+        self.sim.server.get_db().change_feed.unsubscribe(self._subscription)
+        if self._file is not None:
+            self._file.close()
+
+    def _run(self):
+        next_compaction = time.monotonic() + self.compact_interval
+        while not self._stop.is_set():
+            try:
+                if self._subscription.wait(min(1.0, max(next_compaction - time.monotonic(), 0.0))):
+                    # writes coming in the meantime are committed with these
+                    self._stop.wait(self.commit_interval)
+                    self._commit()
+                # slaves added, declared or removed are only kept by a snapshot
+                if self._overflowed or self._known != set(self.sim.slaves) or \
+                        self._known_declared != self._get_declared() or time.monotonic() >= next_compaction:
+                    self._compact(self._overflowed)
+                    next_compaction = time.monotonic() + self.compact_interval
+                self.stats['failed'] = False
+            except Exception as e:
+                self._fail(e)
+                self._stop.wait(RETRY_INTERVAL)
+
+    def _fail(self, e):
+        # the writes being committed may be lost, the base snapshot taken
+        # once the journal works again holds them
+        self._overflowed = True
+        self.stats['failed'] = True
+        self.stats['failures'] += 1
+        self.stats['last_error'] = '%s: %s' % (type(e).__name__, e)
+        LOGGER.error('Journal in %s failed: %s' % (self.directory, e))
+
+    def _commit(self):
+        (changes, overflowed) = self._subscription.changes()
+        if overflowed:
+            # the ranges written were dropped, a base snapshot holds them
+            self._overflowed = True
+        if not changes:
+            return
+        if self._file is None:
+            # a compaction failed to open the next journal
+            self._overflowed = True
+            return
+        start = time.perf_counter()
+        records = []
+        for (slave_id, slave, block_type, block_name, address, count) in self.sim.iter_change_blocks(changes):
+            try:
+                data = slave.get_bytes(block_name, address, count)
+            except (MissingKeyError, OutOfModbusBlockError):
+                # the block was removed or replaced meanwhile, the snapshot
+                # of the slave written then holds its new layout
+                continue
+            body = RECORD.pack(len(data), slave_id, block_type, address, count) + data
+            records.append(CHECKSUM.pack(zlib.crc32(body)) + body)
+            self._dirty.add(slave_id)
+        buff = b''.join(records)
+        self._file.write(buff)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.stats['records'] += len(records)
+        self.stats['bytes'] += len(buff)
+        self.stats['commits'] += 1
+        self.stats['last_commit_seconds'] = time.perf_counter() - start
+
+    def _compact(self, full=False):
+        self._commit()
+        slaves = set(self.sim.slaves)
+        declared = self._get_declared()
+        full = full or self._full_only or self._incremental_count >= self.full_every or \
+            len(self._known - slaves) > 0
+        dirty = self._dirty | (slaves - self._known)
+        if not full and not dirty and declared == self._known_declared:
+            return
+        seq = self._seq + 1
+        # writes from now on go to the journal of the new snapshot, which
+        # replays them over it
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # taken even if the snapshot fails, a retry starts a journal of its own
+        self._seq = seq
+        self._file = open(self._path('journal', seq), 'wb')
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        (self._dirty, self._known, self._known_declared, self._overflowed) = (set(), slaves, declared, False)
+        # written before the snapshot, which makes it the latest one
+        data = json.dumps(declared, sort_keys=True).encode('utf-8')
+        self._write_file(self._path('declared', seq), lambda f: f.write(data))
+        if full:
+            self._write_snapshot(self._path('base', seq), None)
+            self._incremental_count = 0
+            self.stats['base_snapshots'] += 1
+            obsolete = self._files('base') + self._files('incr')
+        else:
+            self._write_snapshot(self._path('incr', seq), dirty)
+            self._incremental_count += 1
+            self.stats['incremental_snapshots'] += 1
+            obsolete = []
+        obsolete += self._files('declared') + self._files('journal')
+        for (old_seq, path) in obsolete:
+            if old_seq < seq:
+                os.remove(path)
+
+    def _write_snapshot(self, path, slave_ids):
+        # the declared slaves are kept in a file of their own
+        self._write_file(path, lambda f: self.sim.write_snapshot(f, slave_ids, declared=False))
+
+    def _write_file(self, path, write):
+        '''
+        Writes a file with write(f), so that it is either complete or not
+        there
+        '''
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        except Exception:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            raise
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def get_stats(self):
+        return dict(self.stats, seq=self._seq, dirty_slaves=len(self._dirty), directory=self.directory,
+                    running=self._thread is not None and self._thread.is_alive())
@@ -0,0 +1,177 @@
+# -*- coding: utf_8 -*-
+'''
+Several Modbus RTU serial lines served by one simulator
+
+Every line gets its own ModbusRtuServer, reading its port on its own
+thread, and answers for its own set of slave ids; all of them share the
+databank of the simulator. A line on port 'pty' is a virtual serial port:
+masters open the device it reports, which is linked to the line through a
+pair of ptys.
+'''
+import logging
+import os
+import select
+import serial
+import threading
+import tty
+
+from modbus_tk.modbus import Server
+
+from .modbussim import ModbusRtuServer, ModbusSimError
+
+
+LOGGER = logging.getLogger(__name__)
+
+PTY = 'pty'
+
+
+def parse_slave_ids(text):
+    '''
+    Returns the set of slave ids of a list such as 1-16,20,32-40
+    '''
+    slave_ids = set()
+    try:
+        for part in text.split(','):
+            (first, _, last) = part.partition('-')
+            slave_ids.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise ModbusSimError('Invalid slave ids: %s' % (text, ))
+    return slave_ids
+
+
+def format_slave_ids(slave_ids):
+    '''
+    Returns a set of slave ids as a list such as 1-16,20, or 'all' for None
+    '''
+    if slave_ids is None:
+        return 'all'
+    ranges = []
+    for slave_id in sorted(slave_ids):
+        if ranges and ranges[-1][1] == slave_id - 1:
+            ranges[-1][1] = slave_id
+        else:
+            ranges.append([slave_id, slave_id])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last) for (first, last) in ranges)
+
+
+def parse_line(text):
+    '''
+    Returns the line of a PORT or PORT@SLAVE_IDS command line argument
+    '''
+    (port, _, slave_ids) = text.partition('@')
+    return {'port': port, 'slave_ids': parse_slave_ids(slave_ids) if slave_ids else None}
+
+
+class PtyBridge(object):
+    '''
+    Two linked pty pairs: whatever is written to one device is read from the
+    other, like the ends of a null modem cable
+    '''
+
+    def __init__(self):
+        self._fds = []
+        (self._line_master, line_slave) = self._openpty()
+        (self._master, master_slave) = self._openpty()
+        self.line_device = os.ttyname(line_slave)
+        self.device = os.ttyname(master_slave)
+        (self._stop_r, self._stop_w) = os.pipe()
+        self._thread = threading.Thread(target=self._run, name='pty-bridge %s' % (self.device, ), daemon=True)
+        self._thread.start()
+
+    def _openpty(self):
+        (master, slave) = os.openpty()
+        # the slave ends stay open so the masters never read a hang up while
+        # nobody has the devices open
+        tty.setraw(slave)
+        self._fds.extend((master, slave))
+        return (master, slave)
+
+    def _run(self):
+        peers = {self._line_master: self._master, self._master: self._line_master}
+        while True:
+            (readable, _, _) = select.select([self._line_master, self._master, self._stop_r], [], [])
+            if self._stop_r in readable:
+                break
+            for fd in readable:
+                os.write(peers[fd], os.read(fd, 4096))
+
+    def close(self):
+        os.write(self._stop_w, b'x')
+        self._thread.join()
+        for fd in self._fds + [self._stop_r, self._stop_w]:
+            os.close(fd)
+
+
+class RtuLines(Server):
+    '''
+    Modbus server running one ModbusRtuServer per serial line over a shared
+    databank. lines are dicts with a port, and optionally a baud rate, a
+    parity and the set of slave ids of the line (every slave when None)
+    '''
+
+    def __init__(self, databank, lines, baud=9600):
+        Server.__init__(self, databank)
+        # (line, bridge, server) of every line
+        self._lines = []
+        try:
+            for line in lines:
+                self._add_line(dict(line), baud)
+        except Exception:
+            self.close()
+            raise
+
+    def _add_line(self, line, baud):
+        line.setdefault('baud', baud)
+        line.setdefault('parity', serial.PARITY_NONE)
+        line.setdefault('slave_ids', None)
+        bridge = None
+        port = line['port']
+        if port == PTY:
+            bridge = PtyBridge()
+            port = bridge.line_device
+            line['device'] = bridge.device
+        try:
+            server = ModbusRtuServer(serial.Serial(port=port, baudrate=line['baud'], parity=line['parity']),
+                                     self._databank)
+        except Exception:
+            if bridge is not None:
+                bridge.close()
+            raise
+        server.slave_ids = line['slave_ids']
+        self._lines.append((line, bridge, server))
+        LOGGER.info('Modbus rtu line on %s: baud = %d slave ids = %s' %
+                    (line.get('device', port), line['baud'], format_slave_ids(line['slave_ids'])))
+
+    def set_verbose(self, verbose):
+        Server.set_verbose(self, verbose)
+        for (line, bridge, server) in self._lines:
+            server.set_verbose(verbose)
+
+    def start(self):
+        for (line, bridge, server) in self._lines:
+            server.start()
+
+    def stop(self):
+        for (line, bridge, server) in self._lines:
+            server.stop()
+
+    def close(self):
+        for (line, bridge, server) in self._lines:
+            server.close()
+            if bridge is not None:
+                bridge.close()
+
+    def get_lines(self):
+        lines = []
+        for (index, (line, bridge, server)) in enumerate(self._lines):
+            lines.append({
+                'index': index,
+                'port': line['port'],
+                'device': line.get('device', line['port']),
+                'baud': line['baud'],
+                'parity': line['parity'],
+                'slave_ids': format_slave_ids(line['slave_ids']),
+                'running': server._thread.is_alive(),
+            })
+        return lines
+
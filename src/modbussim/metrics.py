@@ -0,0 +1,183 @@
+# -*- coding: utf_8 -*-
+'''
+Request metrics in the Prometheus text format
+
+Every thread records into its own counters, so the hot path takes no lock
+and shares no cache line with other threads. Scraping sums the counters of
+all threads; the counters of threads which ended are folded into a single
+retired set so REST worker threads do not pile up.
+'''
+import threading
+
+from bisect import bisect_left
+
+
+# histogram upper bounds in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# index of the count, exception count and latency sum in a series, the
+# histogram buckets follow
+COUNT = 0
+EXCEPTIONS = 1
+TOTAL = 2
+BUCKETS = 3
+
+
+class ThreadCounters(object):
+    '''
+    Series recorded by one thread, keyed by their label values
+    '''
+
+    def __init__(self):
+        # (transport, slave_id, function_code) -> series
+        self.requests = {}
+        # (route, method, status) -> series
+        self.routes = {}
+        # transport -> count
+        self.errors = {}
+
+    def merge(self, other):
+        for (mine, theirs) in ((self.requests, other.requests), (self.routes, other.routes)):
+            for (key, series) in list(theirs.items()):
+                current = mine.get(key)
+                if current is None:
+                    mine[key] = list(series)
+                else:
+                    for (i, value) in enumerate(series):
+                        current[i] += value
+        for (key, count) in list(other.errors.items()):
+            self.errors[key] = self.errors.get(key, 0) + count
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    labels = ','.join('%s="%s"' % (name, escape(value)) for (name, value) in zip(names, values))
+    if extra:
+        labels = labels + ',' + extra if labels else extra
+    return '{%s}' % (labels, )
+
+
+class Metrics(object):
+    '''
+    Counters and latency histograms of Modbus requests by transport, slave
+    id and function code, and of REST requests by route, method and status
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (thread, counters) of every thread which recorded something
+        self._threads = []
+        self._retired = ThreadCounters()
+
+    def _get_counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = ThreadCounters()
+            with self._lock:
+                self._retire()
+                self._threads.append((threading.current_thread(), counters))
+            self._local.counters = counters
+            return counters
+
+    def _retire(self):
+        # called with the lock held
+        alive = []
+        for (thread, counters) in self._threads:
+            if thread.is_alive():
+                alive.append((thread, counters))
+            else:
+                self._retired.merge(counters)
+        self._threads = alive
+
+    def _observe(self, series_by_key, key, elapsed, exception):
+        series = series_by_key.get(key)
+        if series is None:
+            series = series_by_key[key] = [0, 0, 0.0] + [0] * (len(self.buckets) + 1)
+        series[COUNT] += 1
+        if exception:
+            series[EXCEPTIONS] += 1
+        series[TOTAL] += elapsed
+        series[BUCKETS + bisect_left(self.buckets, elapsed)] += 1
+
+    def observe_request(self, transport, slave_id, function_code, elapsed, exception=False):
+        '''
+        Records a Modbus request which took elapsed seconds. exception is
+        true when it was answered with an exception response or failed
+        '''
+        self._observe(self._get_counters().requests, (transport, slave_id, function_code), elapsed, exception)
+
+    def observe_error(self, transport):
+        '''
+        Records a Modbus request which could not be handled at all
+        '''
+        errors = self._get_counters().errors
+        errors[transport] = errors.get(transport, 0) + 1
+
+    def observe_route(self, route, method, status, elapsed):
+        '''
+        Records a REST request which took elapsed seconds
+        '''
+        self._observe(self._get_counters().routes, (route, method, status), elapsed, status >= 500)
+
+    def collect(self):
+        '''
+        Returns the sum of the counters of every thread
+        '''
+        total = ThreadCounters()
+        with self._lock:
+            self._retire()
+            total.merge(self._retired)
+            for (thread, counters) in self._threads:
+                total.merge(counters)
+        return total
+
+    def _render_histogram(self, lines, name, help_text, label_names, series_by_key):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s histogram' % (name, ))
+        for key in sorted(series_by_key, key=lambda key: tuple(str(value) for value in key)):
+            series = series_by_key[key]
+            cumulative = 0
+            for (i, bound) in enumerate(self.buckets + (None, )):
+                cumulative += series[BUCKETS + i]
+                le = 'le="%s"' % ('+Inf' if bound is None else repr(bound), )
+                lines.append('%s_bucket%s %d' % (name, format_labels(label_names, key, le), cumulative))
+            lines.append('%s_sum%s %r' % (name, format_labels(label_names, key), series[TOTAL]))
+            lines.append('%s_count%s %d' % (name, format_labels(label_names, key), series[COUNT]))
+
+    def _render_counter(self, lines, name, help_text, label_names, values_by_key):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % (name, ))
+        for key in sorted(values_by_key, key=lambda key: tuple(str(value) for value in key)):
+            lines.append('%s%s %d' % (name, format_labels(label_names, key), values_by_key[key]))
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format
+        '''
+        total = self.collect()
+        request_labels = ('transport', 'slave', 'function')
+        route_labels = ('route', 'method', 'status')
+        lines = []
+        self._render_counter(lines, 'modbussim_requests_total', 'Modbus requests handled', request_labels,
+                             dict((key, series[COUNT]) for (key, series) in total.requests.items()))
+        self._render_counter(lines, 'modbussim_request_exceptions_total',
+                             'Modbus requests answered with an exception response or failed', request_labels,
+                             dict((key, series[EXCEPTIONS]) for (key, series) in total.requests.items()))
+        self._render_counter(lines, 'modbussim_request_errors_total',
+                             'Modbus requests which could not be handled at all', ('transport', ),
+                             dict(((key, ), count) for (key, count) in total.errors.items()))
+        self._render_histogram(lines, 'modbussim_request_duration_seconds', 'Time spent handling Modbus requests',
+                               request_labels, total.requests)
+        self._render_counter(lines, 'modbussim_http_requests_total', 'REST requests handled', route_labels,
+                             dict((key, series[COUNT]) for (key, series) in total.routes.items()))
+        self._render_histogram(lines, 'modbussim_http_request_duration_seconds',
+                               'Time spent handling REST requests, up to the first byte of streamed responses',
+                               route_labels, total.routes)
+        return '\n'.join(lines) + '\n'
@@ -1,13 +1,35 @@
 # -*- coding: utf_8 -*-
+import json
 import logging
+import mmap
+import os
 import serial
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
 
 from modbus_tk import modbus
+from modbus_tk.exceptions import DuplicatedKeyError, MissingKeyError, OutOfModbusBlockError, OverlapModbusBlockError
 from modbus_tk.hooks import call_hooks
-from modbus_tk.modbus_rtu import RtuServer
-from modbus_tk.modbus_tcp import TcpServer
+from modbus_tk.modbus_rtu import RtuQuery, RtuServer
+from modbus_tk.modbus_tcp import TcpQuery, TcpServer
 from modbus_tk.simulator import Simulator
-from modbus_tk.utils import calculate_rtu_inter_char
+
+from .asynctcp import AsyncTcpServer
+from .broadcast import parse_broadcast
+from .cache import ResponseCache
+from .feed import ChangeFeed
+from .framing import RtuFrameReader
+from .generators import make_generator
+from .modbusutil import bytes_to_registers, registers_to_bytes
+from .playback import Playback, PlaybackError, PlaybackRegister, register_count
+from .points import PointError, PointMap
+from .slave import ArraySlave, ModbusSlave
+from .snapshot import SnapshotError, read_declared, read_snapshot, release_snapshot, write_snapshot
+from .templates import SlaveTemplate, TemplateError
+from .trace import REQUEST, RESPONSE, FrameTrace
 
 
 LOGGER = logging.getLogger(__name__)
@@ -19,26 +41,297 @@ class ModbusSimError(Exception):
     pass
 
 
+# block type -> (block name, starting address, key of its size in ModbusSim.slaves)
+BLOCKS = {
+    4: ('input_registers', 30001, 'input_register_count'),
+    3: ('holding_registers', 40001, 'holding_register_count'),
+    1: ('coils', 1, 'coil_count'),
+    2: ('discrete_inputs', 10001, 'discrete_input_count'),
+}
+
+# block types whose items are single bits
+BIT_BLOCKS = (1, 2)
+
+
+# block name -> block type
+BLOCK_TYPES = dict((name, block_type) for (block_type, (name, address, count_key)) in BLOCKS.items())
+
+# addresses of the modbus address space of every block type
+ADDRESS_SPACE = 0x10000
+
+# highest slave id a Modbus master can address
+MAX_SLAVE_ID = 247
+
+
+def parse_segments(segments):
+    '''
+    Returns the (block_type, starting_address, count) of every segment of a
+    sparse register map. Segments are dicts giving the type (a block name
+    such as holding_registers), address and count of a range of items
+    '''
+    parsed = []
+    for segment in segments:
+        try:
+            (name, address, count) = (segment['type'], segment['address'], segment['count'])
+        except (KeyError, TypeError):
+            raise ModbusSimError('Segments need a type, an address and a count')
+        if name not in BLOCK_TYPES:
+            raise ModbusSimError('Segment type must be one of %s' % (', '.join(sorted(BLOCK_TYPES)), ))
+        if not isinstance(address, int) or not isinstance(count, int) or address < 0 or count <= 0 \
+                or address + count > ADDRESS_SPACE:
+            raise ModbusSimError('Segment %s %s count %s is out of the address space' % (name, address, count))
+        parsed.append((BLOCK_TYPES[name], address, count))
+    return parsed
+
+
+def segment_name(block_type, address):
+    '''
+    Returns the block name of the segment of block_type starting at address
+    '''
+    return '%s_%d' % (BLOCKS[block_type][0], address)
+
+
+def image_length(block_type, count):
+    '''
+    Returns the length of the snapshot image of count items of block_type
+    '''
+    return (count + 7) // 8 if block_type in BIT_BLOCKS else 2 * count
+
+# query class -> transport label of the request metrics
+TRANSPORTS = {
+    TcpQuery: 'tcp',
+    RtuQuery: 'rtu',
+}
+
+REGISTER_STORES = {
+    'list': ModbusSlave,
+    'array': ArraySlave,
+}
+
+
 class ModbusDatabank(modbus.Databank):
-    def handle_request(self, query, request):
+    def __init__(self, error_on_missing_slave=True, slave_class=ModbusSlave, response_cache=False,
+                 broadcast_thread=False, trace_size=0, metrics=None):
+        modbus.Databank.__init__(self, error_on_missing_slave)
+        # a Metrics recording every request
+        self.metrics = metrics
+        self.slave_class = slave_class
+        self.response_cache = response_cache
+        # name -> Playback of the recordings being played into registers
+        self.playbacks = {}
+        # a FrameTrace of the last trace_size frames when tracing
+        self.trace = FrameTrace(trace_size) if trace_size else None
+        # publishes the writes of every slave to the subscribers
+        self.change_feed = ChangeFeed()
+        # slave_id -> (materialize(slave_id), entry) of the slaves declared
+        # but not made yet, see declare_slave
+        self._declared = {}
+        # applies broadcasts in order, off the thread serving the requests
+        self._broadcast_executor = None
+        if broadcast_thread:
+            self._broadcast_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='broadcast')
+
+    def close(self):
+        if self._broadcast_executor is not None:
+            self._broadcast_executor.shutdown(wait=True)
+        for name in list(self.playbacks):
+            self.remove_playback(name)
+
+    def add_playback(self, name, playback):
+        with self._lock:
+            if name in self.playbacks:
+                raise DuplicatedKeyError('Playback %s already exists' % (name, ))
+            self.playbacks[name] = playback
+
+    def remove_playback(self, name):
+        '''
+        Stops a playback, its registers keep their last values
+        '''
+        with self._lock:
+            if name not in self.playbacks:
+                raise MissingKeyError('Playback %s does not exist' % (name, ))
+            playback = self.playbacks.pop(name)
+            slaves = list(self._slaves.values())
+        for slave in slaves:
+            for ((block_type, address), generator) in slave.generators.items():
+                if getattr(generator, 'playback', None) is playback:
+                    slave.remove_generator(address, block_type)
+        playback.close()
+
+    def make_generator(self, spec):
+        '''
+        Returns the generator of a spec, including the playback generators
+        '''
+        if isinstance(spec, dict) and spec.get('type') == 'playback':
+            return PlaybackRegister(spec['playback'], self.playbacks[spec['playback']], spec['column'],
+                                    spec['format'], spec['word'])
+        return make_generator(spec)
+
+    def add_slave(self, slave_id, unsigned=True, memory=None):
+        with self._lock:
+            if (slave_id <= 0) or (slave_id > 255):
+                raise ModbusSimError('Invalid slave id %s' % (slave_id,))
+            if slave_id in self._slaves or slave_id in self._declared:
+                raise DuplicatedKeyError('Slave %s already exists' % (slave_id,))
+            slave = self.slave_class(slave_id, unsigned, memory)
+            if self.response_cache:
+                slave.response_cache = ResponseCache()
+            slave.change_feed = self.change_feed
+            self._slaves[slave_id] = slave
+            return slave
+
+    def get_cache_stats(self):
+        '''
+        Returns the response cache statistics of every slave by slave id
+        '''
+        with self._lock:
+            slaves = list(self._slaves.items())
+        return dict((slave_id, slave.response_cache.get_stats()) for (slave_id, slave) in slaves
+                    if slave.response_cache is not None)
+
+    def get_slave(self, slave_id):
+        # a dict lookup needs no lock, so the threads serving requests do not
+        # contend for the databank lock
+        slave = self._slaves.get(slave_id)
+        if slave is None:
+            return self._materialize(slave_id)
+        return slave
+
+    def declare_slave(self, slave_id, materialize, entry=None):
+        '''
+        Declares a slave which is only made, by calling materialize(slave_id),
+        when it is first looked up. entry describes it until then
+        '''
+        with self._lock:
+            if (slave_id <= 0) or (slave_id > MAX_SLAVE_ID):
+                raise ModbusSimError('Invalid slave id %s' % (slave_id,))
+            if slave_id in self._slaves or slave_id in self._declared:
+                raise DuplicatedKeyError('Slave %s already exists' % (slave_id,))
+            self._declared[slave_id] = (materialize, entry)
+
+    def undeclare_slave(self, slave_id):
+        '''
+        Forgets a declared slave. Returns False if it was not declared
+        '''
+        with self._lock:
+            return self._declared.pop(slave_id, None) is not None
+
+    def is_declared(self, slave_id):
+        return slave_id in self._declared
+
+    def get_declared(self):
+        '''
+        Returns the ids of the declared slaves not made yet
+        '''
+        with self._lock:
+            return sorted(self._declared)
+
+    def get_declared_entries(self):
+        '''
+        Returns the entries of the declared slaves not made yet by slave id
+        '''
+        with self._lock:
+            return dict((slave_id, entry) for (slave_id, (materialize, entry)) in self._declared.items())
+
+    def _materialize(self, slave_id):
+        with self._lock:
+            slave = self._slaves.get(slave_id)
+            if slave is not None:
+                return slave
+            declared = self._declared.pop(slave_id, None)
+            if declared is None:
+                raise MissingKeyError("Slave %s doesn't exist" % (slave_id, ))
+            try:
+                declared[0](slave_id)
+            except Exception as e:
+                # still declared, requests to it are answered as to a missing
+                # slave rather than failing in the request path
+                self._declared[slave_id] = declared
+                LOGGER.error('Cannot make declared slave %s: %s' % (slave_id, e))
+                raise MissingKeyError('Slave %s cannot be made: %s' % (slave_id, e))
+            return self._slaves[slave_id]
+
+    def remove_all_slaves(self):
+        with self._lock:
+            self._declared.clear()
+            modbus.Databank.remove_all_slaves(self)
+
+    def handle_request(self, query, request, slave_ids=None):
+        '''
+        Handles a request, broadcasts only reaching the slaves in slave_ids
+        when it is given
+        '''
+        trace = self.trace
+        if trace is None:
+            return self._handle_request(query, request, slave_ids)
+        trace.record(REQUEST, request)
+        response = self._handle_request(query, request, slave_ids)
+        if response:
+            trace.record(RESPONSE, response)
+        return response
+
+    def _handle_request(self, query, request, slave_ids=None):
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
         request_pdu = ''
+        slave_id = None
+        response = None
+        exception = True
         try:
             (slave_id, request_pdu) = query.parse_request(request)
             if slave_id == 0:
-                for key in self._slaves:
-                    self._slaves[key].handle_request(request_pdu,
-                                                     broadcast=True)
-                return
+                self.handle_broadcast(request_pdu, slave_ids)
+                exception = False
             else:
                 slave = self.get_slave(slave_id)
                 response_pdu = slave.handle_request(request_pdu)
+                exception = bool(response_pdu) and response_pdu[0] > 0x80
                 response = query.build_response(response_pdu)
-                return response
         except Exception as e:
             call_hooks('modbus.Databank.on_error', (self, e, request_pdu))
             LOGGER.error('handle_request failed: ' + str(e))
+            if metrics is not None:
+                metrics.observe_error(TRANSPORTS.get(type(query), 'unknown'))
         except:
             LOGGER.error('handle_request failed: unknown exception')
+        if metrics is not None:
+            function_code = request_pdu[0] if len(request_pdu) > 0 else None
+            metrics.observe_request(TRANSPORTS.get(type(query), 'unknown'), slave_id, function_code,
+                                    time.perf_counter() - start, exception)
+        return response
+
+    def handle_broadcast(self, request_pdu, slave_ids=None):
+        '''
+        Applies a broadcast request to every slave, or to the ones in
+        slave_ids, on the broadcast thread when there is one. Broadcasts never
+        get a response
+        '''
+        if self._broadcast_executor is None:
+            self._apply_broadcast(request_pdu, slave_ids)
+        else:
+            # the request may be a view on the transport's receive buffer
+            self._broadcast_executor.submit(self._apply_broadcast, bytes(request_pdu), slave_ids)
+
+    def _apply_broadcast(self, request_pdu, slave_ids=None):
+        try:
+            with self._lock:
+                # a broadcast reaches the declared slaves too
+                for slave_id in list(self._declared):
+                    if slave_ids is None or slave_id in slave_ids:
+                        self._materialize(slave_id)
+                slaves = [slave for (slave_id, slave) in self._slaves.items()
+                          if slave_ids is None or slave_id in slave_ids]
+            write = parse_broadcast(request_pdu)
+            if write is None:
+                for slave in slaves:
+                    slave.handle_request(request_pdu, broadcast=True)
+            else:
+                for slave in slaves:
+                    slave.apply_broadcast(write)
+        except Exception as e:
+            call_hooks('modbus.Databank.on_error', (self, e, request_pdu))
+            LOGGER.error('broadcast failed: ' + str(e))
 
 
 class ModbusRtuServer(RtuServer):
@@ -49,58 +342,128 @@ class ModbusRtuServer(RtuServer):
 
     def __init__(self, serial, databank=None):
         self._serial = serial
+        # ids of the slaves on this line, requests to other ones are left to
+        # the other devices of the bus. Every slave when None
+        self.slave_ids = None
         modbus.Server.__init__(self, databank if databank else ModbusDatabank())
         LOGGER.info('RtuServer alt %s is %s' % (self._serial.portstr,
                                                 'opened' if self._serial.isOpen() else 'closed'))
-        self._t0 = calculate_rtu_inter_char(self._serial.baudrate)
-        self._serial.interCharTimeout = 1.5 * self._t0
-        self._serial.timeout = 10*self._t0
-        LOGGER.info('interchar timeout = %f' % (self._serial.interCharTimeout,))
-        LOGGER.info('timeout = %f' % (self._serial.timeout,))
+        self._reader = RtuFrameReader(self._serial)
+        self._timeout = self._reader.timeout
+        LOGGER.info('silence = %f' % (self._reader.silence,))
+        LOGGER.info('timeout = %f' % (self._reader.timeout,))
+
+    def _do_run(self):
+        try:
+            try:
+                request = self._reader.read()
+            except serial.SerialException as e:
+                LOGGER.error('Error while reading request: %s' % (e, ))
+                self._serial.close()
+                self._serial.open()
+                return
+            if not request:
+                return
+            retval = call_hooks('modbus_rtu.RtuServer.after_read', (self, request))
+            if retval is not None:
+                request = retval
+
+            response = self._handle(request)
+
+            retval = call_hooks('modbus_rtu.RtuServer.before_write', (self, response))
+            if retval is not None:
+                response = retval
+            if response:
+                if self._serial.in_waiting > 0:
+                    # the master most likely timed out and sent its next request
+                    LOGGER.warning('Not sending response because there is new request pending')
+                else:
+                    self._serial.write(response)
+                    self._serial.flush()
+            call_hooks('modbus_rtu.RtuServer.after_write', (self, response))
+        except Exception as e:
+            LOGGER.error('Error while handling request, Exception occurred: %s' % (e, ))
+            call_hooks('modbus_rtu.RtuServer.on_error', (self, e))
 
     def _handle(self, request):
-        LOGGER.debug(self.get_log_buffer('-->', request))
+        verbose = self._verbose and LOGGER.isEnabledFor(logging.DEBUG)
+        if verbose:
+            LOGGER.debug(self.get_log_buffer('-->', request))
 
+        if self.slave_ids is not None and request and request[0] != 0 and request[0] not in self.slave_ids:
+            return None
         query = self._make_query()
         retval = call_hooks('modbus.Server.before_handle_request', (self, request))
         if retval:
             request = retval
-        response = self._databank.handle_request(query, request)
+        response = self._databank.handle_request(query, request, self.slave_ids)
         retval = call_hooks('modbus.Server.after_handle_request', (self, response))
         if retval:
             response = retval
-        if response:
+        if response and verbose:
             LOGGER.debug(self.get_log_buffer('<--', response))
         return response
 
     def get_log_buffer(self, prefix, buff):
-        log = prefix
-        for i in buff:
-            log += str(hex(i)) + ' '
-        return log[:-1]
+        return prefix + ' '.join(hex(i) for i in bytearray(buff))
+
+
+TCP_ENGINES = {
+    'select': TcpServer,
+    'asyncio': AsyncTcpServer,
+}
 
 
 class ModbusSim(Simulator):
     slaves = {}
 
-    def __init__(self, mode, port, baud=None, hostname=None, verbose=None):
+    def __init__(self, mode, port, baud=None, hostname=None, verbose=None,
+                 tcp_engine='select', register_store='list', response_cache=False, broadcast_thread=False,
+                 trace_size=0, metrics=None, workers=0, sharding='reuseport', shm_size=64, lines=None):
         self.rtu = None
         self.mode = mode
-        if self.mode == 'rtu' and baud and port:
+        # name -> SlaveTemplate new slaves can be made from
+        self.templates = {}
+        # slave_id -> PointMap of the typed points of the slave
+        self.point_maps = {}
+        if register_store not in REGISTER_STORES:
+            raise ModbusSimError('Unknown register store: %s' % (register_store))
+        if self.mode == 'tcp' and workers:
+            # imported here as the worker processes import this module
+            from .shared import RegisterFile
+            from .workers import SHARDINGS, SharedDatabank, WorkerPool
+            if sharding not in SHARDINGS:
+                raise ModbusSimError('Unknown sharding: %s' % (sharding))
+            databank = SharedDatabank(RegisterFile(size=shm_size * 1024 * 1024))
+        else:
+            databank = ModbusDatabank(slave_class=REGISTER_STORES[register_store],
+                                      response_cache=response_cache, broadcast_thread=broadcast_thread,
+                                      trace_size=trace_size, metrics=metrics)
+        if self.mode == 'rtu' and lines:
+            # imported here as it builds on this module
+            from .lines import RtuLines
+            Simulator.__init__(self, RtuLines(databank, lines, baud or 9600))
+            LOGGER.info('Initializing modbus %s simulator: %d lines' % (self.mode, len(lines)))
+        elif self.mode == 'rtu' and baud and port:
             self.rtu = serial.Serial(port=port, baudrate=baud)
-            Simulator.__init__(self, ModbusRtuServer(self.rtu))
-            # timeout is too fast for 19200 so increase a little bit
-            self.server._serial.timeout *= 2
-            self.server._serial.interCharTimeout *= 2
+            Simulator.__init__(self, ModbusRtuServer(self.rtu, databank))
             LOGGER.info('Initializing modbus %s simulator: baud = %d port = %s parity = %s' % (self.mode, baud, port, self.rtu.parity))
             LOGGER.info('stop bits = %d xonxoff = %d' % (self.rtu.stopbits, self.rtu.xonxoff))
+        elif self.mode == 'tcp' and hostname and port and workers:
+            Simulator.__init__(self, WorkerPool(hostname, port, databank, workers, sharding))
+            LOGGER.info('Initializing modbus %s simulator: addr = %s port = %s workers = %d sharding = %s' %
+                        (self.mode, hostname, port, workers, sharding))
         elif self.mode == 'tcp' and hostname and port:
-            Simulator.__init__(self, TcpServer(address=hostname, port=port))
-            LOGGER.info('Initializing modbus %s simulator: addr = %s port = %s' % (self.mode, hostname, port))
+            if tcp_engine not in TCP_ENGINES:
+                raise ModbusSimError('Unknown tcp engine: %s' % (tcp_engine))
+            Simulator.__init__(self, TCP_ENGINES[tcp_engine](address=hostname, port=port,
+                                                             databank=databank))
+            LOGGER.info('Initializing modbus %s simulator: addr = %s port = %s engine = %s' %
+                        (self.mode, hostname, port, tcp_engine))
         else:
             raise ModbusSimError('Unknown mode: %s' % (mode))
 
-        self.server.set_verbose(True)
+        self.server.set_verbose(bool(verbose))
 
     def start(self):
         self.server.start()
@@ -111,90 +474,600 @@ class ModbusSim(Simulator):
     def close(self):
         self.rpc.close()
         self.server.stop()
+        close = getattr(self.server, 'close', None)
+        if close is not None:
+            close()
+        self.server.get_db().close()
 
-    def add_slave(self, slave_id, input_register_count, holding_register_count):
-        if slave_id in self.slaves:
+    @contextmanager
+    def locked_slaves(self, slave_ids):
+        '''
+        Holds the data lock of every given slave, so Modbus requests are
+        served either before or after everything done in the block
+        '''
+        with ExitStack() as stack:
+            # always lock in the same order so two callers cannot deadlock
+            for slave_id in sorted(set(slave_ids)):
+                stack.enter_context(self.server.get_slave(slave_id).data_lock)
+            yield
+
+    def add_slave(self, slave_id, input_register_count, holding_register_count, coil_count=0,
+                  discrete_input_count=0, segments=None):
+        '''
+        Adds a slave with dense blocks of the given sizes at the standard
+        addresses, and the blocks of a sparse register map given as segments
+        (see parse_segments). Addresses in no block answer with an illegal
+        data address exception
+        '''
+        if slave_id in self.slaves or self.server.get_db().is_declared(slave_id):
             raise ModbusSimError('Slave with slaveID: %s already exists...' % (slave_id, ))
+        parsed = parse_segments(segments or [])
 
-        LOGGER.info('Generating slave with slave_id: %d having %d input registers and %d holding registers' %
-                    (slave_id, input_register_count, holding_register_count))
+        LOGGER.info('Generating slave with slave_id: %d having %d input registers, %d holding registers, '
+                    '%d coils, %d discrete inputs and %d segments' %
+                    (slave_id, input_register_count, holding_register_count, coil_count, discrete_input_count,
+                     len(parsed)))
 
         slave = self.server.add_slave(slave_id)
-        self.slaves.update({slave_id:
-                            {'input_register_count': input_register_count,
-                             'holding_register_count': holding_register_count}})
-        if input_register_count > 0:
-            slave.add_block('input_registers', 4,
-                            30001, input_register_count)
-        if holding_register_count > 0:
-            slave.add_block('holding_registers', 3,
-                            40001, holding_register_count)
+        counts = {'input_register_count': input_register_count,
+                  'holding_register_count': holding_register_count,
+                  'coil_count': coil_count,
+                  'discrete_input_count': discrete_input_count}
+        self.slaves.update({slave_id: counts})
+        try:
+            self._add_blocks(slave, counts, parsed)
+        except Exception:
+            self.server.remove_slave(slave_id)
+            del self.slaves[slave_id]
+            raise
+
+    def _add_blocks(self, slave, counts, segments):
+        '''
+        Adds the dense blocks of counts and the blocks of parsed segments to
+        a slave without blocks
+        '''
+        for block_type, (name, address, count_key) in BLOCKS.items():
+            if counts[count_key] > 0:
+                slave.add_block(name, block_type, address, counts[count_key])
+        self._add_segments(slave, counts, segments)
+
+    def _add_segments(self, slave, counts, segments):
+        '''
+        Adds the blocks of parsed segments to a slave and lists them in its
+        entry of self.slaves
+        '''
+        if not segments:
+            return
+        counts['segments'] = []
+        for (block_type, address, count) in segments:
+            try:
+                slave.add_block(segment_name(block_type, address), block_type, address, count)
+            except (DuplicatedKeyError, OverlapModbusBlockError) as e:
+                raise ModbusSimError('Segment %s %d count %d: %s' % (BLOCKS[block_type][0], address, count, e))
+            counts['segments'].append({'type': BLOCKS[block_type][0], 'address': address, 'count': count})
+
+    def add_playback(self, name, path, mappings, speed=1.0, loop=False, record_format=None, columns=None):
+        '''
+        Plays a CSV recording, or a binary one of records packed with
+        record_format, into registers. Every mapping gives the slave_id,
+        address, column and struct format of a register value
+        '''
+        playback = Playback(path, speed, loop, record_format, columns)
+        registers = []
+        try:
+            for mapping in mappings:
+                try:
+                    (slave_id, address, column) = (mapping['slave_id'], mapping['address'], mapping['column'])
+                except (KeyError, TypeError):
+                    raise PlaybackError('Mappings need a slave_id, an address and a column')
+                if not self.has_slave(slave_id):
+                    raise PlaybackError('Slave %s does not exist' % (slave_id, ))
+                fmt = mapping.get('format', '>H')
+                for word in range(register_count(fmt)):
+                    registers.append((slave_id, address + word, PlaybackRegister(name, playback, column, fmt, word)))
+            self.server.get_db().add_playback(name, playback)
+        except Exception:
+            playback.close()
+            raise
+        try:
+            for (slave_id, address, generator) in registers:
+                self.server.get_slave(slave_id).set_generator(address, generator)
+        except Exception:
+            self.server.get_db().remove_playback(name)
+            raise
+        LOGGER.info('Playing %s into %d registers as %s' % (path, len(registers), name))
+
+    def remove_playback(self, name):
+        self.server.get_db().remove_playback(name)
+
+    def get_playbacks(self):
+        '''
+        Returns the playbacks by name, with their current playback time
+        '''
+        playbacks = {}
+        now = time.monotonic()
+        for (name, playback) in list(self.server.get_db().playbacks.items()):
+            spec = playback.get_spec()
+            del spec['started']
+            spec.update({
+                'start_time': playback.recording.start_time,
+                'end_time': playback.recording.end_time,
+                'time': playback.playback_time(now),
+            })
+            playbacks[name] = spec
+        return playbacks
 
     def dump_simulator(self):
-        if not self.slaves:
-            return ""
-        toReturn = "["
-        for slave in self.slaves:
-            if not toReturn.endswith('['):
-                toReturn += ","
-            toReturn += self.dump_slave(slave)
-        toReturn += "]"
-        return toReturn
+        return ''.join(self.iter_dump_simulator())
+
+    def iter_dump_simulator(self):
+        '''
+        Yields the JSON dump of all slaves in chunks, one slave at a time.
+        The slaves declared but not made yet are dumped as their slave_id
+        and declared layout
+        '''
+        separator = '['
+        for slave_id in list(self.slaves):
+            if slave_id not in self.slaves:
+                continue
+            yield separator
+            separator = ','
+            for chunk in self.iter_dump_slave(slave_id):
+                yield chunk
+        for (slave_id, entry) in sorted(self.server.get_db().get_declared_entries().items()):
+            if entry is not None:
+                yield '%s{"slave_id":%d,"declared":%s}' % (separator, slave_id, json.dumps(entry))
+                separator = ','
+        if separator == ',':
+            yield ']'
 
     def load_simulator_dump(self, dump):
+        self.remove_slaves(self.server.get_db().get_declared())
         for slave in self.slaves:
             self.server.remove_slave(slave)
         self.slaves = {}
+        self.point_maps = {}
+        declared = {}
         for slave in dump:
-            self.load_slave_dump(slave)
+            if 'declared' in slave:
+                declared[slave['slave_id']] = slave['declared']
+            else:
+                self.load_slave_dump(slave)
+        self.declare_entries(declared)
 
     def dump_slave(self, slave_id):
         if slave_id not in self.slaves:
             return 'Specified slave with slave_id %d does not exist.' % (slave_id,)
+        return ''.join(self.iter_dump_slave(slave_id))
+
+    def iter_dump_slave(self, slave_id):
+        '''
+        Yields the JSON dump of a slave in chunks, one block at a time
+        '''
         slave = self.server.get_slave(slave_id)
-        input_register_count = self.slaves[slave_id]['input_register_count']
-        holding_register_count = self.slaves[slave_id]['holding_register_count']
-        input_registers = []
-        holding_registers = []
-        if input_register_count > 0:
-            input_registers = slave.get_values('input_registers', 30001,
-                                               input_register_count)
-        if holding_register_count > 0:
-            holding_registers = slave.get_values('holding_registers', 40001,
-                                                 holding_register_count)
-        toReturn = '{"slave_id":' + str(slave_id)
-        toReturn += ',"input_register_count":'+str(input_register_count)
-        toReturn += ',"input_registers":'+str(list(input_registers))
-        toReturn += ',"holding_register_count":'+str(holding_register_count)
-        toReturn += ',"holding_registers":'+str(list(holding_registers))
-        toReturn += '}'
-        return toReturn
+        counts = self.slaves[slave_id]
+        separator = '{"slave_id":%d,' % (slave_id, )
+        for block_type, (name, address, count_key) in BLOCKS.items():
+            count = counts.get(count_key, 0)
+            yield '%s"%s":%d,"%s":' % (separator, count_key, count, name)
+            separator = ','
+            if count > 0:
+                yield json.dumps(self._get_dump_values(slave, block_type, name, address, count))
+            else:
+                yield '[]'
+        separator = ',"segments":['
+        for segment in counts.get('segments', []):
+            block_type = BLOCK_TYPES[segment['type']]
+            yield '%s{"type":"%s","address":%d,"count":%d,"values":' % \
+                (separator, segment['type'], segment['address'], segment['count'])
+            separator = ','
+            yield json.dumps(self._get_dump_values(slave, block_type, segment_name(block_type, segment['address']),
+                                                   segment['address'], segment['count']))
+            yield '}'
+        if separator == ',':
+            yield ']'
+        point_map = self.point_maps.get(slave_id)
+        if point_map is not None:
+            yield ',"points":%s' % (json.dumps(point_map.get_specs()), )
+        yield '}'
 
     def load_slave_dump(self, dump):
+        '''
+        Replaces or adds the slave of a dump, or the slave declared with its
+        id. Dumps without coils, discrete inputs, segments or points, as older
+        ones, give the slave none. An invalid dump leaves the slave as it was
+        '''
         slave_id = dump['slave_id']
-        input_register_count = dump['input_register_count']
-        input_registers = dump['input_registers']
-        holding_register_count = dump['holding_register_count']
-        holding_registers = dump['holding_registers']
-        slave = None
-        if dump['slave_id'] in self.slaves:
-            slave = self.server.get_slave(slave_id)
-            if self.slaves[slave_id]['input_register_count'] > 0:
-                slave.remove_block('input_registers')
-            if self.slaves[slave_id]['holding_register_count'] > 0:
-                slave.remove_block('holding_registers')
+        parse_segments(dump.get('segments', []))
+        point_map = PointMap(dump['points']) if 'points' in dump else None
+        slave = self.server.get_slave(slave_id) if slave_id in self.slaves else None
+        # the values are converted on a scratch slave outside of the databank
+        # first, so they raise before the slave is touched
+        self._fill_slave(ArraySlave(0, True if slave is None else slave.unsigned), dump)
+        if slave is not None:
+            slave.remove_all_blocks()
         else:
+            self.server.get_db().undeclare_slave(slave_id)
             slave = self.server.add_slave(slave_id)
+        self.slaves.update({slave_id: self._fill_slave(slave, dump)})
+        if point_map is None:
+            self.point_maps.pop(slave_id, None)
+        else:
+            self.point_maps[slave_id] = point_map
+
+    def _fill_slave(self, slave, dump):
+        '''
+        Adds the blocks of a slave dump to a slave without blocks. Returns
+        the entry of the slave in self.slaves
+        '''
+        counts = {}
+        for block_type, (name, address, count_key) in BLOCKS.items():
+            count = dump.get(count_key, 0)
+            counts[count_key] = count
+            if count > 0:
+                slave.add_block(name, block_type, address, count)
+                self._set_dump_values(slave, block_type, name, address, dump[name])
+        segments = dump.get('segments', [])
+        parsed = parse_segments(segments)
+        self._add_segments(slave, counts, parsed)
+        for ((block_type, address, count), segment) in zip(parsed, segments):
+            if 'values' in segment:
+                self._set_dump_values(slave, block_type, segment_name(block_type, address), address,
+                                      segment['values'])
+        return counts
+
+    def _get_dump_values(self, slave, block_type, block_name, address, count):
+        # registers are converted from their image in one go
+        if block_type in BIT_BLOCKS:
+            return slave.get_values(block_name, address, count)
+        return bytes_to_registers(slave.get_bytes(block_name, address, count), not slave.unsigned)
+
+    def _set_dump_values(self, slave, block_type, block_name, address, values):
+        if block_type in BIT_BLOCKS:
+            slave.set_values(block_name, address, values)
+        else:
+            slave.set_bytes(block_name, address, registers_to_bytes(values, not slave.unsigned))
+
+    def add_template(self, name, dump):
+        '''
+        Adds a named slave template with the layout and register values of a
+        slave dump, whose slave_id is ignored
+        '''
+        if name in self.templates:
+            raise TemplateError('Template %s already exists' % (name, ))
+        # the image is taken from a scratch slave outside of the databank
+        slave = ArraySlave(0)
+        try:
+            counts = self._fill_slave(slave, dump)
+        except (KeyError, TypeError, ValueError, ModbusSimError) as e:
+            raise TemplateError('Invalid template %s: %s' % (name, e))
+        self.templates[name] = SlaveTemplate(name, slave, counts)
+        LOGGER.info('Added template %s' % (name, ))
+
+    def remove_template(self, name):
+        '''
+        Removes a template. Slaves made from it keep sharing its image
+        '''
+        if self.templates.pop(name, None) is None:
+            raise TemplateError('Template %s does not exist' % (name, ))
+
+    def get_templates(self):
+        return dict((name, template.get_info()) for (name, template) in self.templates.items())
+
+    def add_slave_from_template(self, slave_id, name):
+        '''
+        Adds a slave with the layout and register values of a template. Its
+        register blocks share the pages of the template image until written
+        '''
+        if slave_id in self.slaves or self.server.get_db().is_declared(slave_id):
+            raise ModbusSimError('Slave with slaveID: %s already exists...' % (slave_id, ))
+        template = self.templates.get(name)
+        if template is None:
+            raise TemplateError('Template %s does not exist' % (name, ))
+        self._add_template_slave(slave_id, template)
+
+    def _add_template_slave(self, slave_id, template):
+        slave = self.server.add_slave(slave_id)
+        for template_block in template.blocks:
+            slave.add_template_block(template_block)
+        counts = dict(template.counts, template=template.name)
+        if 'segments' in counts:
+            counts['segments'] = [dict(segment) for segment in counts['segments']]
+        self.slaves.update({slave_id: counts})
+
+    def declare_slaves(self, slave_ids, layout):
+        '''
+        Declares slaves which are only made when a Modbus or REST request
+        first reaches them. layout holds the counts and segments add_slave
+        takes, or the name of a template
+        '''
+        slave_ids = sorted(slave_ids)
+        for slave_id in slave_ids:
+            if not isinstance(slave_id, int) or not 0 < slave_id <= MAX_SLAVE_ID:
+                raise ModbusSimError('Invalid slave id %s' % (slave_id, ))
+            if slave_id in self.slaves or self.server.get_db().is_declared(slave_id):
+                raise ModbusSimError('Slave with slaveID: %s already exists...' % (slave_id, ))
+        if 'template' in layout:
+            template = self.templates.get(layout['template'])
+            if template is None:
+                raise TemplateError('Template %s does not exist' % (layout['template'], ))
+            materialize = partial(self._add_template_slave, template=template)
+            entry = dict(template.counts, template=template.name)
+        else:
+            entry = dict((count_key, layout.get(count_key, 0)) for (name, address, count_key) in BLOCKS.values())
+            if not all(isinstance(count, int) and count >= 0 for count in entry.values()):
+                raise ModbusSimError('Counts must be zero or positive integers')
+            # the layout is built once on a scratch slave outside of the
+            # databank, so a bad one fails here rather than on the first request
+            self._add_blocks(ArraySlave(0), entry, parse_segments(layout.get('segments') or []))
+            materialize = partial(self.add_slave, input_register_count=entry['input_register_count'],
+                                  holding_register_count=entry['holding_register_count'],
+                                  coil_count=entry['coil_count'],
+                                  discrete_input_count=entry['discrete_input_count'],
+                                  segments=layout.get('segments'))
+        databank = self.server.get_db()
+        for slave_id in slave_ids:
+            databank.declare_slave(slave_id, materialize, entry)
+        LOGGER.info('Declared %d slaves' % (len(slave_ids), ))
+
+    def declare_entries(self, entries):
+        '''
+        Declares again the slaves of entries, the layouts of declared slaves
+        by slave id as returned by get_declared_entries. Slaves which already
+        exist or cannot be declared are logged and left out
+        '''
+        # slave ids of the same layout are declared together
+        layouts = {}
+        for (slave_id, entry) in entries.items():
+            if not isinstance(entry, dict) or int(slave_id) in self.slaves:
+                continue
+            layout = {'template': entry['template']} if 'template' in entry else entry
+            (layout, slave_ids) = layouts.setdefault(json.dumps(layout, sort_keys=True), (layout, []))
+            slave_ids.append(int(slave_id))
+        for (layout, slave_ids) in layouts.values():
+            try:
+                self.declare_slaves(slave_ids, layout)
+            except (ModbusSimError, TemplateError) as e:
+                LOGGER.warning('Cannot declare slaves %s again: %s' % (slave_ids, e))
+
+    def has_slave(self, slave_id):
+        '''
+        Returns True if the slave exists, making it first if it was declared
+        '''
+        if slave_id in self.slaves:
+            return True
+        try:
+            self.server.get_slave(slave_id)
+        except MissingKeyError:
+            return False
+        return slave_id in self.slaves
+
+    def remove_slaves(self, slave_ids):
+        '''
+        Removes slaves, made or only declared. Returns how many there were
+        '''
+        databank = self.server.get_db()
+        removed = 0
+        for slave_id in slave_ids:
+            if databank.undeclare_slave(slave_id):
+                removed += 1
+            elif slave_id in self.slaves:
+                self.server.remove_slave(slave_id)
+                del self.slaves[slave_id]
+                removed += 1
+            self.point_maps.pop(slave_id, None)
+        return removed
+
+    def set_points(self, slave_id, specs):
+        '''
+        Replaces the typed points of a slave with the ones of specs, a list
+        of {name, address, format, scale, byte_order, word_order}
+        '''
+        if not self.has_slave(slave_id):
+            raise PointError('Slave %s does not exist' % (slave_id, ))
+        self.point_maps[slave_id] = PointMap(specs)
+
+    def get_points(self, slave_id):
+        point_map = self.point_maps.get(slave_id)
+        return [] if point_map is None else point_map.get_specs()
+
+    def _get_point_map(self, slave_id):
+        point_map = self.point_maps.get(slave_id)
+        if point_map is None or not self.has_slave(slave_id):
+            raise PointError('Slave %s has no points' % (slave_id, ))
+        return point_map
+
+    def read_points(self, slave_id, names=None):
+        '''
+        Returns name -> value of the named points of a slave, of all of them
+        by default
+        '''
+        return self._get_point_map(slave_id).read(self.server.get_slave(slave_id), names)
+
+    def write_points(self, slave_id, values):
+        '''
+        Writes name -> value to the points of a slave, all or none of them
+        '''
+        self._get_point_map(slave_id).write(self.server.get_slave(slave_id), values)
+
+    def iter_change_blocks(self, changes):
+        '''
+        Splits the (slave_id, block_type, address, count) changes of a
+        Subscription at block boundaries. Yields (slave_id, slave,
+        block_type, block_name, address, count) for the parts still there
+        '''
+        for (slave_id, block_type, address, count) in changes:
+            try:
+                slave = self.server.get_slave(slave_id)
+            except MissingKeyError:
+                continue
+            end = address + count
+            while address < end:
+                with slave.data_lock:
+                    route = slave.route(address, 1, block_type)
+                    if route is not None:
+                        (block_name, offset) = route
+                        count = min(end - address, slave.get_block(block_name).size - offset)
+                if route is None:
+                    # the block was removed since the write
+                    address += 1
+                    continue
+                yield (slave_id, slave, block_type, block_name, address, count)
+                address += count
+
+    def get_change_events(self, changes):
+        '''
+        Returns the events of the (slave_id, block_type, address, count)
+        changes of a Subscription, one per block with the current values
+        '''
+        events = []
+        for (slave_id, slave, block_type, block_name, address, count) in self.iter_change_blocks(changes):
+            try:
+                values = list(slave.get_values(block_name, address, count))
+            except (MissingKeyError, OutOfModbusBlockError):
+                # the block was removed or replaced meanwhile
+                continue
+            events.append({'slave_id': slave_id, 'type': BLOCKS[block_type][0], 'address': address,
+                           'count': count, 'values': values})
+        return events
+
+    def get_slaves(self):
+        '''
+        Returns the entries of the slaves by slave id, including the declared
+        ones with the layout they will be made with
+        '''
+        slaves = dict((slave_id, dict(entry, declared=True))
+                      for (slave_id, entry) in self.server.get_db().get_declared_entries().items()
+                      if entry is not None)
+        slaves.update(self.slaves)
+        return slaves
+
+    def get_provisioning(self):
+        '''
+        Returns the ids of the slaves made and of the ones only declared
+        '''
+        return {'materialized': sorted(self.slaves), 'declared': self.server.get_db().get_declared()}
+
+    def write_snapshot(self, stream, slave_ids=None, declared=True):
+        '''
+        Writes a binary snapshot of the given slaves, all of them by default
+        along with the layouts of the declared slaves unless declared is False
+        '''
+        slaves = []
+        slave_ids = None if slave_ids is None else set(slave_ids)
+        # slaves may be removed meanwhile, the ones gone are left out
+        for (slave_id, counts) in sorted(list(self.slaves.items())):
+            if slave_ids is not None and slave_id not in slave_ids:
+                continue
+            try:
+                slave = self.server.get_slave(slave_id)
+            except MissingKeyError:
+                continue
+            blocks = []
+            layout = [(block_type, name, address, counts.get(count_key, 0))
+                      for block_type, (name, address, count_key) in BLOCKS.items()]
+            for segment in counts.get('segments', []):
+                block_type = BLOCK_TYPES[segment['type']]
+                layout.append((block_type, segment_name(block_type, segment['address']), segment['address'],
+                               segment['count']))
+            for (block_type, name, address, count) in layout:
+                if count > 0:
+                    blocks.append((block_type, address, count, image_length(block_type, count),
+                                   lambda slave=slave, name=name, address=address, count=count:
+                                   slave.get_bytes(name, address, count)))
+            slaves.append((slave_id, blocks))
+        entries = None
+        if slave_ids is None and declared:
+            entries = dict((slave_id, entry) for (slave_id, entry) in
+                           self.server.get_db().get_declared_entries().items() if entry is not None)
+        write_snapshot(stream, slaves, entries)
+
+    def save_snapshot(self, path):
+        '''
+        Writes a binary snapshot of all slaves to path
+        '''
+        with open(path + '.tmp', 'wb') as f:
+            self.write_snapshot(f)
+        os.replace(path + '.tmp', path)
+        LOGGER.info('Saved snapshot of %d slaves to %s' % (len(self.slaves), path))
+
+    def load_snapshot(self, buff, incremental=False):
+        '''
+        Replaces all slaves with the ones of a binary snapshot, and declares
+        its declared slaves, or only replaces the slaves it holds when
+        incremental
+        '''
+        declared = {} if incremental else read_declared(buff)
+        snapshot = read_snapshot(buff)
+        try:
+            self._check_snapshot(snapshot)
+            if incremental:
+                for (slave_id, blocks) in snapshot:
+                    if slave_id in self.slaves:
+                        self.server.remove_slave(slave_id)
+                        del self.slaves[slave_id]
+                    self.server.get_db().undeclare_slave(slave_id)
+            else:
+                self.remove_slaves(self.server.get_db().get_declared())
+                for slave_id in self.slaves:
+                    self.server.remove_slave(slave_id)
+                self.slaves = {}
+            for (slave_id, blocks) in snapshot:
+                slave = self.server.add_slave(slave_id)
+                counts = dict((count_key, 0) for (name, address, count_key) in BLOCKS.values())
+                segments = []
+                for (block_type, address, count, image) in blocks:
+                    (name, standard_address, count_key) = BLOCKS[block_type]
+                    if address == standard_address and counts[count_key] == 0:
+                        counts[count_key] = count
+                    else:
+                        # any other block was a segment of a sparse map
+                        name = segment_name(block_type, address)
+                        segments.append({'type': BLOCKS[block_type][0], 'address': address, 'count': count})
+                    slave.add_block(name, block_type, address, count)
+                    slave.set_bytes(name, address, image, count)
+                if segments:
+                    counts['segments'] = segments
+                self.slaves[slave_id] = counts
+            # snapshots hold no points, the ones of slaves still there stay
+            self.point_maps = dict((slave_id, point_map) for (slave_id, point_map) in self.point_maps.items()
+                                   if slave_id in self.slaves)
+            self.declare_entries(declared)
+        finally:
+            # the images are views on buff, which may be an mmap about to be closed
+            release_snapshot(snapshot)
+
+    def _check_snapshot(self, snapshot):
+        '''
+        Raises SnapshotError unless every slave of a parsed snapshot can be
+        made, so that a bad snapshot leaves the current slaves alone
+        '''
+        slave_ids = set()
+        for (slave_id, blocks) in snapshot:
+            if not 0 < slave_id <= MAX_SLAVE_ID:
+                raise SnapshotError('Invalid slave id %d in snapshot' % (slave_id,))
+            if slave_id in slave_ids:
+                raise SnapshotError('Slave %d is in snapshot twice' % (slave_id,))
+            slave_ids.add(slave_id)
+            ranges = []
+            for (block_type, address, count, image) in blocks:
+                if block_type not in BLOCKS:
+                    raise SnapshotError('Unsupported block type %d in snapshot' % (block_type,))
+                if count <= 0 or address + count > ADDRESS_SPACE or len(image) != image_length(block_type, count):
+                    raise SnapshotError('Invalid %s block at %d of slave %d in snapshot' %
+                                        (BLOCKS[block_type][0], address, slave_id))
+                ranges.append((block_type, address, address + count))
+            ranges.sort()
+            for ((block_type, address, end), (next_type, next_address, next_end)) in zip(ranges, ranges[1:]):
+                if block_type == next_type and next_address < end:
+                    raise SnapshotError('%s blocks at %d and %d of slave %d overlap in snapshot' %
+                                        (BLOCKS[block_type][0], address, next_address, slave_id))
 
-        if input_register_count > 0:
-            slave.add_block('input_registers',
-                            4, 30001, input_register_count)
-            slave.set_values('input_registers', 30001, input_registers)
-        if holding_register_count > 0:
-            slave.add_block('holding_registers',
-                            3, 40001, holding_register_count)
-            slave.set_values('holding_registers', 40001, holding_registers)
-
-        self.slaves.update({slave_id:
-                            {'input_register_count': input_register_count,
-                             'holding_register_count': holding_register_count}})
+    def load_snapshot_file(self, path, incremental=False):
+        '''
+        Restores a snapshot written by save_snapshot through mmap
+        '''
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                self.load_snapshot(mapped, incremental)
+        LOGGER.info('Loaded snapshot of %d slaves from %s' % (len(self.slaves), path))
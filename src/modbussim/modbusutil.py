@@ -1,7 +1,36 @@
+'''
+Conversions between numbers and 16 bit registers
+
+number_to_bytes and bytes_to_number convert a single register. The bulk
+counterparts convert whole sequences to and from register images, the
+big endian bytes of consecutive registers, in one call: with NumPy when it
+is installed, with array otherwise.
+'''
 import struct
+import sys
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 BYTES_PER_REGISTER = 2
 
+# registers travel big endian, array holds them in native order
+SWAP_BYTES = sys.byteorder == 'little'
+
+# signed -> (typecode, lowest, highest) of a register value
+REGISTER_RANGES = {
+    False: ('H', 0, 0xffff),
+    True: ('h', -0x8000, 0x7fff),
+}
+
+
+class ConversionError(ValueError):
+    pass
+
 
 def number_to_byte(number):
     return chr(number)
@@ -24,8 +53,8 @@ def number_to_bytes(number, number_decimals=0,
 
     try:
         bytestring = struct.pack(format_code, integer)
-    except Exception as e:
-        print(str(e))
+    except struct.error as e:
+        raise ConversionError('Cannot convert %s to a register: %s' % (number, e))
     return bytestring
 
 
@@ -42,8 +71,8 @@ def bytes_to_number(bytestring, number_decimals=0, signed=False):
 
     try:
         number = struct.unpack(format_code, bytestring)[0]
-    except Exception as e:
-        print(str(e))
+    except struct.error as e:
+        raise ConversionError('Cannot convert %r to a number: %s' % (bytestring, e))
 
     if number_decimals == 0:
         return number
@@ -51,6 +80,85 @@ def bytes_to_number(bytestring, number_decimals=0, signed=False):
     return number / float(factor)
 
 
+def registers_to_bytes(values, signed=False, little_endian=False):
+    '''
+    Returns the register image of a sequence of integer register values.
+    Raises ConversionError for values which are not integers or are out of
+    the range of a register
+    '''
+    (typecode, lowest, highest) = REGISTER_RANGES[signed]
+    if numpy is not None:
+        values = numpy.asarray(values)
+        if values.size == 0:
+            return b''
+        if values.ndim != 1 or values.dtype.kind not in 'biu':
+            raise ConversionError('Register values must be integers')
+        if values.min() < lowest or values.max() > highest:
+            raise ConversionError('Register values must be between %d and %d' % (lowest, highest))
+        return values.astype(('<' if little_endian else '>') + ('i2' if signed else 'u2')).tobytes()
+    try:
+        registers = array(typecode, values)
+    except TypeError:
+        raise ConversionError('Register values must be integers')
+    except OverflowError:
+        raise ConversionError('Register values must be between %d and %d' % (lowest, highest))
+    if SWAP_BYTES != little_endian:
+        registers.byteswap()
+    return registers.tobytes()
+
+
+def bytes_to_registers(bytestring, signed=False):
+    '''
+    Returns the list of register values of a big endian register image
+    '''
+    if len(bytestring) % BYTES_PER_REGISTER:
+        raise ConversionError('Register images hold an even number of bytes')
+    if numpy is not None:
+        return numpy.frombuffer(bytestring, dtype='>i2' if signed else '>u2').tolist()
+    registers = array(REGISTER_RANGES[signed][0])
+    registers.frombytes(bytestring)
+    if SWAP_BYTES:
+        registers.byteswap()
+    return registers.tolist()
+
+
+def numbers_to_bytes(numbers, number_decimals=0, little_endian=False, signed=False):
+    '''
+    Returns the register image of a sequence of numbers, each one converted
+    as number_to_bytes does
+    '''
+    factor = 10 ** number_decimals
+    if numpy is not None:
+        try:
+            scaled = numpy.trunc(numpy.asarray(numbers, dtype=numpy.float64) * factor)
+        except (TypeError, ValueError) as e:
+            raise ConversionError('Cannot convert numbers to registers: %s' % (e, ))
+        (typecode, lowest, highest) = REGISTER_RANGES[signed]
+        if scaled.size and not (lowest <= scaled.min() and scaled.max() <= highest):
+            raise ConversionError('Scaled numbers must be between %d and %d' % (lowest, highest))
+        return registers_to_bytes(scaled.astype(numpy.int64), signed, little_endian)
+    try:
+        scaled = [int(float(number) * factor) for number in numbers]
+    except (TypeError, ValueError, OverflowError) as e:
+        raise ConversionError('Cannot convert numbers to registers: %s' % (e, ))
+    return registers_to_bytes(scaled, signed, little_endian)
+
+
+def bytes_to_numbers(bytestring, number_decimals=0, signed=False):
+    '''
+    Returns the numbers of a big endian register image, each one converted
+    as bytes_to_number does
+    '''
+    if number_decimals == 0:
+        return bytes_to_registers(bytestring, signed)
+    factor = float(10 ** number_decimals)
+    if numpy is not None:
+        if len(bytestring) % BYTES_PER_REGISTER:
+            raise ConversionError('Register images hold an even number of bytes')
+        return (numpy.frombuffer(bytestring, dtype='>i2' if signed else '>u2') / factor).tolist()
+    return [register / factor for register in bytes_to_registers(bytestring, signed)]
+
+
 def string_to_bytestring(inputstring, number_registers=16):
     max_chars = BYTES_PER_REGISTER * number_registers
     bytestring = inputstring.ljust(max_chars)
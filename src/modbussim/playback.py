@@ -0,0 +1,330 @@
+# -*- coding: utf_8 -*-
+'''
+Playback of recorded register values
+
+A recording is a CSV file whose header names its columns, or a binary file
+of fixed size records described by a struct format. The first column is
+the time of the row in seconds. Recordings are memory mapped and read a row
+at a time, so a multi-gigabyte recording plays without being loaded.
+Recordings whose first or last row hold a value that is not finite are
+rejected when opened; further in, such a value keeps its registers at 0
+while its row is in effect.
+
+A Playback plays a recording from the time it is started at, speed times
+faster than it was recorded and over and over when looping. Its columns are
+mapped to registers by PlaybackRegister generators, so a register only
+looks up the current row when it is read.
+'''
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .generators import Generator
+
+
+# rows stepped over before seeking instead, when playback jumps ahead
+SEEK_AFTER = 64
+
+
+class PlaybackError(Exception):
+    pass
+
+
+class Recording(object):
+    '''
+    Base of the memory mapped recordings. rows(t) yields the (time, values)
+    of the rows from the one in effect at time t on
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.close()
+            raise PlaybackError('Recording %s is empty' % (path, ))
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.columns = []
+
+    def rows(self, t):
+        raise NotImplementedError()
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+class CsvRecording(Recording):
+    '''
+    CSV recording: a header row naming the columns, then one row of numbers
+    per sample sorted by the time in the first column
+    '''
+
+    def __init__(self, path):
+        Recording.__init__(self, path)
+        header_end = self._line_end(0)
+        self.columns = [name.strip() for name in self._mm[:header_end].decode().split(',')[1:]]
+        self._size = len(self._mm)
+        self._data = self._skip_blank(header_end + 1)
+        if self._data >= self._size:
+            raise PlaybackError('Recording %s has no rows' % (path, ))
+        self.start_time = self._row(self._data)[0]
+        self.end_time = self._row(self._last_line())[0]
+
+    def _line_end(self, pos):
+        end = self._mm.find(b'\n', pos)
+        return len(self._mm) if end < 0 else end
+
+    def _skip_blank(self, pos):
+        while pos < self._size and self._mm[pos:pos + 1] in (b'\n', b'\r'):
+            pos += 1
+        return pos
+
+    def _last_line(self):
+        end = self._size
+        while end > self._data and self._mm[end - 1:end] in (b'\n', b'\r'):
+            end -= 1
+        return self._mm.rfind(b'\n', self._data, end) + 1 or self._data
+
+    def _parse(self, pos):
+        line = self._mm[pos:self._line_end(pos)]
+        try:
+            fields = [float(field) for field in line.split(b',')]
+        except ValueError:
+            raise PlaybackError('Recording %s has an invalid row at byte %d' % (self.path, pos))
+        if len(fields) != len(self.columns) + 1:
+            raise PlaybackError('Recording %s has a row of %d fields at byte %d' % (self.path, len(fields), pos))
+        if not math.isfinite(fields[0]):
+            raise PlaybackError('Recording %s has a time that is not finite at byte %d' % (self.path, pos))
+        return (fields[0], fields[1:])
+
+    def _row(self, pos):
+        row = self._parse(pos)
+        if not all(math.isfinite(value) for value in row[1]):
+            raise PlaybackError('Recording %s has a value that is not finite at byte %d' % (self.path, pos))
+        return row
+
+    def _seek(self, t):
+        # bisects the byte offsets for the last row at or before t
+        (lo, hi) = (self._data, self._size)
+        while True:
+            row = self._skip_blank(self._line_end((lo + hi) // 2) + 1)
+            if row >= hi:
+                break
+            if self._parse(row)[0] <= t:
+                lo = row
+            else:
+                hi = row
+        # the rows between lo and the middle were skipped, step through them
+        while True:
+            row = self._skip_blank(self._line_end(lo) + 1)
+            if row >= hi or self._parse(row)[0] > t:
+                return lo
+            lo = row
+
+    def rows(self, t):
+        pos = self._seek(t)
+        while pos < self._size:
+            yield self._parse(pos)
+            pos = self._skip_blank(self._line_end(pos) + 1)
+
+
+class BinaryRecording(Recording):
+    '''
+    Binary recording: records packed with record_format, the time first
+    '''
+
+    def __init__(self, path, record_format, columns=None):
+        Recording.__init__(self, path)
+        try:
+            self._record = struct.Struct(record_format)
+        except struct.error as e:
+            raise PlaybackError('Invalid record format %s: %s' % (record_format, e))
+        fields = len(self._record.unpack(bytes(self._record.size)))
+        if columns is None:
+            columns = [str(i) for i in range(1, fields)]
+        if len(columns) != fields - 1:
+            raise PlaybackError('Record format %s has %d columns, %d are named' %
+                                (record_format, fields - 1, len(columns)))
+        self.columns = list(columns)
+        self._count = len(self._mm) // self._record.size
+        if self._count == 0:
+            raise PlaybackError('Recording %s has no records' % (path, ))
+        self.start_time = self._unpack(0)[0]
+        self.end_time = self._unpack(self._count - 1)[0]
+
+    def _unpack(self, index):
+        record = self._record.unpack_from(self._mm, index * self._record.size)
+        if not all(math.isfinite(field) for field in record):
+            raise PlaybackError('Recording %s has a value that is not finite in record %d' % (self.path, index))
+        return record
+
+    def _time(self, index):
+        t = self._record.unpack_from(self._mm, index * self._record.size)[0]
+        if not math.isfinite(t):
+            raise PlaybackError('Recording %s has a time that is not finite in record %d' % (self.path, index))
+        return t
+
+    def _seek(self, t):
+        (lo, hi) = (0, self._count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(mid) <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(lo - 1, 0)
+
+    def rows(self, t):
+        for index in range(self._seek(t), self._count):
+            record = self._record.unpack_from(self._mm, index * self._record.size)
+            if not math.isfinite(record[0]):
+                raise PlaybackError('Recording %s has a time that is not finite in record %d' % (self.path, index))
+            yield (record[0], record[1:])
+
+
+def open_recording(path, record_format=None, columns=None):
+    '''
+    Opens a CSV recording, or a binary one when given its record format
+    '''
+    try:
+        if record_format is None:
+            return CsvRecording(path)
+        return BinaryRecording(path, record_format, columns)
+    except (OSError, ValueError) as e:
+        raise PlaybackError('Could not open recording %s: %s' % (path, e))
+
+
+class Playback(object):
+    '''
+    Plays a recording from monotonic time started on
+    '''
+
+    def __init__(self, path, speed=1.0, loop=False, record_format=None, columns=None, started=None):
+        if not isinstance(speed, (int, float)) or speed <= 0:
+            raise PlaybackError('speed must be a positive number')
+        self.recording = open_recording(path, record_format, columns)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.record_format = record_format
+        self.started = time.monotonic() if started is None else started
+        self._rows = None
+        self._current = None
+        self._next = None
+        self._lock = threading.Lock()
+
+    def get_spec(self):
+        '''
+        Returns what rebuilds this playback, on the same clock, in another
+        process
+        '''
+        return {
+            'path': self.path,
+            'speed': self.speed,
+            'loop': self.loop,
+            'record_format': self.record_format,
+            'columns': self.recording.columns,
+            'started': self.started,
+        }
+
+    def get_column(self, column):
+        '''
+        Returns the index of a column given by name or index
+        '''
+        if isinstance(column, int) and not isinstance(column, bool) and 0 <= column < len(self.recording.columns):
+            return column
+        if column in self.recording.columns:
+            return self.recording.columns.index(column)
+        raise PlaybackError('Recording %s has no column %s' % (self.path, column))
+
+    def playback_time(self, now):
+        recording = self.recording
+        elapsed = (now - self.started) * self.speed
+        duration = recording.end_time - recording.start_time
+        if self.loop and duration > 0:
+            elapsed %= duration
+        return recording.start_time + elapsed
+
+    def _rewind(self, t):
+        self._rows = self.recording.rows(t)
+        self._current = next(self._rows)
+        self._next = next(self._rows, None)
+
+    def sample(self, now):
+        '''
+        Returns the values of the row in effect at monotonic time now, raises
+        PlaybackError when a row read on the way is invalid
+        '''
+        t = self.playback_time(now)
+        with self._lock:
+            try:
+                if self._current is None or t < self._current[0]:
+                    self._rewind(t)
+                steps = 0
+                while self._next is not None and self._next[0] <= t:
+                    steps += 1
+                    if steps > SEEK_AFTER:
+                        self._rewind(t)
+                        break
+                    self._current = self._next
+                    self._next = next(self._rows, None)
+            except PlaybackError:
+                # the rows iterator is done with, seek again on the next sample
+                self._current = None
+                raise
+            return self._current[1]
+
+    def close(self):
+        with self._lock:
+            self._rows = None
+            self.recording.close()
+
+
+class PlaybackRegister(Generator):
+    '''
+    Generator giving a register the word-th 16 bit word of a playback column
+    packed with a struct format
+    '''
+
+    def __init__(self, name, playback, column, fmt='>H', word=0):
+        self.spec = {'type': 'playback', 'playback': name, 'column': column, 'format': fmt, 'word': word}
+        self.playback = playback
+        self.started = playback.started
+        self._column = playback.get_column(column)
+        self._format = fmt
+        self._word = word
+        self._integer = fmt[-1] not in 'efd'
+
+    def register_value(self, now, unsigned=True):
+        try:
+            value = self.playback.sample(now)[self._column]
+        except PlaybackError:
+            # an invalid row is in effect, keep the register at 0
+            return 0
+        if not math.isfinite(value):
+            return 0
+        if self._integer:
+            value = int(round(value))
+        try:
+            packed = struct.pack(self._format, value)
+        except struct.error:
+            # out of the range of the format, keep the register at 0
+            return 0
+        value = struct.unpack_from('>H', packed, 2 * self._word)[0]
+        return value if unsigned or value < 0x8000 else value - 0x10000
+
+
+def register_count(fmt):
+    '''
+    Returns the number of registers a value packed with fmt takes
+    '''
+    try:
+        size = struct.calcsize(fmt)
+    except struct.error as e:
+        raise PlaybackError('Invalid format %s: %s' % (fmt, e))
+    if size % 2 or fmt[-1] not in 'hHiIlLqQefd':
+        raise PlaybackError('Format %s does not pack a number into whole registers' % (fmt, ))
+    return size // 2
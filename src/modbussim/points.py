@@ -0,0 +1,258 @@
+# -*- coding: utf_8 -*-
+'''
+Typed register points
+
+A point names a value held in one or more registers: a struct format packs
+it, scale turns the raw value into the engineering one, and the byte and
+word orders say how the device lays the packed bytes out over its
+registers. A PointMap holds the points of a slave and reads or writes any
+set of them in one call.
+
+Codecs are struct.Struct objects compiled once per format. Points next to
+each other with the same layout are packed and unpacked together by one
+codec, and each run of adjacent registers is read or written in one go.
+'''
+import struct
+
+from array import array
+from functools import lru_cache
+
+
+ORDERS = ('big', 'little')
+
+# struct codes of the values a point can hold
+INTEGER_CODES = 'hHiIlLqQ'
+FLOAT_CODES = 'efd'
+STRING_CODE = 's'
+
+
+class PointError(Exception):
+    pass
+
+
+@lru_cache(maxsize=1024)
+def get_struct(fmt):
+    '''
+    Returns the compiled struct of a format, shared by every caller
+    '''
+    return struct.Struct(fmt)
+
+
+class Point(object):
+    '''
+    A typed value at address. fmt is a struct format without byte order
+    such as 'f', 'i' or '16s'; values are big endian unless byte_order or
+    word_order is little, little word order swapping the registers of the
+    value and little byte order the two bytes of every register
+    '''
+
+    def __init__(self, name, address, fmt='H', scale=1, byte_order='big', word_order='big'):
+        if not isinstance(name, str) or not name:
+            raise PointError('Points need a name')
+        if not isinstance(address, int) or not 0 <= address < 0x10000:
+            raise PointError('Point %s has an invalid address %s' % (name, address))
+        if not isinstance(fmt, str) or not fmt or fmt[0] in '@=<>!':
+            raise PointError('Point %s needs a format without byte order' % (name, ))
+        try:
+            codec = get_struct('>' + fmt)
+        except struct.error as e:
+            raise PointError('Point %s has an invalid format %s: %s' % (name, fmt, e))
+        (length, code) = (fmt[:-1], fmt[-1])
+        if code not in INTEGER_CODES + FLOAT_CODES + STRING_CODE or codec.size % 2 or \
+                (length != '' and (code != STRING_CODE or not length.isdigit())):
+            raise PointError('Format %s of point %s does not pack one value into whole registers' % (fmt, name))
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or scale == 0:
+            raise PointError('Point %s has an invalid scale %s' % (name, scale))
+        if byte_order not in ORDERS or word_order not in ORDERS:
+            raise PointError('Byte and word orders of point %s must be one of %s' % (name, ', '.join(ORDERS)))
+        self.name = name
+        self.address = address
+        self.format = fmt
+        self.scale = scale
+        self.byte_order = byte_order
+        self.word_order = word_order
+        self.count = codec.size // 2
+        self.code = code
+        # points of the same layout are packed by the same codecs
+        self.layout = (fmt, scale, byte_order, word_order)
+
+    def get_spec(self):
+        return {'name': self.name, 'address': self.address, 'format': self.format, 'scale': self.scale,
+                'byte_order': self.byte_order, 'word_order': self.word_order}
+
+    def to_raw(self, value):
+        '''
+        Returns the value to pack for an engineering value
+        '''
+        if self.code == STRING_CODE:
+            if not isinstance(value, str):
+                raise PointError('Point %s holds a string' % (self.name, ))
+            return value.encode()
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise PointError('Point %s holds a number' % (self.name, ))
+        if self.scale != 1:
+            value = value / self.scale
+        if self.code in INTEGER_CODES:
+            value = int(round(value))
+        return value
+
+    def from_raw(self, value):
+        '''
+        Returns the engineering value of an unpacked value
+        '''
+        if self.code == STRING_CODE:
+            return value.rstrip(b'\0').decode(errors='replace')
+        if self.scale != 1:
+            return value * self.scale
+        return value
+
+
+class Run(object):
+    '''
+    Points of the same layout at adjacent addresses, packed by one codec
+    '''
+
+    def __init__(self, points):
+        self.points = points
+        self.address = points[0].address
+        self.count = sum(point.count for point in points)
+        first = points[0]
+        self._codec = get_struct('>' + first.format * len(points))
+        self._words = first.count
+        self._swap_bytes = first.byte_order == 'little'
+        self._swap_words = first.word_order == 'little' and first.count > 1
+
+    def _reorder(self, data):
+        # big endian bytes to the order of the device, or back: both swaps
+        # are their own inverse
+        if not self._swap_bytes and not self._swap_words:
+            return data
+        registers = array('H', data)
+        if self._swap_bytes:
+            registers.byteswap()
+        if self._swap_words:
+            swapped = array('H', registers)
+            words = self._words
+            for word in range(words):
+                swapped[word::words] = registers[words - 1 - word::words]
+            registers = swapped
+        return registers.tobytes()
+
+    def pack(self, values):
+        '''
+        Returns the register bytes of the engineering values of the points
+        '''
+        raw = [point.to_raw(value) for (point, value) in zip(self.points, values)]
+        try:
+            return self._reorder(self._codec.pack(*raw))
+        except struct.error as e:
+            raise PointError('Cannot pack %s: %s' % (', '.join(point.name for point in self.points), e))
+
+    def unpack(self, data):
+        '''
+        Returns the engineering values of the points held in register bytes
+        '''
+        return [point.from_raw(value) for (point, value) in
+                zip(self.points, self._codec.unpack(self._reorder(data)))]
+
+
+class PointMap(object):
+    '''
+    The typed points of a slave, by name. Points may not overlap
+    '''
+
+    def __init__(self, specs):
+        if not isinstance(specs, list):
+            raise PointError('Points must be a list')
+        points = []
+        for spec in specs:
+            if not isinstance(spec, dict):
+                raise PointError('Points must be objects')
+            try:
+                points.append(Point(spec['name'], spec['address'], spec.get('format', 'H'),
+                                    spec.get('scale', 1), spec.get('byte_order', 'big'),
+                                    spec.get('word_order', 'big')))
+            except KeyError as e:
+                raise PointError('Points need a %s' % (e.args[0], ))
+        self.points = dict((point.name, point) for point in points)
+        if len(self.points) != len(points):
+            raise PointError('Point names must be unique')
+        self._sorted = sorted(points, key=lambda point: point.address)
+        for (previous, point) in zip(self._sorted, self._sorted[1:]):
+            if previous.address + previous.count > point.address:
+                raise PointError('Points %s and %s overlap' % (previous.name, point.name))
+        # runs of every point, for reads and writes of the whole map
+        self._all_runs = self._make_runs(self._sorted)
+
+    def get_specs(self):
+        return [point.get_spec() for point in self._sorted]
+
+    def _make_runs(self, points):
+        runs = []
+        current = []
+        for point in points:
+            if current and (current[-1].layout != point.layout or
+                            current[-1].address + current[-1].count != point.address):
+                runs.append(Run(current))
+                current = []
+            current.append(point)
+        if current:
+            runs.append(Run(current))
+        return runs
+
+    def get_runs(self, names=None):
+        '''
+        Returns the runs of the named points, of all of them by default
+        '''
+        if names is None:
+            return self._all_runs
+        try:
+            points = [self.points[name] for name in set(names)]
+        except KeyError as e:
+            raise PointError('Point %s does not exist' % (e.args[0], ))
+        return self._make_runs(sorted(points, key=lambda point: point.address))
+
+    def read(self, slave, names=None):
+        '''
+        Returns name -> value of the named points of slave, of all of them
+        by default
+        '''
+        values = {}
+        for (block_name, address, count, runs) in self._spans(slave, self.get_runs(names)):
+            data = slave.get_bytes(block_name, address, count)
+            for run in runs:
+                start = 2 * (run.address - address)
+                values.update(zip((point.name for point in run.points),
+                                  run.unpack(data[start:start + 2 * run.count])))
+        return values
+
+    def write(self, slave, values):
+        '''
+        Writes name -> value to the points of slave, packing every value
+        before writing any
+        '''
+        if not isinstance(values, dict):
+            raise PointError('Point values must be an object')
+        spans = []
+        for (block_name, address, count, runs) in self._spans(slave, self.get_runs(values)):
+            spans.append((block_name, address, b''.join(run.pack([values[point.name] for point in run.points])
+                                                       for run in runs)))
+        with slave.data_lock:
+            for (block_name, address, data) in spans:
+                slave.set_bytes(block_name, address, data)
+
+    def _spans(self, slave, runs):
+        # groups the runs at adjacent registers of the same block, to
+        # access each group in one call
+        spans = []
+        for run in runs:
+            route = slave.route(run.address, run.count)
+            block_name = route[0] if route else None
+            if block_name is None or slave.is_bit_block(block_name):
+                raise PointError('Registers of %s are out of range' % (', '.join(point.name for point in run.points)))
+            if spans and spans[-1][0] == block_name and spans[-1][1] + spans[-1][2] == run.address:
+                spans[-1][2] += run.count
+                spans[-1][3].append(run)
+            else:
+                spans.append([block_name, run.address, run.count, [run]])
+        return spans
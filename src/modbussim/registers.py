@@ -0,0 +1,308 @@
+# -*- coding: utf_8 -*-
+import struct
+import sys
+
+from array import array
+
+from modbus_tk.hooks import call_hooks
+from modbus_tk.modbus import ModbusBlock
+
+
+# registers travel big endian on the wire
+SWAP_BYTES = sys.byteorder == 'little'
+
+
+class ListBlock(ModbusBlock):
+    '''
+    modbus_tk's list backed block with big endian byte image access
+    '''
+
+    def __init__(self, starting_address, size, name='', unsigned=True):
+        ModbusBlock.__init__(self, starting_address, size, name)
+        self._typecode = 'H' if unsigned else 'h'
+
+    def read_bytes(self, offset, count):
+        '''
+        Returns count registers starting at offset as big endian bytes
+        '''
+        return struct.pack('>%d%s' % (count, self._typecode), *self._data[offset:offset + count])
+
+    def write_bytes(self, offset, data):
+        '''
+        Writes big endian register values from a bytes like object at offset
+        '''
+        values = struct.unpack('>%d%s' % (len(data) // 2, self._typecode), data)
+        self[offset:offset + len(values)] = values
+
+
+class ArrayBlock(ModbusBlock):
+    '''
+    Register block backed by a single array of 16 bit values instead of a
+    list of python ints
+    '''
+
+    def __init__(self, starting_address, size, name='', unsigned=True):
+        self.starting_address = starting_address
+        self._data = array('H' if unsigned else 'h', bytes(2 * size))
+        self.size = size
+
+    def __setitem__(self, item, value):
+        call_hooks('modbus.ModbusBlock.setitem', (self, item, value))
+        if isinstance(item, slice) and not isinstance(value, array):
+            value = array(self._data.typecode, value)
+        self._data[item] = value
+
+    def read_bytes(self, offset, count):
+        '''
+        Returns count registers starting at offset as big endian bytes
+        '''
+        values = self._data[offset:offset + count]
+        if SWAP_BYTES:
+            values.byteswap()
+        return values.tobytes()
+
+    def write_bytes(self, offset, data):
+        '''
+        Writes big endian register values from a bytes like object at offset
+        '''
+        values = array(self._data.typecode)
+        values.frombytes(data)
+        if SWAP_BYTES:
+            values.byteswap()
+        self[offset:offset + len(values)] = values
+
+
+class SharedBlock(ModbusBlock):
+    '''
+    Register block living in a RegisterFile, so every process mapping the
+    file sees the same values. data is a memoryview of 16 bit values over
+    the block's region of the file
+    '''
+
+    def __init__(self, starting_address, size, name='', unsigned=True, data=None, offset=None):
+        self.starting_address = starting_address
+        self.size = size
+        self.offset = offset
+        self._data = data if unsigned else data.cast('B').cast('h')
+
+    def __setitem__(self, item, value):
+        call_hooks('modbus.ModbusBlock.setitem', (self, item, value))
+        if isinstance(item, slice) and not isinstance(value, array):
+            value = array(self._data.format, value)
+        self._data[item] = value
+
+    def read_bytes(self, offset, count):
+        '''
+        Returns count registers starting at offset as big endian bytes
+        '''
+        values = array(self._data.format)
+        values.frombytes(self._data[offset:offset + count].cast('B'))
+        if SWAP_BYTES:
+            values.byteswap()
+        return values.tobytes()
+
+    def write_bytes(self, offset, data):
+        '''
+        Writes big endian register values from a bytes like object at offset
+        '''
+        values = array(self._data.format)
+        values.frombytes(data)
+        if SWAP_BYTES:
+            values.byteswap()
+        self[offset:offset + len(values)] = values
+
+    def release(self):
+        self._data.release()
+
+
+# registers of a page of a CowBlock, the unit copied on first write
+PAGE_SIZE = 64
+
+
+class CowBlock(ModbusBlock):
+    '''
+    Register block sharing the pages of a template image with every other
+    block made from it. A write copies the pages it touches first, so a
+    block only owns memory for the pages written since it was made. pages
+    are arrays of PAGE_SIZE registers, the last one possibly shorter
+    '''
+
+    def __init__(self, starting_address, size, name='', unsigned=True, pages=None):
+        self.starting_address = starting_address
+        self.size = size
+        self._typecode = 'H' if unsigned else 'h'
+        self._pages = list(pages)
+        # 1 for the pages this block copied and owns
+        self._owned = bytearray(len(self._pages))
+
+    def _page(self, index):
+        if not self._owned[index]:
+            self._pages[index] = array(self._typecode, self._pages[index])
+            self._owned[index] = 1
+        return self._pages[index]
+
+    def _index(self, item):
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError('register index out of range')
+        return item
+
+    def _values(self, start, stop):
+        values = array(self._typecode)
+        while start < stop:
+            (page, offset) = divmod(start, PAGE_SIZE)
+            end = min(stop, (page + 1) * PAGE_SIZE)
+            values.extend(self._pages[page][offset:offset + end - start])
+            start = end
+        return values
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(self.size)
+            values = self._values(start, stop) if stop > start else array(self._typecode)
+            return values if step == 1 else values[::step]
+        item = self._index(item)
+        return self._pages[item // PAGE_SIZE][item % PAGE_SIZE]
+
+    def __setitem__(self, item, value):
+        call_hooks('modbus.ModbusBlock.setitem', (self, item, value))
+        if not isinstance(item, slice):
+            item = self._index(item)
+            self._page(item // PAGE_SIZE)[item % PAGE_SIZE] = value
+            return
+        (start, stop, step) = item.indices(self.size)
+        values = value if isinstance(value, array) else array(self._typecode, value)
+        if step != 1 or len(values) != max(stop - start, 0):
+            indices = range(start, stop, step)
+            if len(values) != len(indices):
+                raise ValueError('attempt to assign %d registers to a slice of %d' % (len(values), len(indices)))
+            for (i, register) in zip(indices, values):
+                self[i] = register
+            return
+        done = 0
+        while start < stop:
+            (page, offset) = divmod(start, PAGE_SIZE)
+            end = min(stop, (page + 1) * PAGE_SIZE)
+            self._page(page)[offset:offset + end - start] = values[done:done + end - start]
+            done += end - start
+            start = end
+
+    def read_bytes(self, offset, count):
+        '''
+        Returns count registers starting at offset as big endian bytes
+        '''
+        values = self._values(offset, offset + count)
+        if SWAP_BYTES:
+            values.byteswap()
+        return values.tobytes()
+
+    def write_bytes(self, offset, data):
+        '''
+        Writes big endian register values from a bytes like object at offset
+        '''
+        values = array(self._typecode)
+        values.frombytes(data)
+        if SWAP_BYTES:
+            values.byteswap()
+        self[offset:offset + len(values)] = values
+
+    def get_copied_pages(self):
+        return sum(self._owned)
+
+
+def pack_bits(values):
+    '''
+    Returns bit values packed 8 per byte, least significant bit first
+    '''
+    bits = ''.join('1' if value else '0' for value in reversed(values))
+    return int(bits or '0', 2).to_bytes((len(values) + 7) // 8, 'little')
+
+
+def unpack_bits(data, count):
+    '''
+    Returns the count first bit values packed in data
+    '''
+    bits = bin(int.from_bytes(data, 'little'))[2:].zfill(8 * len(data))
+    return [1 if bit == '1' else 0 for bit in reversed(bits[-count:])] if count else []
+
+
+class BitBlock(ModbusBlock):
+    '''
+    Coil or discrete input block keeping its bits packed 8 per byte, least
+    significant bit first as they travel on the wire, so reads and multiple
+    writes are byte copies. data is a bytes like object to keep the bits in,
+    a new bytearray by default
+    '''
+
+    def __init__(self, starting_address, size, name='', unsigned=True, data=None, offset=None):
+        self.starting_address = starting_address
+        self.size = size
+        self.offset = offset
+        self._data = bytearray((size + 7) // 8) if data is None else data
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(self.size)
+            if step == 1:
+                return unpack_bits(self.read_bits(start, stop - start), stop - start) if stop > start else []
+            return [self[i] for i in range(start, stop, step)]
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError('bit index out of range')
+        return (self._data[item >> 3] >> (item & 7)) & 1
+
+    def __setitem__(self, item, value):
+        call_hooks('modbus.ModbusBlock.setitem', (self, item, value))
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(self.size)
+            values = list(value)
+            if step == 1 and len(values) == stop - start:
+                self.write_bits(start, pack_bits(values), len(values))
+                return
+            indices = range(start, stop, step)
+            if len(values) != len(indices):
+                raise ValueError('attempt to assign %d bits to a slice of %d' % (len(values), len(indices)))
+            for (i, bit) in zip(indices, values):
+                self[i] = bit
+            return
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError('bit index out of range')
+        if value:
+            self._data[item >> 3] |= 1 << (item & 7)
+        else:
+            self._data[item >> 3] &= ~(1 << (item & 7)) & 0xff
+
+    def read_bits(self, offset, count):
+        '''
+        Returns count bits starting at offset packed as in a read response
+        '''
+        shift = offset & 7
+        first = offset >> 3
+        value = int.from_bytes(self._data[first:(offset + count + 7) >> 3], 'little') >> shift
+        return (value & ((1 << count) - 1)).to_bytes((count + 7) >> 3, 'little')
+
+    def write_bits(self, offset, data, count):
+        '''
+        Writes count bits packed as in a write multiple coils request at offset
+        '''
+        shift = offset & 7
+        first = offset >> 3
+        last = (offset + count + 7) >> 3
+        mask = ((1 << count) - 1) << shift
+        current = int.from_bytes(self._data[first:last], 'little')
+        value = (int.from_bytes(data, 'little') << shift) & mask
+        self._data[first:last] = ((current & ~mask) | value).to_bytes(last - first, 'little')
+
+    def read_bytes(self, offset, count):
+        return self.read_bits(offset, count)
+
+    def write_bytes(self, offset, data, count=None):
+        self.write_bits(offset, data, 8 * len(data) if count is None else count)
+
+    def release(self):
+        if isinstance(self._data, memoryview):
+            self._data.release()
@@ -0,0 +1,91 @@
+# -*- coding: utf_8 -*-
+import threading
+
+from bisect import bisect_right
+
+
+class AddressIndex(object):
+    '''
+    Maps addresses of a slave to the block holding them.
+
+    The address space is cut at every block boundary into segments, each
+    one listing the blocks covering it in the order they were added, so a
+    lookup is a bisect over the segment starts whatever the layout, and
+    overlapping blocks resolve to the first one added.
+    '''
+
+    def __init__(self):
+        # (block_name, block_type, starting_address, size, block) in priority order
+        self._blocks = []
+        # (segment starts, blocks covering each segment), built on first lookup
+        self._table = None
+        self._lock = threading.Lock()
+
+    def add(self, block_name, block_type, starting_address, size, block=None):
+        with self._lock:
+            self._blocks.append((block_name, block_type, starting_address, size, block))
+            self._table = None
+
+    def remove(self, block_name):
+        with self._lock:
+            self._blocks = [block for block in self._blocks if block[0] != block_name]
+            self._table = None
+
+    def clear(self):
+        with self._lock:
+            self._blocks = []
+            self._table = None
+
+    def _build(self):
+        priority = dict((block[0], i) for (i, block) in enumerate(self._blocks))
+        by_start = sorted(self._blocks, key=lambda block: block[2])
+        boundaries = sorted(set([block[2] for block in self._blocks] +
+                                [block[2] + block[3] for block in self._blocks]))
+        starts = []
+        covering = []
+        active = []
+        i = 0
+        for boundary in boundaries:
+            active = [block for block in active if block[2] + block[3] > boundary]
+            while i < len(by_start) and by_start[i][2] == boundary:
+                active.append(by_start[i])
+                i += 1
+            starts.append(boundary)
+            covering.append(tuple(sorted(active, key=lambda block: priority[block[0]])))
+        return (starts, covering)
+
+    def _get_table(self):
+        table = self._table
+        if table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = self._build()
+                table = self._table
+        return table
+
+    def _find(self, address, count, block_type):
+        (starts, covering) = self._get_table()
+        i = bisect_right(starts, address) - 1
+        if i < 0:
+            return None
+        for entry in covering[i]:
+            (block_name, type_, starting_address, size, block) = entry
+            if (block_type is None or type_ == block_type) and address + count <= starting_address + size:
+                return entry
+        return None
+
+    def lookup(self, address, count=1, block_type=None):
+        '''
+        Returns (block_name, offset) of the block holding count addresses
+        from address on, optionally only looking at blocks of block_type.
+        Returns None if no block holds the whole range
+        '''
+        entry = self._find(address, count, block_type)
+        return None if entry is None else (entry[0], address - entry[2])
+
+    def lookup_block(self, address, count=1, block_type=None):
+        '''
+        Like lookup, but returns (block, offset) with the block given to add
+        '''
+        entry = self._find(address, count, block_type)
+        return None if entry is None else (entry[4], address - entry[2])
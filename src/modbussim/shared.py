@@ -0,0 +1,195 @@
+# -*- coding: utf_8 -*-
+'''
+Registers in shared memory
+
+A RegisterFile is a shared memory segment the simulator process carves
+register blocks out of. Worker processes attach to the same segment by
+name and wrap the regions they are told about in SharedBlocks, or BitBlocks
+for coils and discrete inputs, so a value written by any process is read by
+every other one.
+'''
+import threading
+
+from multiprocessing.shared_memory import SharedMemory
+
+from modbus_tk import defines
+from modbus_tk.modbus import ModbusBlock
+
+from .generators import Generator
+from .registers import BitBlock, SharedBlock
+from .slave import BIT_BLOCK_TYPES, ArraySlave
+
+
+class RegisterFileError(Exception):
+    pass
+
+
+class RegisterFile(object):
+    '''
+    Shared memory segment of 16 bit registers. The process which creates it
+    owns it: it allocates and frees regions and unlinks the segment on
+    close, other processes attach to it by name
+    '''
+
+    def __init__(self, size=None, name=None):
+        if name is None:
+            self._shm = SharedMemory(create=True, size=size)
+        else:
+            self._shm = SharedMemory(name=name)
+        self.name = self._shm.name
+        self.owner = name is None
+        self._registers = self._shm.buf.cast('H')
+        # (offset, count) of the free regions, sorted by offset
+        self._free = [(0, len(self._registers))]
+        self._lock = threading.Lock()
+
+    def allocate(self, count):
+        '''
+        Returns the offset of count zeroed registers
+        '''
+        with self._lock:
+            for (i, (offset, free)) in enumerate(self._free):
+                if free >= count:
+                    if free == count:
+                        del self._free[i]
+                    else:
+                        self._free[i] = (offset + count, free - count)
+                    self._registers[offset:offset + count].cast('B')[:] = bytes(2 * count)
+                    return offset
+        raise RegisterFileError('Register file %s has no room left for %d registers' % (self.name, count))
+
+    def free(self, offset, count):
+        with self._lock:
+            self._free.append((offset, count))
+            self._free.sort()
+            merged = [self._free[0]]
+            for (start, size) in self._free[1:]:
+                (last_start, last_size) = merged[-1]
+                if last_start + last_size == start:
+                    merged[-1] = (last_start, last_size + size)
+                else:
+                    merged.append((start, size))
+            self._free = merged
+
+    def view(self, offset, count):
+        '''
+        Returns a memoryview of count registers from offset on
+        '''
+        return self._registers[offset:offset + count]
+
+    def get_stats(self):
+        with self._lock:
+            free = sum(count for (offset, count) in self._free)
+        return {
+            'name': self.name,
+            'registers': len(self._registers),
+            'free': free,
+        }
+
+    def close(self):
+        try:
+            self._registers.release()
+            self._shm.close()
+        except BufferError:
+            # blocks still hold views on the segment, the mapping goes away
+            # with the process
+            pass
+        if self.owner:
+            self._shm.unlink()
+
+
+def block_registers(block_type, size):
+    '''
+    Returns the number of registers of the file a block takes, bit blocks
+    keep 16 bits in each
+    '''
+    return (size + 15) // 16 if block_type in BIT_BLOCK_TYPES else size
+
+
+def make_shared_block(register_file, block_type, starting_address, size, block_name, unsigned, offset):
+    '''
+    Returns the block of block_type over the registers of the file from offset on
+    '''
+    data = register_file.view(offset, block_registers(block_type, size))
+    if block_type in BIT_BLOCK_TYPES:
+        return BitBlock(starting_address, size, block_name, data=data.cast('B')[:(size + 7) // 8], offset=offset)
+    return SharedBlock(starting_address, size, block_name, unsigned=unsigned, data=data, offset=offset)
+
+
+class SharedSlave(ArraySlave):
+    '''
+    Slave keeping its registers in a RegisterFile. In the process owning the
+    file, changes to the block layout are passed to listener so worker
+    processes can mirror them
+    '''
+    block_classes = {
+        defines.COILS: BitBlock,
+        defines.DISCRETE_INPUTS: BitBlock,
+        defines.HOLDING_REGISTERS: SharedBlock,
+        defines.ANALOG_INPUTS: SharedBlock,
+    }
+
+    def __init__(self, slave_id, unsigned=True, memory=None):
+        ArraySlave.__init__(self, slave_id, unsigned, memory)
+        self.register_file = None
+        self.listener = None
+
+    def _make_block(self, block_type, starting_address, size, block_name):
+        if self.block_classes.get(block_type, ModbusBlock) is ModbusBlock:
+            return ModbusBlock(starting_address, size, block_name)
+        offset = self.register_file.allocate(block_registers(block_type, size))
+        return make_shared_block(self.register_file, block_type, starting_address, size, block_name,
+                                 self.unsigned, offset)
+
+    def _notify(self, message):
+        if self.listener is not None:
+            self.listener(message)
+
+    def add_block(self, block_name, block_type, starting_address, size, block=None):
+        with self._data_lock:
+            ArraySlave.add_block(self, block_name, block_type, starting_address, size, block)
+            block = self._get_block(block_name)
+            self._notify(('add_block', self._id, block_name, block_type, starting_address, size,
+                          getattr(block, 'offset', None)))
+
+    def add_template_block(self, template_block):
+        # the workers only see blocks of the register file, so the image is
+        # copied into one
+        with self._data_lock:
+            self.add_block(template_block.block_name, template_block.block_type, template_block.starting_address,
+                           template_block.size)
+            self.set_bytes(template_block.block_name, template_block.starting_address, template_block.image,
+                           template_block.size)
+
+    def _release_block(self, block_type, block):
+        if isinstance(block, (SharedBlock, BitBlock)) and block.offset is not None:
+            if self.register_file.owner:
+                self.register_file.free(block.offset, block_registers(block_type, block.size))
+            block.release()
+
+    def remove_block(self, block_name):
+        with self._data_lock:
+            block = self._get_block(block_name)
+            block_type = self._blocks[block_name][0]
+            ArraySlave.remove_block(self, block_name)
+            self._release_block(block_type, block)
+            self._notify(('remove_block', self._id, block_name))
+
+    def remove_all_blocks(self):
+        with self._data_lock:
+            for block_name in list(self._blocks):
+                self.remove_block(block_name)
+
+    def set_generator(self, address, spec, block_type=None):
+        with self._data_lock:
+            block_type = ArraySlave.set_generator(self, address, spec, block_type)
+            if isinstance(spec, Generator):
+                spec = spec.spec
+            self._notify(('set_generator', self._id, block_type, address, spec))
+            return block_type
+
+    def remove_generator(self, address, block_type=None):
+        with self._data_lock:
+            removed = ArraySlave.remove_generator(self, address, block_type)
+            self._notify(('remove_generator', self._id, block_type, address))
+            return removed
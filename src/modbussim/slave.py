@@ -0,0 +1,422 @@
+# -*- coding: utf_8 -*-
+import struct
+import time
+
+from modbus_tk import defines
+from modbus_tk.exceptions import (DuplicatedKeyError, InvalidArgumentError,
+                                  InvalidModbusBlockError, MissingKeyError, ModbusError,
+                                  OutOfModbusBlockError, OverlapModbusBlockError)
+from modbus_tk.hooks import call_hooks
+from modbus_tk.modbus import ModbusBlock, Slave
+
+from .generators import Generator, GeneratorIndex, make_generator
+from .registers import ArrayBlock, BitBlock, CowBlock, ListBlock
+from .routing import AddressIndex
+
+
+BYTE_COUNT = struct.Struct('>B')
+ADDRESS_AND_QUANTITY = struct.Struct('>HH')
+WRITE_MULTIPLE_HEADER = struct.Struct('>HHB')
+
+# largest quantities allowed by the modbus spec for FC3/FC4 and FC16
+MAX_READ_REGISTERS = 125
+MAX_WRITE_REGISTERS = 123
+# and for FC1/FC2 and FC15
+MAX_READ_BITS = 2000
+MAX_WRITE_BITS = 1968
+
+# block types of single bit items
+BIT_BLOCK_TYPES = (defines.COILS, defines.DISCRETE_INPUTS)
+
+# function code -> block type read, for reads whose response can be cached
+CACHEABLE_FUNCTIONS = {
+    defines.READ_COILS: defines.COILS,
+    defines.READ_DISCRETE_INPUTS: defines.DISCRETE_INPUTS,
+    defines.READ_HOLDING_REGISTERS: defines.HOLDING_REGISTERS,
+    defines.READ_INPUT_REGISTERS: defines.ANALOG_INPUTS,
+}
+
+# function code -> (block type written, offset of the starting address in
+# the request pdu, offset of the quantity or None for a single item)
+WRITE_FUNCTIONS = {
+    defines.WRITE_SINGLE_COIL: (defines.COILS, 1, None),
+    defines.WRITE_SINGLE_REGISTER: (defines.HOLDING_REGISTERS, 1, None),
+    defines.WRITE_MULTIPLE_COILS: (defines.COILS, 1, 3),
+    defines.WRITE_MULTIPLE_REGISTERS: (defines.HOLDING_REGISTERS, 1, 3),
+    defines.MASK_WRITE_REGISTER: (defines.HOLDING_REGISTERS, 1, None),
+    defines.READ_WRITE_MULTIPLE_REGISTERS: (defines.HOLDING_REGISTERS, 5, 7),
+}
+UINT16 = struct.Struct('>H')
+
+# function code -> block type of the registers it reads from the starting
+# address at offset 1 of the request pdu, for reads of animated registers
+GENERATED_READS = {
+    defines.READ_HOLDING_REGISTERS: defines.HOLDING_REGISTERS,
+    defines.READ_INPUT_REGISTERS: defines.ANALOG_INPUTS,
+    defines.READ_WRITE_MULTIPLE_REGISTERS: defines.HOLDING_REGISTERS,
+}
+
+
+class ModbusSlave(Slave):
+    '''
+    modbus_tk slave which lets subclasses choose the block implementation
+    used for every block type
+    '''
+    block_classes = {
+        defines.COILS: BitBlock,
+        defines.DISCRETE_INPUTS: BitBlock,
+        defines.HOLDING_REGISTERS: ListBlock,
+        defines.ANALOG_INPUTS: ListBlock,
+    }
+
+    def __init__(self, slave_id, unsigned=True, memory=None):
+        Slave.__init__(self, slave_id, unsigned, memory)
+        self.address_index = AddressIndex()
+        # a ResponseCache when read responses are cached
+        self.response_cache = None
+        # the ChangeFeed every write is published to
+        self.change_feed = None
+        # generators animating registers, evaluated when they are read
+        self.generators = GeneratorIndex()
+        # block name -> block
+        self._named_blocks = {}
+
+    def handle_request(self, request_pdu, broadcast=False):
+        function_code = request_pdu[0] if len(request_pdu) > 0 else None
+        generated = False
+        if self.generators and function_code in GENERATED_READS and len(request_pdu) >= 5:
+            (address, count) = ADDRESS_AND_QUANTITY.unpack_from(request_pdu, 1)
+            generated = self._generate(GENERATED_READS[function_code], address, count)
+
+        if self.response_cache is not None and not broadcast and not generated \
+                and function_code in CACHEABLE_FUNCTIONS:
+            return self._handle_cached_read(function_code, request_pdu)
+
+        if function_code not in WRITE_FUNCTIONS:
+            return Slave.handle_request(self, request_pdu, broadcast)
+
+        # the write and its notification happen under the same lock so no
+        # reader can see a stale cached response in between
+        with self._data_lock:
+            response_pdu = Slave.handle_request(self, request_pdu, broadcast)
+            # exception responses are writes which did not happen, a
+            # broadcast which went through has no response at all
+            if response_pdu[:1] != bytes([function_code]) and (response_pdu or not broadcast):
+                return response_pdu
+            (block_type, address_offset, count_offset) = WRITE_FUNCTIONS[function_code]
+            if len(request_pdu) >= (count_offset or address_offset) + 2:
+                (address, ) = UINT16.unpack_from(request_pdu, address_offset)
+                count = UINT16.unpack_from(request_pdu, count_offset)[0] if count_offset else 1
+                self._on_write(block_type, address, count)
+            return response_pdu
+
+    def _handle_cached_read(self, function_code, request_pdu):
+        with self._data_lock:
+            start = time.perf_counter()
+            key = bytes(request_pdu)
+            response_pdu = self.response_cache.get(key)
+            hit = response_pdu is not None
+            if not hit:
+                response_pdu = Slave.handle_request(self, request_pdu)
+                # only cache real answers, not exception responses
+                if response_pdu and response_pdu[0] == function_code and len(key) == 5:
+                    (address, count) = ADDRESS_AND_QUANTITY.unpack_from(key, 1)
+                    self.response_cache.put(key, CACHEABLE_FUNCTIONS[function_code],
+                                            address, count, response_pdu)
+            self.response_cache.record(hit, time.perf_counter() - start)
+            return response_pdu
+
+    def _on_write(self, block_type, address, count):
+        '''
+        Called after count items of block_type were written from address on
+        '''
+        if self.response_cache is not None:
+            with self._data_lock:
+                self.response_cache.invalidate(block_type, address, count)
+        if self.change_feed is not None:
+            self.change_feed.publish(self._id, block_type, address, count)
+
+    def _generate(self, block_type, address, count):
+        '''
+        Stores the current value of the generators of block_type in
+        [address, address + count). Returns False if there are none
+        '''
+        found = self.generators.find(block_type, address, count)
+        if not found:
+            return False
+        now = time.monotonic()
+        with self._data_lock:
+            for (generator_address, generator) in found:
+                route = self.address_index.lookup(generator_address, 1, block_type)
+                if route is not None:
+                    self._get_block(route[0])[route[1]] = generator.register_value(now, self.unsigned)
+        return True
+
+    def set_generator(self, address, spec, block_type=None):
+        '''
+        Animates the register at address with the generator described by
+        spec, or with spec itself when it is a Generator. Returns the block
+        type of the register
+        '''
+        with self._data_lock:
+            route = self.address_index.lookup(address, 1, block_type)
+            if route is None:
+                raise OutOfModbusBlockError('address %d is out of every block' % (address, ))
+            block_type = self._blocks[route[0]][0]
+            if block_type not in GENERATED_READS.values():
+                raise InvalidArgumentError('Only registers can be animated')
+            generator = spec if isinstance(spec, Generator) else make_generator(spec)
+            self.generators.set(block_type, address, generator)
+            self._on_write(block_type, address, 1)
+            return block_type
+
+    def remove_generator(self, address, block_type=None):
+        '''
+        Stops animating the register at address, which keeps its last value.
+        Returns False if it was not animated
+        '''
+        with self._data_lock:
+            route = self.address_index.lookup(address, 1, block_type)
+            if route is None:
+                return False
+            return self.generators.remove(self._blocks[route[0]][0], address)
+
+    def get_generators(self):
+        '''
+        Returns the specs of the generators with their block type and address
+        '''
+        generators = []
+        for ((block_type, address), generator) in self.generators.items():
+            spec = dict(generator.spec)
+            spec.update({'block_type': block_type, 'address': address})
+            generators.append(spec)
+        return generators
+
+    def get_values(self, block_name, address, size=1):
+        with self._data_lock:
+            if self.generators and block_name in self._blocks:
+                self._generate(self._blocks[block_name][0], address, size)
+            return Slave.get_values(self, block_name, address, size)
+
+    def set_values(self, block_name, address, values):
+        with self._data_lock:
+            Slave.set_values(self, block_name, address, values)
+            count = len(values) if isinstance(values, (list, tuple)) else 1
+            self._on_write(self._blocks[block_name][0], address, count)
+
+    def _make_block(self, block_type, starting_address, size, block_name):
+        block_class = self.block_classes.get(block_type, ModbusBlock)
+        if block_class is ModbusBlock:
+            return ModbusBlock(starting_address, size, block_name)
+        return block_class(starting_address, size, block_name, unsigned=self.unsigned)
+
+    def add_template_block(self, template_block):
+        '''
+        Adds a block made from a TemplateBlock: registers share the pages of
+        the template image until they are written, bits are copied
+        '''
+        if template_block.is_bits():
+            block = BitBlock(template_block.starting_address, template_block.size, template_block.block_name,
+                             data=bytearray(template_block.image))
+        else:
+            block = CowBlock(template_block.starting_address, template_block.size, template_block.block_name,
+                             unsigned=self.unsigned, pages=template_block.get_pages(self.unsigned))
+        self.add_block(template_block.block_name, template_block.block_type, template_block.starting_address,
+                       template_block.size, block)
+
+    def add_block(self, block_name, block_type, starting_address, size, block=None):
+        '''
+        Adds a block of block_type, a new one made by _make_block unless an
+        existing block is given
+        '''
+        with self._data_lock:
+            if size <= 0:
+                raise InvalidArgumentError('size must be a positive number')
+            if starting_address < 0:
+                raise InvalidArgumentError('starting address must be zero or positive number')
+            if block_name in self._blocks:
+                raise DuplicatedKeyError('Block %s already exists. ' % (block_name,))
+            if block_type not in self._memory:
+                raise InvalidModbusBlockError('Invalid block type %s' % (block_type,))
+
+            index = 0
+            for i, existing in enumerate(self._memory[block_type]):
+                if existing.is_in(starting_address, size):
+                    raise OverlapModbusBlockError('Overlap block at %d size %d' %
+                                                  (existing.starting_address, existing.size))
+                if existing.starting_address > starting_address:
+                    index = i
+                    break
+
+            self._blocks[block_name] = (block_type, starting_address)
+            if block is None:
+                block = self._make_block(block_type, starting_address, size, block_name)
+            self._memory[block_type].insert(index, block)
+            self._named_blocks[block_name] = block
+            self.address_index.add(block_name, block_type, starting_address, size, block)
+
+    def remove_block(self, block_name):
+        with self._data_lock:
+            block = self._get_block(block_name)
+            block_type = self._blocks[block_name][0]
+            Slave.remove_block(self, block_name)
+            del self._named_blocks[block_name]
+            self.address_index.remove(block_name)
+            self.generators.remove_range(block_type, block.starting_address, block.size)
+            if self.response_cache is not None:
+                self.response_cache.clear()
+
+    def remove_all_blocks(self):
+        with self._data_lock:
+            Slave.remove_all_blocks(self)
+            self._named_blocks.clear()
+            self.address_index.clear()
+            self.generators.clear()
+            if self.response_cache is not None:
+                self.response_cache.clear()
+
+    def apply_broadcast(self, write):
+        '''
+        Applies a BroadcastWrite to the block holding its range. Like any
+        broadcast it is silently ignored when the slave has no such block
+        '''
+        with self._data_lock:
+            found = self.address_index.lookup(write.address, write.count, write.block_type)
+            if found is None:
+                return False
+            (block_name, offset) = found
+            block = self._get_block(block_name)
+            block[offset:offset + write.count] = write.values_for(block, self.unsigned)
+            self._on_write(write.block_type, write.address, write.count)
+            call_hooks('modbus.Slave.on_handle_broadcast', (self, write.response_pdu))
+            return True
+
+    def route(self, address, count=1, block_type=None):
+        '''
+        Returns (block_name, offset) of the block holding count addresses from
+        address on, None if there is none
+        '''
+        return self.address_index.lookup(address, count, block_type)
+
+    @property
+    def data_lock(self):
+        return self._data_lock
+
+    def get_block(self, block_name):
+        with self._data_lock:
+            return self._get_block(block_name)
+
+    def _get_block(self, block_name):
+        block = self._named_blocks.get(block_name)
+        if block is None:
+            raise MissingKeyError('block %s not found' % (block_name, ))
+        return block
+
+    def _get_block_and_offset(self, block_type, address, length):
+        '''
+        Returns the block holding length items of block_type from address on
+        and the offset of address in it. Addresses in no block, as the gaps
+        of a sparse register map, are illegal data addresses
+        '''
+        found = self.address_index.lookup_block(address, length, block_type)
+        if found is None:
+            raise ModbusError(defines.ILLEGAL_DATA_ADDRESS)
+        return found
+
+    def is_bit_block(self, block_name):
+        '''
+        Returns True for coil and discrete input blocks
+        '''
+        return self._blocks[block_name][0] in BIT_BLOCK_TYPES
+
+    def _read_digital(self, block_type, request_pdu):
+        (starting_address, quantity_of_x) = ADDRESS_AND_QUANTITY.unpack_from(request_pdu, 1)
+        if (quantity_of_x <= 0) or (quantity_of_x > MAX_READ_BITS):
+            raise ModbusError(defines.ILLEGAL_DATA_VALUE)
+
+        block, offset = self._get_block_and_offset(block_type, starting_address, quantity_of_x)
+        if not isinstance(block, BitBlock):
+            return Slave._read_digital(self, block_type, request_pdu)
+        data = block.read_bits(offset, quantity_of_x)
+        return BYTE_COUNT.pack(len(data)) + data
+
+    def _write_multiple_coils(self, request_pdu):
+        call_hooks('modbus.Slave.handle_write_multiple_coils_request', (self, request_pdu))
+        (starting_address, quantity_of_x, byte_count) = WRITE_MULTIPLE_HEADER.unpack_from(request_pdu, 1)
+        if (quantity_of_x <= 0) or (quantity_of_x > MAX_WRITE_BITS) or (byte_count != (quantity_of_x + 7) // 8) \
+                or len(request_pdu) < 6 + byte_count:
+            raise ModbusError(defines.ILLEGAL_DATA_VALUE)
+
+        block, offset = self._get_block_and_offset(defines.COILS, starting_address, quantity_of_x)
+        if not isinstance(block, BitBlock):
+            return Slave._write_multiple_coils(self, request_pdu)
+        block.write_bits(offset, request_pdu[6:6 + byte_count], quantity_of_x)
+        return ADDRESS_AND_QUANTITY.pack(starting_address, quantity_of_x)
+
+    def _get_block_range(self, block_name, address, count):
+        block = self._get_block(block_name)
+        offset = address - block.starting_address
+        if (offset < 0) or ((offset + count) > block.size):
+            raise OutOfModbusBlockError('address %d size %d is out of block %s' %
+                                        (address, count, block_name))
+        return block, offset
+
+    def get_bytes(self, block_name, address, count):
+        '''
+        Returns count registers of a block as big endian bytes, or count bits
+        of a bit block packed 8 per byte
+        '''
+        with self._data_lock:
+            block, offset = self._get_block_range(block_name, address, count)
+            if self.generators:
+                self._generate(self._blocks[block_name][0], address, count)
+            return block.read_bytes(offset, count)
+
+    def set_bytes(self, block_name, address, data, count=None):
+        '''
+        Writes big endian register values from a bytes like object into a
+        block, or count bits packed 8 per byte into a bit block (all the bits
+        of data by default)
+        '''
+        with self._data_lock:
+            if self.is_bit_block(block_name):
+                count = 8 * len(data) if count is None else count
+                block, offset = self._get_block_range(block_name, address, count)
+                block.write_bits(offset, data, count)
+            else:
+                count = len(data) // 2
+                block, offset = self._get_block_range(block_name, address, count)
+                block.write_bytes(offset, data)
+            self._on_write(self._blocks[block_name][0], address, count)
+
+
+class ArraySlave(ModbusSlave):
+    '''
+    Slave keeping its registers in ArrayBlocks. Register reads and multiple
+    register writes are served as slice copies of the block
+    '''
+    block_classes = {
+        defines.COILS: BitBlock,
+        defines.DISCRETE_INPUTS: BitBlock,
+        defines.HOLDING_REGISTERS: ArrayBlock,
+        defines.ANALOG_INPUTS: ArrayBlock,
+    }
+
+    def _read_registers(self, block_type, request_pdu):
+        (starting_address, quantity_of_x) = ADDRESS_AND_QUANTITY.unpack_from(request_pdu, 1)
+        if (quantity_of_x <= 0) or (quantity_of_x > MAX_READ_REGISTERS):
+            raise ModbusError(defines.ILLEGAL_DATA_VALUE)
+
+        block, offset = self._get_block_and_offset(block_type, starting_address, quantity_of_x)
+        return BYTE_COUNT.pack(2 * quantity_of_x) + block.read_bytes(offset, quantity_of_x)
+
+    def _write_multiple_registers(self, request_pdu):
+        call_hooks('modbus.Slave.handle_write_multiple_registers_request', (self, request_pdu))
+        (starting_address, quantity_of_x, byte_count) = WRITE_MULTIPLE_HEADER.unpack_from(request_pdu, 1)
+        if (quantity_of_x <= 0) or (quantity_of_x > MAX_WRITE_REGISTERS) or (byte_count != (quantity_of_x * 2)) \
+                or len(request_pdu) < 6 + byte_count:
+            raise ModbusError(defines.ILLEGAL_DATA_VALUE)
+
+        block, offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, starting_address, quantity_of_x)
+        block.write_bytes(offset, request_pdu[6:6 + byte_count])
+        return ADDRESS_AND_QUANTITY.pack(starting_address, quantity_of_x)
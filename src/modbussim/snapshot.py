@@ -0,0 +1,148 @@
+# -*- coding: utf_8 -*-
+'''
+Binary simulator snapshots
+
+A snapshot is laid out as:
+
+    header      magic, version, slave count, block count
+    declared    offset and length of the declared slaves
+    slave index one entry per slave: slave id, number of blocks
+    block index one entry per block, in slave order: block type, starting
+                address, size, offset and length of its image
+    images      the raw big endian register image of every block, coils and
+                discrete inputs packed 8 per byte
+    declared    the JSON of the layouts of the slaves declared but not made
+                yet by slave id
+
+so it can be restored from an mmap without parsing any of the images.
+Version 1 snapshots, which have no declared slaves, are still read.
+'''
+import json
+import struct
+
+
+MAGIC = b'MBSN'
+VERSION = 2
+
+HEADER = struct.Struct('>4sHHI')
+DECLARED = struct.Struct('>QI')
+SLAVE_ENTRY = struct.Struct('>BB')
+BLOCK_ENTRY = struct.Struct('>BHIQI')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_snapshot(stream, slaves, declared=None):
+    '''
+    Writes a snapshot to a binary stream.
+    slaves is a list of (slave_id, blocks) where blocks is a list of
+    (block_type, starting_address, size, length, read) and read() returns
+    the length bytes long image of the block. declared gives the layouts of
+    the declared slaves by slave id
+    '''
+    block_count = sum(len(blocks) for (slave_id, blocks) in slaves)
+    declared_data = json.dumps(declared or {}, sort_keys=True).encode('utf-8')
+    offset = HEADER.size + DECLARED.size + len(slaves) * SLAVE_ENTRY.size + block_count * BLOCK_ENTRY.size
+    # the declared slaves follow the images, whose lengths are the 4th item
+    images_length = sum(block[3] for (slave_id, blocks) in slaves for block in blocks)
+    stream.write(HEADER.pack(MAGIC, VERSION, len(slaves), block_count))
+    stream.write(DECLARED.pack(offset + images_length, len(declared_data)))
+    for (slave_id, blocks) in slaves:
+        stream.write(SLAVE_ENTRY.pack(slave_id, len(blocks)))
+
+    for (slave_id, blocks) in slaves:
+        for (block_type, starting_address, size, length, read) in blocks:
+            stream.write(BLOCK_ENTRY.pack(block_type, starting_address, size, offset, length))
+            offset += length
+
+    for (slave_id, blocks) in slaves:
+        for (block_type, starting_address, size, length, read) in blocks:
+            image = read()
+            if len(image) != length:
+                raise SnapshotError('Block image of slave %d is %d bytes instead of %d' %
+                                    (slave_id, len(image), length))
+            stream.write(image)
+    stream.write(declared_data)
+
+
+def _read_header(buff):
+    if len(buff) < HEADER.size:
+        raise SnapshotError('Snapshot is only %d bytes long' % (len(buff),))
+    (magic, version, slave_count, block_count) = HEADER.unpack_from(buff, 0)
+    if magic != MAGIC:
+        raise SnapshotError('Not a ModbusSim snapshot')
+    if version not in (1, VERSION):
+        raise SnapshotError('Unsupported snapshot version %d' % (version,))
+    return (version, slave_count, block_count)
+
+
+def read_snapshot(buff):
+    '''
+    Parses a snapshot from a bytes like object (bytes, mmap...).
+    Returns a list of (slave_id, blocks) where blocks is a list of
+    (block_type, starting_address, size, image) and image is a memoryview
+    over buff. The views must be released before buff is closed.
+    '''
+    (version, slave_count, block_count) = _read_header(buff)
+
+    slave_index = HEADER.size if version == 1 else HEADER.size + DECLARED.size
+    block_index = slave_index + slave_count * SLAVE_ENTRY.size
+    if len(buff) < block_index + block_count * BLOCK_ENTRY.size:
+        raise SnapshotError('Snapshot index is truncated')
+
+    view = memoryview(buff)
+
+    slaves = []
+    try:
+        for i in range(slave_count):
+            (slave_id, slave_block_count) = SLAVE_ENTRY.unpack_from(view, slave_index + i * SLAVE_ENTRY.size)
+            blocks = []
+            slaves.append((slave_id, blocks))
+            for j in range(slave_block_count):
+                if block_count == 0:
+                    raise SnapshotError('Slave index does not match block index')
+                (block_type, starting_address, size, offset, length) = BLOCK_ENTRY.unpack_from(view, block_index)
+                if offset + length > len(view):
+                    raise SnapshotError('Block image of slave %d is truncated' % (slave_id,))
+                blocks.append((block_type, starting_address, size, view[offset:offset + length]))
+                block_index += BLOCK_ENTRY.size
+                block_count -= 1
+    except Exception:
+        # buff cannot be closed while views on it are left
+        release_snapshot(slaves)
+        raise
+    finally:
+        view.release()
+    return slaves
+
+
+def read_declared(buff):
+    '''
+    Returns the layouts of the declared slaves of a snapshot by slave id
+    '''
+    (version, slave_count, block_count) = _read_header(buff)
+    if version == 1:
+        return {}
+    if len(buff) < HEADER.size + DECLARED.size:
+        raise SnapshotError('Snapshot index is truncated')
+    (offset, length) = DECLARED.unpack_from(buff, HEADER.size)
+    if offset + length > len(buff):
+        raise SnapshotError('Declared slaves are truncated')
+    try:
+        declared = json.loads(bytes(buff[offset:offset + length]).decode('utf-8'))
+        if not isinstance(declared, dict):
+            raise ValueError('not an object')
+        return dict((int(slave_id), entry) for (slave_id, entry) in declared.items())
+    except ValueError as e:
+        raise SnapshotError('Invalid declared slaves in snapshot: %s' % (e,))
+
+
+def release_snapshot(slaves):
+    '''
+    Releases the images of a snapshot returned by read_snapshot
+    '''
+    for (slave_id, blocks) in slaves:
+        for (block_type, starting_address, size, image) in blocks:
+            image.release()
@@ -0,0 +1,72 @@
+# -*- coding: utf_8 -*-
+'''
+Slave templates
+
+A template is the register image of a slave, captured once. Slaves made from
+it get CowBlocks sharing the pages of the image, and only copy a page when
+it is first written, so a fleet of identical devices costs the memory of
+one image plus the pages each device changed. Coils and discrete inputs are
+copied outright, their bitmaps are 16 times smaller than registers.
+'''
+from array import array
+
+from modbus_tk import defines
+
+from .registers import PAGE_SIZE, SWAP_BYTES
+
+
+class TemplateError(Exception):
+    pass
+
+
+class TemplateBlock(object):
+    '''
+    Image of a block of a template: big endian register values, or bits
+    packed 8 per byte for coils and discrete inputs
+    '''
+
+    def __init__(self, block_name, block_type, starting_address, size, image):
+        self.block_name = block_name
+        self.block_type = block_type
+        self.starting_address = starting_address
+        self.size = size
+        self.image = bytes(image)
+        # typecode -> pages of the image shared by the blocks made from it
+        self._pages = {}
+
+    def is_bits(self):
+        return self.block_type in (defines.COILS, defines.DISCRETE_INPUTS)
+
+    def get_pages(self, unsigned=True):
+        '''
+        Returns the image as arrays of PAGE_SIZE registers
+        '''
+        typecode = 'H' if unsigned else 'h'
+        pages = self._pages.get(typecode)
+        if pages is None:
+            values = array(typecode)
+            values.frombytes(self.image)
+            if SWAP_BYTES:
+                values.byteswap()
+            pages = tuple(values[start:start + PAGE_SIZE] for start in range(0, self.size, PAGE_SIZE))
+            self._pages[typecode] = pages
+        return pages
+
+
+class SlaveTemplate(object):
+    '''
+    Named register image of a slave. counts is the entry of the slave in
+    ModbusSim.slaves, giving the layout the image was taken from
+    '''
+
+    def __init__(self, name, slave, counts):
+        self.name = name
+        self.counts = counts
+        self.blocks = []
+        for (block_name, (block_type, starting_address)) in sorted(slave._blocks.items()):
+            size = slave.get_block(block_name).size
+            self.blocks.append(TemplateBlock(block_name, block_type, starting_address, size,
+                                             slave.get_bytes(block_name, starting_address, size)))
+
+    def get_info(self):
+        return dict(self.counts, registers=sum(block.size for block in self.blocks if not block.is_bits()))
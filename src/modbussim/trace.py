@@ -0,0 +1,107 @@
+# -*- coding: utf_8 -*-
+'''
+Frame tracing
+
+Raw request and response frames are copied with a timestamp into a ring
+buffer allocated once at startup. Nothing is formatted until the trace is
+read, so recording a frame costs a slice copy and a few array stores.
+'''
+import itertools
+import threading
+import time
+
+from array import array
+
+
+REQUEST = 0
+RESPONSE = 1
+
+DIRECTIONS = {
+    REQUEST: 'request',
+    RESPONSE: 'response',
+}
+
+# largest Modbus TCP ADU; RTU frames are at most 256 bytes
+MAX_FRAME = 260
+
+
+class FrameTrace(object):
+    '''
+    Ring buffer of the last size frames. Every frame gets its sequence
+    number from an atomic counter and writes its own slot, and readers skip
+    slots rewritten while they were being read. Only the count of recorded
+    frames is updated under a lock, so that lines recording concurrently
+    never move it backwards
+    '''
+
+    def __init__(self, size=4096, max_frame=MAX_FRAME):
+        self.size = size
+        self.max_frame = max_frame
+        self._frames = bytearray(size * max_frame)
+        self._lengths = array('H', bytes(2 * size))
+        self._times = array('d', bytes(8 * size))
+        self._directions = array('B', bytes(size))
+        # sequence number of the frame held by every slot, -1 when empty
+        self._sequences = array('q', [-1]) * size
+        self._counter = itertools.count()
+        self._recorded = 0
+        self._recorded_lock = threading.Lock()
+
+    def record(self, direction, frame):
+        sequence = next(self._counter)
+        slot = sequence % self.size
+        length = len(frame)
+        offset = slot * self.max_frame
+        self._sequences[slot] = -1
+        if length <= self.max_frame:
+            self._frames[offset:offset + length] = frame
+        else:
+            self._frames[offset:offset + self.max_frame] = frame[:self.max_frame]
+        self._lengths[slot] = length
+        self._times[slot] = time.time()
+        self._directions[slot] = direction
+        self._sequences[slot] = sequence
+        with self._recorded_lock:
+            self._recorded = max(self._recorded, sequence + 1)
+
+    def clear(self):
+        for slot in range(self.size):
+            self._sequences[slot] = -1
+
+    def read(self, since=0, limit=None):
+        '''
+        Returns (frames, next) where frames are the recorded frames with a
+        sequence number of at least since, oldest first, as dicts, and next
+        is the since to pass to only get newer frames on the next read
+        '''
+        recorded = self._recorded
+        first = max(since, recorded - self.size, 0)
+        if limit is not None:
+            first = max(first, recorded - limit)
+        frames = []
+        for sequence in range(first, recorded):
+            slot = sequence % self.size
+            offset = slot * self.max_frame
+            length = self._lengths[slot]
+            frame = bytes(self._frames[offset:offset + min(length, self.max_frame)])
+            timestamp = self._times[slot]
+            direction = self._directions[slot]
+            if self._sequences[slot] != sequence:
+                # cleared, or overwritten by a newer frame while reading
+                continue
+            frames.append({
+                'sequence': sequence,
+                'time': timestamp,
+                'direction': DIRECTIONS[direction],
+                'length': length,
+                'truncated': length > self.max_frame,
+                'frame': ' '.join('%02x' % (byte, ) for byte in frame),
+            })
+        return (frames, recorded)
+
+    def get_stats(self):
+        return {
+            'size': self.size,
+            'max_frame': self.max_frame,
+            'recorded': self._recorded,
+        }
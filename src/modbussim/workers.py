@@ -0,0 +1,265 @@
+# -*- coding: utf_8 -*-
+'''
+Multi-process Modbus TCP serving
+
+A WorkerPool takes the place of the Modbus server of a simulator: it runs
+a number of worker processes, each one serving Modbus TCP from its own
+AsyncTcpServer, with the registers of every slave in a RegisterFile shared
+by the simulator process and all workers.
+
+Workers either all listen on the same port with SO_REUSEPORT, the kernel
+spreading the connections between them, or each listens on its own port
+(port + worker index) for its own range of slave ids.
+
+The simulator process owns the slave layout. Adding or removing slaves and
+blocks is mirrored into the workers through one queue per worker; register
+values need no messages as they live in the shared memory.
+'''
+import logging
+import multiprocessing
+import threading
+
+from modbus_tk.exceptions import DuplicatedKeyError, MissingKeyError, OutOfModbusBlockError
+from modbus_tk.modbus import Server
+
+from .asynctcp import AsyncTcpServer
+from .modbussim import MAX_SLAVE_ID, ModbusDatabank
+from .playback import Playback, PlaybackError
+from .shared import RegisterFile, SharedSlave, make_shared_block
+
+
+LOGGER = logging.getLogger(__name__)
+
+SHARDINGS = ('reuseport', 'ports')
+
+
+class SharedDatabank(ModbusDatabank):
+    '''
+    Databank of the simulator process: slaves keep their registers in
+    register_file and every layout change is passed to listener
+    '''
+
+    def __init__(self, register_file, error_on_missing_slave=True, **kwargs):
+        ModbusDatabank.__init__(self, error_on_missing_slave, slave_class=SharedSlave, **kwargs)
+        self.register_file = register_file
+        self.listener = None
+
+    def _notify(self, message):
+        if self.listener is not None:
+            self.listener(message)
+
+    def add_slave(self, slave_id, unsigned=True, memory=None):
+        slave = ModbusDatabank.add_slave(self, slave_id, unsigned, memory)
+        slave.register_file = self.register_file
+        slave.listener = self._notify
+        self._notify(('add_slave', slave_id, unsigned))
+        return slave
+
+    def remove_slave(self, slave_id):
+        self.get_slave(slave_id).remove_all_blocks()
+        ModbusDatabank.remove_slave(self, slave_id)
+        self._notify(('remove_slave', slave_id))
+
+    def remove_all_slaves(self):
+        with self._lock:
+            slave_ids = list(self._slaves)
+        for slave_id in slave_ids:
+            self.remove_slave(slave_id)
+
+    def declare_slave(self, slave_id, materialize, entry=None):
+        # the workers can only serve slaves laid out in the register file,
+        # which only this process can do, so declared slaves are made now
+        with self._lock:
+            if slave_id in self._slaves:
+                raise DuplicatedKeyError('Slave %s already exists' % (slave_id,))
+            materialize(slave_id)
+
+    def add_playback(self, name, playback):
+        ModbusDatabank.add_playback(self, name, playback)
+        self._notify(('add_playback', name, playback.get_spec()))
+
+    def remove_playback(self, name):
+        ModbusDatabank.remove_playback(self, name)
+        self._notify(('remove_playback', name))
+
+    def layout(self):
+        '''
+        Returns the messages rebuilding the current slaves and blocks
+        '''
+        with self._lock:
+            slaves = list(self._slaves.items())
+            messages = [('add_playback', name, playback.get_spec()) for (name, playback) in self.playbacks.items()]
+        for (slave_id, slave) in slaves:
+            messages.append(('add_slave', slave_id, slave.unsigned))
+            with slave.data_lock:
+                for (block_name, (block_type, starting_address)) in list(slave._blocks.items()):
+                    block = slave._get_block(block_name)
+                    messages.append(('add_block', slave_id, block_name, block_type, starting_address,
+                                     block.size, getattr(block, 'offset', None)))
+                for ((block_type, address), generator) in slave.generators.items():
+                    messages.append(('set_generator', slave_id, block_type, address, generator.spec))
+        return messages
+
+    def close(self):
+        '''
+        Drops every slave, releasing their views on the register file, and
+        removes the register file
+        '''
+        ModbusDatabank.close(self)
+        self.listener = None
+        self.remove_all_slaves()
+        self.register_file.close()
+
+
+def apply_layout(databank, register_file, message):
+    '''
+    Applies a layout message in a worker. Messages may repeat what the
+    worker already has, or refer to a slave it does not know anymore
+    '''
+    kind = message[0]
+    try:
+        if kind == 'add_slave':
+            (slave_id, unsigned) = message[1:]
+            databank.add_slave(slave_id, unsigned).register_file = register_file
+        elif kind == 'remove_slave':
+            databank.remove_slave(message[1])
+        elif kind == 'add_block':
+            (slave_id, block_name, block_type, starting_address, size, offset) = message[1:]
+            slave = databank.get_slave(slave_id)
+            block = None
+            if offset is not None:
+                block = make_shared_block(register_file, block_type, starting_address, size, block_name,
+                                          slave.unsigned, offset)
+            slave.add_block(block_name, block_type, starting_address, size, block)
+        elif kind == 'remove_block':
+            databank.get_slave(message[1]).remove_block(message[2])
+        elif kind == 'set_generator':
+            (slave_id, block_type, address, spec) = message[1:]
+            databank.get_slave(slave_id).set_generator(address, databank.make_generator(spec), block_type)
+        elif kind == 'remove_generator':
+            (slave_id, block_type, address) = message[1:]
+            databank.get_slave(slave_id).remove_generator(address, block_type)
+        elif kind == 'add_playback':
+            databank.add_playback(message[1], Playback(**message[2]))
+        elif kind == 'remove_playback':
+            databank.remove_playback(message[1])
+    except (DuplicatedKeyError, MissingKeyError, OutOfModbusBlockError, PlaybackError) as e:
+        LOGGER.debug('Skipped %s: %s' % (kind, e))
+
+
+def run_worker(address, port, register_file_name, queue, ready):
+    '''
+    Body of a worker process: serves Modbus TCP and applies the layout
+    messages of the simulator process until told to stop
+    '''
+    register_file = RegisterFile(name=register_file_name)
+    databank = ModbusDatabank(slave_class=SharedSlave)
+    server = AsyncTcpServer(address=address, port=port, databank=databank, reuse_port=True)
+    server.start()
+    ready.set()
+    try:
+        while True:
+            message = queue.get()
+            if message[0] == 'stop':
+                break
+            apply_layout(databank, register_file, message)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        databank.close()
+        for slave_id in list(databank._slaves):
+            databank.get_slave(slave_id).remove_all_blocks()
+        register_file.close()
+
+
+class WorkerPool(Server):
+    '''
+    Modbus server running worker processes over a SharedDatabank
+    '''
+
+    def __init__(self, address, port, databank, workers=2, sharding='reuseport', start_timeout=30.0):
+        Server.__init__(self, databank)
+        databank.listener = self.notify
+        self._sa = (address, port)
+        self.workers = workers
+        self.sharding = sharding
+        self._start_timeout = start_timeout
+        self._context = multiprocessing.get_context('spawn')
+        # (process, queue) of every worker
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def get_port(self, index):
+        return self._sa[1] if self.sharding == 'reuseport' else self._sa[1] + index
+
+    def get_worker_index(self, slave_id):
+        '''
+        Returns the index of the worker serving slave_id, None if they all do
+        '''
+        if self.sharding == 'reuseport':
+            return None
+        return min(max(slave_id - 1, 0) * self.workers // MAX_SLAVE_ID, self.workers - 1)
+
+    def _owns(self, index, message):
+        if message[0] in ('add_playback', 'remove_playback'):
+            return True
+        owner = self.get_worker_index(message[1])
+        return owner is None or owner == index
+
+    def notify(self, message):
+        with self._lock:
+            for (index, (process, queue)) in enumerate(self._processes):
+                if self._owns(index, message):
+                    queue.put(message)
+
+    def start(self):
+        events = []
+        with self._lock:
+            register_file_name = self._databank.register_file.name
+            for index in range(self.workers):
+                queue = self._context.Queue()
+                ready = self._context.Event()
+                process = self._context.Process(target=run_worker, name='modbus-worker-%d' % (index, ),
+                                                args=(self._sa[0], self.get_port(index), register_file_name,
+                                                      queue, ready),
+                                                daemon=True)
+                process.start()
+                for message in self._databank.layout():
+                    if self._owns(index, message):
+                        queue.put(message)
+                self._processes.append((process, queue))
+                events.append(ready)
+        for (index, ready) in enumerate(events):
+            if not ready.wait(self._start_timeout):
+                LOGGER.error('Modbus worker %d did not start' % (index, ))
+        LOGGER.info('%d modbus workers serving %s:%s (%s)' % (self.workers, self._sa[0], self._sa[1], self.sharding))
+
+    def stop(self):
+        with self._lock:
+            processes = self._processes
+            self._processes = []
+        for (process, queue) in processes:
+            queue.put(('stop', ))
+        for (process, queue) in processes:
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def get_workers(self):
+        workers = []
+        with self._lock:
+            for (index, (process, queue)) in enumerate(self._processes):
+                worker = {
+                    'index': index,
+                    'pid': process.pid,
+                    'alive': process.is_alive(),
+                    'port': self.get_port(index),
+                }
+                if self.sharding == 'ports':
+                    slave_ids = [slave_id for slave_id in range(1, MAX_SLAVE_ID + 1)
+                                 if self.get_worker_index(slave_id) == index]
+                    worker['slave_ids'] = [slave_ids[0], slave_ids[-1]] if slave_ids else []
+                workers.append(worker)
+        return workers
@@ -5,17 +5,32 @@
 # This class is the interface implementation
 ##############################################
 import argparse
+import io
+import json
 import logging
 import os
 import signal
-import struct
+import sys
+import time
 
 from threading import Thread
 
 from configparser import ConfigParser
 
-from modbussim.modbussim import ModbusSim
-from flask import Flask, request, jsonify, redirect
+from modbus_tk.exceptions import DuplicatedKeyError, InvalidArgumentError, MissingKeyError, OutOfModbusBlockError
+
+from modbussim.feed import FeedError, Subscription, parse_ranges
+from modbussim.generators import GeneratorError
+from modbussim.journal import Journal
+from modbussim.lines import format_slave_ids, parse_line, parse_slave_ids
+from modbussim.metrics import Metrics
+from modbussim.modbussim import BLOCK_TYPES, ModbusSim, ModbusSimError
+from modbussim.modbusutil import ConversionError, registers_to_bytes
+from modbussim.playback import PlaybackError
+from modbussim.points import PointError, get_struct
+from modbussim.snapshot import SnapshotError
+from modbussim.templates import TemplateError
+from flask import Flask, Response, g, request, jsonify, redirect
 from flasgger import Swagger
 app = Flask(__name__)
 app.config['SWAGGER'] = {
@@ -43,12 +58,26 @@ LOGGER.setLevel(logging.DEBUG)
 
 thread = None
 sim = None
+journal = None
+metrics = Metrics()
+
+# changed ranges a change feed subscriber may fall behind by before it is
+# told to read its registers again, and seconds between keepalives
+FEED_MAX_RANGES = 1024
+FEED_KEEPALIVE = 15.0
+
+PARITIES = {
+    'none': 'N',
+    'even': 'E',
+    'odd': 'O',
+}
 
 
 def init_sim():
     global thread
     global config
     global sim
+    global journal
 
     # in debug mode, this will get called twice. run only after reload
     if config.getboolean('server', 'debug') \
@@ -64,24 +93,110 @@ def init_sim():
                                              'input_register_count')
         holding_register_count = config.getint('slave-config',
                                                'holding_register_count')
+        coil_count = config.getint('slave-config', 'coil_count', fallback=0)
+        discrete_input_count = config.getint('slave-config', 'discrete_input_count', fallback=0)
+        segments = json.loads(config.get('slave-config', 'segments', fallback='[]'))
 
         if config.mode == 'rtu':
             sim = ModbusSim(mode=config.mode,
                             port=config.serial,
-                            baud=config.rtu_baud)
+                            baud=config.rtu_baud,
+                            lines=config.lines,
+                            register_store=config.register_store,
+                            response_cache=config.response_cache,
+                            broadcast_thread=config.broadcast_thread,
+                            trace_size=config.trace_size,
+                            verbose=config.verbose,
+                            metrics=metrics)
         else:
             sim = ModbusSim(mode=config.mode,
                             port=config.port,
-                            hostname=config.hostname)
+                            hostname=config.hostname,
+                            tcp_engine=config.tcp_engine,
+                            workers=config.workers,
+                            sharding=config.sharding,
+                            shm_size=config.shm_size,
+                            register_store=config.register_store,
+                            response_cache=config.response_cache,
+                            broadcast_thread=config.broadcast_thread,
+                            trace_size=config.trace_size,
+                            verbose=config.verbose,
+                            metrics=metrics)
 
-        for slave_id_offset in range(0, slave_count):
-            sim.add_slave(slave_start_id + slave_id_offset,
-                          input_register_count, holding_register_count)
+        if config.has_section('templates'):
+            add_config_templates(config.items('templates'))
+        template = config.get('slaves', 'template', fallback=None)
+
+        if config.journal:
+            journal = Journal(sim, config.journal, config.journal_commit, config.journal_compact)
+        if journal is not None and journal.exists():
+            journal.restore()
+        elif config.snapshot and os.path.exists(config.snapshot):
+            sim.load_snapshot_file(config.snapshot)
+        elif config.lazy:
+            layout = {'template': template} if template else {
+                'input_register_count': input_register_count,
+                'holding_register_count': holding_register_count,
+                'coil_count': coil_count,
+                'discrete_input_count': discrete_input_count,
+                'segments': segments}
+            sim.declare_slaves(range(slave_start_id, slave_start_id + slave_count), layout)
+        elif template:
+            for slave_id_offset in range(0, slave_count):
+                sim.add_slave_from_template(slave_start_id + slave_id_offset, template)
+        else:
+            for slave_id_offset in range(0, slave_count):
+                sim.add_slave(slave_start_id + slave_id_offset,
+                              input_register_count, holding_register_count,
+                              coil_count, discrete_input_count, segments)
+        if config.has_section('generators'):
+            add_config_generators(config.items('generators'))
+        if journal is not None:
+            journal.start()
     if thread is None:
         thread = Thread(target=sim.start)
         thread.start()
 
 
+def add_config_templates(items):
+    '''
+    Adds the templates of the [templates] configuration section, whose keys
+    are template names and values paths of slave dumps
+    '''
+    for (name, path) in items:
+        try:
+            with open(path) as f:
+                sim.add_template(name, json.load(f))
+        except (OSError, ValueError, TemplateError) as e:
+            LOGGER.error("Skipped template %s: %s" % (name, e))
+
+
+def add_config_generators(items):
+    '''
+    Animates the registers of the [generators] configuration section, whose
+    keys are slave_id:address and values JSON generator specs
+    '''
+    for (key, value) in items:
+        try:
+            (slave_id, address) = (int(part) for part in key.split(':'))
+            sim.server.get_slave(slave_id).set_generator(address, json.loads(value))
+        except (ValueError, GeneratorError, OutOfModbusBlockError, InvalidArgumentError) as e:
+            LOGGER.error("Skipped generator %s: %s" % (key, e))
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_timing(response):
+    if 'start' in g:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_route(rule, request.method, response.status_code, time.perf_counter() - g.start)
+    return response
+
+
 @app.route('/')
 def index():
     return "200 OK"
@@ -100,6 +215,8 @@ def slaves():
         tags:
           - modbus-sim
         summary: "Returns Slaves of known to Modbus Sim"
+        description: "Slaves declared but not made yet are listed with the layout they will be made with
+            and declared set to true."
         produces:
           - "application/json"
         responses:
@@ -127,6 +244,14 @@ def slaves():
                                         type: integer
                                         description: "Metric Value"
                                         example: 9999
+                                    coil_count:
+                                        type: integer
+                                        description: "Metric Value"
+                                        example: 16
+                                    discrete_input_count:
+                                        type: integer
+                                        description: "Metric Value"
+                                        example: 16
                         "2":
                             type: object
                             description: "Slave Configuration"
@@ -142,10 +267,142 @@ def slaves():
                                         type: integer
                                         description: "Metric Value"
                                         example: 9999
+                                    coil_count:
+                                        type: integer
+                                        description: "Metric Value"
+                                        example: 16
+                                    discrete_input_count:
+                                        type: integer
+                                        description: "Metric Value"
+                                        example: 16
+
+    """
+    global sim
+    return jsonify(sim.get_slaves())
+
 
+@app.route('/slaves/provision')
+def provisioning():
+    """
+        ModbusSim API / Provisioned Slaves
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the ids of the slaves made and of the ones declared, which are made when a request first reaches them"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: Slave ids as lists such as 1-16,20
+            schema:
+                type: object
+                properties:
+                    materialized:
+                        type: string
+                        example: "1-3"
+                    declared:
+                        type: string
+                        example: "4-247"
+    """
+    global sim
+    provisioning = sim.get_provisioning()
+    return jsonify(dict((key, format_slave_ids(slave_ids)) for (key, slave_ids) in provisioning.items()))
+
+
+@app.route('/slaves/provision', methods=['POST'])
+def provision():
+    """
+        ModbusSim API / Provision Slaves
+        ---
+        tags:
+          - modbus-sim
+        summary: "Creates and destroys slaves by range in one call"
+        description: "Slaves are destroyed first, then every create entry adds the slaves of its ids
+            with the layout it gives: the counts and segments of /slave/add, or a template. Unless
+            lazy is false, slaves are only declared and made when a Modbus or REST request first
+            reaches them."
+        consumes:
+          - "application/json"
+        parameters:
+          - name: "Provisioning"
+            in: body
+            required: true
+            schema:
+                type: object
+                properties:
+                    destroy:
+                        type: string
+                        description: "Ids of the slaves to remove"
+                        example: "100-120"
+                    create:
+                        type: array
+                        items:
+                            type: object
+                            required:
+                                - slave_ids
+                            properties:
+                                slave_ids:
+                                    type: string
+                                    example: "1-247"
+                                template:
+                                    type: string
+                                    example: "inverter"
+                                holding_register_count:
+                                    type: integer
+                                    example: 100
+                    lazy:
+                        type: boolean
+                        example: true
+        responses:
+            200:
+                description: The number of slaves destroyed, declared and created, and the ids of the
+                    slaves which could not be made at once as failed
+            400:
+                description: Invalid request, nothing was created by the failing entry
     """
     global sim
-    return jsonify(sim.slaves)
+    request_json = request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+        return "Body must be a JSON object", 400
+    lazy = request_json.get('lazy', True)
+    if not isinstance(lazy, bool):
+        return "lazy must be true or false", 400
+    result = {'destroyed': 0, 'declared': 0, 'created': 0}
+    failed = set()
+    try:
+        if 'destroy' in request_json:
+            result['destroyed'] = sim.remove_slaves(get_slave_ids(request_json['destroy']))
+        for entry in request_json.get('create', []):
+            if not isinstance(entry, dict) or 'slave_ids' not in entry:
+                raise ModbusSimError('Create entries need slave_ids')
+            slave_ids = get_slave_ids(entry['slave_ids'])
+            layout = dict((key, value) for (key, value) in entry.items() if key != 'slave_ids')
+            sim.declare_slaves(slave_ids, layout)
+            if lazy:
+                result['declared'] += len(slave_ids)
+            else:
+                for slave_id in slave_ids:
+                    if sim.has_slave(slave_id):
+                        result['created'] += 1
+                    else:
+                        failed.add(slave_id)
+    except (ModbusSimError, TemplateError) as e:
+        return jsonify(dict(result, error=str(e))), 400
+    if failed:
+        # these stay declared, and are tried again when first reached
+        result['failed'] = format_slave_ids(failed)
+    return jsonify(result)
+
+
+def get_slave_ids(slave_ids):
+    '''
+    Returns the set of slave ids of a list such as 1-16,20 or of a JSON array
+    '''
+    if isinstance(slave_ids, list):
+        if not all(isinstance(slave_id, int) for slave_id in slave_ids):
+            raise ModbusSimError('Slave ids must be integers')
+        return set(slave_ids)
+    return parse_slave_ids(str(slave_ids))
 
 
 @app.route('/dump')
@@ -190,9 +447,29 @@ def dump():
                                 type: array
                                 description: "Array of Holding Register Values"
                                 example: [ 0, 0, 0 ]
+                            coil_count:
+                                type: integer
+                                description: "Metric Value"
+                                example: 3
+                            coils:
+                                type: array
+                                description: "Array of Coil Values"
+                                example: [ 1, 0, 1 ]
+                            discrete_input_count:
+                                type: integer
+                                description: "Metric Value"
+                                example: 3
+                            discrete_inputs:
+                                type: array
+                                description: "Array of Discrete Input Values"
+                                example: [ 1, 0, 1 ]
+                            segments:
+                                type: array
+                                description: "Type, address, count and values of the segments of a sparse register map"
+                                example: [ {"type": "holding_registers", "address": 40121, "count": 2, "values": [ 1, 2 ]} ]
     """
     global sim
-    return sim.dump_simulator()
+    return Response(sim.iter_dump_simulator(), mimetype='application/json')
 
 
 @app.route('/dump', methods=['POST'])
@@ -239,17 +516,374 @@ def load_dump():
                                 type: array
                                 description: "Array of Holding Register Values"
                                 example: [ 1, 2, 3 ]
+                            coil_count:
+                                type: integer
+                                description: "Metric Value"
+                                example: 3
+                            coils:
+                                type: array
+                                description: "Array of Coil Values"
+                                example: [ 1, 0, 1 ]
+                            discrete_input_count:
+                                type: integer
+                                description: "Metric Value"
+                                example: 3
+                            discrete_inputs:
+                                type: array
+                                description: "Array of Discrete Input Values"
+                                example: [ 1, 0, 1 ]
+                            segments:
+                                type: array
+                                description: "Type, address, count and values of the segments of a sparse register map"
+                                example: [ {"type": "holding_registers", "address": 40121, "count": 2, "values": [ 1, 2 ]} ]
         responses:
             200:
                 description: The result of the load operation
     """
     global sim
     if request.headers['Content-Type'] == 'application/json':
-        sim.load_simulator_dump(request.json)
+        try:
+            sim.load_simulator_dump(request.json)
+        except (ModbusSimError, ConversionError, PointError) as e:
+            return str(e), 400
         return "Finished loading dump", 200
     return "Unsupported Media Type", 415
 
 
+@app.route('/snapshot')
+def snapshot():
+    """
+        ModbusSim API / Download Snapshot
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns a binary snapshot of all slaves known to Modbus Sim"
+        produces:
+          - "application/octet-stream"
+        responses:
+          200:
+            description: The binary snapshot
+    """
+    global sim
+    stream = io.BytesIO()
+    sim.write_snapshot(stream)
+    return Response(stream.getvalue(), mimetype='application/octet-stream')
+
+
+@app.route('/snapshot', methods=['POST'])
+def load_snapshot():
+    """
+        ModbusSim API / Upload Snapshot
+        ---
+        tags:
+          - modbus-sim
+        summary: "Replaces all slaves with the ones of a binary snapshot"
+        consumes:
+          - "application/octet-stream"
+        parameters:
+          - name: "Snapshot"
+            in: body
+            required: true
+            description: The binary snapshot as returned by GET /snapshot
+        responses:
+            200:
+                description: The result of the load operation
+            400:
+                description: The snapshot is invalid, the slaves are left as they were
+    """
+    global sim
+    if request.headers['Content-Type'] == 'application/octet-stream':
+        try:
+            sim.load_snapshot(request.get_data())
+        except (SnapshotError, ModbusSimError) as e:
+            return str(e), 400
+        return "Finished loading snapshot", 200
+    return "Unsupported Media Type", 415
+
+
+@app.route('/snapshot/save', methods=['POST'])
+def save_snapshot_file():
+    """
+        ModbusSim API / Save Snapshot
+        ---
+        tags:
+          - modbus-sim
+        summary: "Writes a binary snapshot of all slaves to the --snapshot file"
+        responses:
+            200:
+                description: The result of the save operation
+    """
+    global sim
+    if not config.snapshot:
+        return "No snapshot file configured, start the server with --snapshot", 400
+    sim.save_snapshot(config.snapshot)
+    return "Saved snapshot to " + config.snapshot, 200
+
+
+@app.route('/snapshot/load', methods=['POST'])
+def load_snapshot_file():
+    """
+        ModbusSim API / Load Snapshot
+        ---
+        tags:
+          - modbus-sim
+        summary: "Replaces all slaves with the ones of the --snapshot file"
+        responses:
+            200:
+                description: The result of the load operation
+            400:
+                description: The snapshot is invalid, the slaves are left as they were
+    """
+    global sim
+    if not config.snapshot:
+        return "No snapshot file configured, start the server with --snapshot", 400
+    if not os.path.exists(config.snapshot):
+        return "Snapshot file " + config.snapshot + " does not exist", 400
+    try:
+        sim.load_snapshot_file(config.snapshot)
+    except (SnapshotError, ModbusSimError) as e:
+        return str(e), 400
+    return "Finished loading snapshot", 200
+
+
+@app.route('/journal')
+def journal_stats():
+    """
+        ModbusSim API / Journal
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the statistics of the journal of register writes"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: Records, bytes and commits written, snapshots taken, the current sequence number, and whether the journal failed with its last error
+          404:
+            description: Journaling is disabled
+    """
+    global journal
+    if journal is None:
+        return "Journaling is disabled, start the server with --journal", 404
+    return jsonify(journal.get_stats())
+
+
+@app.route('/cache')
+def cache_stats():
+    """
+        ModbusSim API / Response Cache Statistics
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the read response cache statistics of every slave"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: Entries, hits, misses, invalidations, hit rate and mean hit/miss time in microseconds by slave id
+    """
+    global sim
+    return jsonify(sim.server.get_db().get_cache_stats())
+
+
+@app.route('/workers')
+def workers():
+    """
+        ModbusSim API / Workers
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the processes serving modbus TCP when running with --workers"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: Index, pid, port and served slave ids of every worker
+    """
+    global sim
+    get_workers = getattr(sim.server, 'get_workers', None)
+    return jsonify(get_workers() if get_workers else [])
+
+
+@app.route('/lines')
+def lines():
+    """
+        ModbusSim API / Serial Lines
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the serial lines served when running with --line"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: Port, device to open for virtual ports, baud rate, parity and slave ids of every line
+    """
+    global sim
+    get_lines = getattr(sim.server, 'get_lines', None)
+    return jsonify(get_lines() if get_lines else [])
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+        ModbusSim API / Metrics
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns request counters and latency histograms in the Prometheus text format"
+        description: "Modbus requests by transport, slave id and function code, and REST requests by route, method and status"
+        produces:
+          - "text/plain"
+        responses:
+          200:
+            description: The metrics
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/trace')
+def trace():
+    """
+        ModbusSim API / Frame Trace
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the last raw modbus frames received and sent, oldest first"
+        produces:
+          - "application/json"
+        parameters:
+          - name: "since"
+            in: query
+            type: integer
+            required: false
+            description: Only return frames with at least this sequence number, pass the next value of the previous read to follow the trace
+          - name: "limit"
+            in: query
+            type: integer
+            required: false
+            description: Only return the newest limit frames
+        responses:
+          200:
+            description: The frames with their sequence number, timestamp, direction and hex bytes, and the next sequence number
+          404:
+            description: Tracing is disabled
+    """
+    global sim
+    frame_trace = sim.server.get_db().trace
+    if frame_trace is None:
+        return "Tracing is disabled, start the server with --trace_size", 404
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    frames, next_sequence = frame_trace.read(since, limit)
+    return jsonify({'frames': frames, 'next': next_sequence})
+
+
+@app.route('/trace/clear', methods=['POST'])
+def clear_trace():
+    """
+        ModbusSim API / Clear Frame Trace
+        ---
+        tags:
+          - modbus-sim
+        summary: "Drops every frame recorded so far"
+        responses:
+            200:
+                description: The result of the clear operation
+    """
+    global sim
+    frame_trace = sim.server.get_db().trace
+    if frame_trace is None:
+        return "Tracing is disabled, start the server with --trace_size", 404
+    frame_trace.clear()
+    return "Cleared trace", 200
+
+
+@app.route('/events')
+def events():
+    """
+        ModbusSim API / Register Change Feed
+        ---
+        tags:
+          - modbus-sim
+        summary: "Streams register and bit changes as server-sent events"
+        description: "Every write from a Modbus master, a broadcast or the API within the
+            subscribed slaves, addresses and block types is sent as a change event holding
+            the current values of the changed range. Writes made while the previous event was
+            sent are coalesced, a register written many times is sent once. A subscriber too
+            slow to keep up gets an overflow event and should read its registers again. In
+            workers mode only the writes of the API are seen."
+        produces:
+          - "text/event-stream"
+        parameters:
+          - name: "slave_ids"
+            in: query
+            type: string
+            required: false
+            description: Slave ids such as 1-16,20, all slaves by default
+          - name: "addresses"
+            in: query
+            type: string
+            required: false
+            description: Address ranges such as 40001-40100,30001, all addresses by default
+          - name: "types"
+            in: query
+            type: string
+            required: false
+            description: Comma separated block types (holding_registers, input_registers, coils, discrete_inputs), all by default
+          - name: "interval"
+            in: query
+            type: number
+            required: false
+            description: Seconds to gather writes before sending them, 0.1 by default
+        responses:
+          200:
+            description: "The stream of change events, such as
+                event: change / data: {\"slave_id\": 1, \"type\": \"holding_registers\", \"address\": 40001, \"count\": 2, \"values\": [1, 2]}"
+          400:
+            description: Invalid subscription
+    """
+    global sim
+    try:
+        slave_ids = parse_slave_ids(request.args['slave_ids']) if 'slave_ids' in request.args else None
+        ranges = parse_ranges(request.args['addresses']) if 'addresses' in request.args else None
+        block_types = None
+        if 'types' in request.args:
+            block_types = set(BLOCK_TYPES[name] for name in request.args['types'].split(','))
+    except KeyError as e:
+        return "Unknown block type %s" % (e.args[0], ), 400
+    except (ModbusSimError, FeedError) as e:
+        return str(e), 400
+    try:
+        interval = float(request.args.get('interval', 0.1))
+    except ValueError:
+        interval = -1.0
+    # checked before the stream starts, nan and inf fail the test too
+    if not 0 <= interval < float('inf'):
+        return "Interval must be a number of seconds, zero or more", 400
+    change_feed = sim.server.get_db().change_feed
+    subscription = change_feed.subscribe(Subscription(slave_ids, ranges, block_types, FEED_MAX_RANGES))
+
+    def stream():
+        try:
+            yield ': subscribed\n\n'
+            while True:
+                if not subscription.wait(FEED_KEEPALIVE):
+                    yield ': keepalive\n\n'
+                    continue
+                # writes coming in the meantime go out with these
+                time.sleep(interval)
+                (changes, overflowed) = subscription.changes()
+                if overflowed:
+                    yield 'event: overflow\ndata: {}\n\n'
+                for event in sim.get_change_events(changes):
+                    yield 'event: change\ndata: %s\n\n' % (json.dumps(event), )
+        finally:
+            change_feed.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/slave/<int:slave_id>')
 @app.route('/modbus/slave/<int:slave_id>')
 def slave(slave_id):
@@ -285,9 +919,17 @@ def slave(slave_id):
                             type: integer
                             description: "Metric Value"
                             example: 9999
+                        coil_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 16
+                        discrete_input_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 16
     """
     global sim
-    if slave_id in sim.slaves:
+    if sim.has_slave(slave_id):
         return jsonify(sim.slaves[slave_id])
     else:
         return "Slave ID: " + str(slave_id) + " does not exist.", 400
@@ -300,7 +942,8 @@ def add_slave_by_id(slave_id):
         ---
         tags:
           - modbus-sim
-        summary: "Add slave with holding and/or input registers"
+        summary: "Add slave with holding and/or input registers, and optionally coils, discrete inputs and
+            the segments of a sparse register map"
         consumes:
           - "application/json"
         parameters:
@@ -316,29 +959,60 @@ def add_slave_by_id(slave_id):
             schema:
                 id: SlaveConfiguration
                 type: object
-                required:
-                    - "input_register_count"
-                    - "holding_register_count"
                 schema:
                     properties:
                         input_register_count:
                             type: integer
                             description: "Metric Value"
                             example: 9999
+                        coil_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 16
+                        discrete_input_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 16
                         holding_register_count:
                             type: integer
                             description: "Metric Value"
                             example: 9999
+                        segments:
+                            type: array
+                            description: "Sparse register map: blocks of the given type (input_registers,
+                                holding_registers, coils or discrete_inputs), address and count. Addresses
+                                in no block answer with an illegal data address exception"
+                            example: [ {"type": "holding_registers", "address": 40000, "count": 69},
+                                       {"type": "holding_registers", "address": 40121, "count": 50} ]
+                        template:
+                            type: string
+                            description: "Name of a template to make the slave from, instead of counts
+                                or segments"
+                            example: "inverter"
         responses:
             200:
                 description: The result of the load operation
     """
     global sim
     if request.headers['Content-Type'] == 'application/json':
-        if 'input_register_count' in request.json and 'holding_register_count' in request.json:
-            sim.server.add_slave(slave_id, request.json['input_register_count'], request.json['holding_register_count'])
+        request_json = request.json
+        if 'template' in request_json:
+            try:
+                sim.add_slave_from_template(slave_id, request_json['template'])
+            except (ModbusSimError, TemplateError) as e:
+                return str(e), 400
+            return "Success"
+        if ('input_register_count' in request_json and 'holding_register_count' in request_json) \
+                or 'segments' in request_json:
+            try:
+                sim.add_slave(slave_id, request_json.get('input_register_count', 0),
+                              request_json.get('holding_register_count', 0),
+                              request_json.get('coil_count', 0), request_json.get('discrete_input_count', 0),
+                              request_json.get('segments'))
+            except ModbusSimError as e:
+                return str(e), 400
             return "Success"
-        return "Must include input_register_count and holding_register_count", 415
+        return "Must include input_register_count and holding_register_count, segments or template", 415
     return "Unsupported Media Type", 415
 
 
@@ -388,13 +1062,36 @@ def load_slave_dump(slave_id):
                             type: array
                             description: "Array of Holding Register Values"
                             example: [ 1, 2, 3 ]
+                        coil_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 3
+                        coils:
+                            type: array
+                            description: "Array of Coil Values"
+                            example: [ 1, 0, 1 ]
+                        discrete_input_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 3
+                        discrete_inputs:
+                            type: array
+                            description: "Array of Discrete Input Values"
+                            example: [ 1, 0, 1 ]
+                        segments:
+                            type: array
+                            description: "Type, address, count and values of the segments of a sparse register map"
+                            example: [ {"type": "holding_registers", "address": 40121, "count": 2, "values": [ 1, 2 ]} ]
         responses:
             200:
                 description: The result of the load operation
     """
     global sim
     if request.headers['Content-Type'] == 'application/json':
-        sim.load_slave_dump(request.json)
+        try:
+            sim.load_slave_dump(request.json)
+        except (ModbusSimError, ConversionError, PointError) as e:
+            return str(e), 400
         return "Finished loading dump", 200
     return "Unsupported Media Type", 415
 
@@ -446,11 +1143,33 @@ def slave_dump(slave_id):
                             type: array
                             description: "Array of Holding Register Values"
                             example: [ 1, 2, 3 ]
-    """
-    global sim
-    return sim.dump_slave(slave_id)
-
-
+                        coil_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 3
+                        coils:
+                            type: array
+                            description: "Array of Coil Values"
+                            example: [ 1, 0, 1 ]
+                        discrete_input_count:
+                            type: integer
+                            description: "Metric Value"
+                            example: 3
+                        discrete_inputs:
+                            type: array
+                            description: "Array of Discrete Input Values"
+                            example: [ 1, 0, 1 ]
+                        segments:
+                            type: array
+                            description: "Type, address, count and values of the segments of a sparse register map"
+                            example: [ {"type": "holding_registers", "address": 40121, "count": 2, "values": [ 1, 2 ]} ]
+    """
+    global sim
+    if not sim.has_slave(slave_id):
+        return sim.dump_slave(slave_id)
+    return Response(sim.iter_dump_slave(slave_id), mimetype='application/json')
+
+
 @app.route('/slave/<int:slave_id>/<int:address>')
 def slave_read(slave_id, address):
     """
@@ -458,9 +1177,11 @@ def slave_read(slave_id, address):
         ---
         tags:
           - modbus-sim
-        summary: "Returns register value"
+        summary: "Returns register value, or a range of register values when count is given"
         produces:
           - "text/plain"
+          - "application/json"
+          - "application/octet-stream"
         parameters:
           - name: slave_id
             in: path
@@ -472,6 +1193,15 @@ def slave_read(slave_id, address):
             type: integer
             required: true
             description: the register address
+          - name: count
+            in: query
+            type: integer
+            required: false
+            description: number of registers to read starting at address.
+                Returned as a JSON array, or as big endian 16 bit values
+                when the request accepts application/octet-stream. Coils and
+                discrete inputs are returned as 0 or 1, or packed 8 per byte
+                least significant bit first as in a Modbus response.
         responses:
           200:
             description: The register value
@@ -481,18 +1211,32 @@ def slave_read(slave_id, address):
                 example: 10
     """
     global sim
-    if slave_id not in sim.slaves:
+    if not sim.has_slave(slave_id):
         return "Slave does not exist", 400
     slave = sim.server.get_slave(slave_id)
-    if 30000 <= address < 30001 + config.getint('slave-config', 'input_register_count'):
-        block = 'input_registers'
-    elif 40000 <= address < 40001 + config.getint('slave-config', 'holding_register_count'):
-        block = 'holding_registers'
-    else:
+
+    count = request.args.get('count')
+    if count is None:
+        block = get_register_block(slave_id, address)
+        if block is None:
+            return "Address is out of range", 400
+        value = slave.get_values(block, address, 1)
+        return str(value[0])
+
+    try:
+        count = int(count)
+    except ValueError:
+        return "Could not convert count to integer", 400
+    if count <= 0:
+        return "Count must be positive", 400
+    block = get_register_block(slave_id, address, count)
+    if block is None:
         return "Address is out of range", 400
-    value = slave.get_values(block, address, 1)
 
-    return str(value[0])
+    if request.accept_mimetypes.best_match(['application/json', 'application/octet-stream']) \
+            == 'application/octet-stream':
+        return Response(slave.get_bytes(block, address, count), mimetype='application/octet-stream')
+    return jsonify(list(slave.get_values(block, address, count)))
 
 
 @app.route('/slave/<int:slave_id>/<int:address>', methods=['POST'])
@@ -503,10 +1247,11 @@ def slave_write(slave_id, address):
         ---
         tags:
           - modbus-sim
-        summary: "Returns register value"
+        summary: "Writes a register value, or a range of register values"
         consumes:
           - "application/json"
           - "text/plain"
+          - "application/octet-stream"
         parameters:
           - name: slave_id
             in: path
@@ -518,10 +1263,22 @@ def slave_write(slave_id, address):
             type: integer
             required: true
             description: the register address
+          - name: count
+            in: query
+            type: integer
+            required: false
+            description: number of registers written, checked against the body.
+                The number of bits of an octet stream written to coils or
+                discrete inputs, all of its bits by default.
           - name: "Register"
             in: body
             required: false
             description: The register value as a "string" (if so use 'text/plain') or as JSON.
+                A JSON array or an 'application/octet-stream' body of big endian
+                16 bit values writes consecutive registers starting at address.
+                Coils and discrete inputs take 0 or 1, or in an octet stream
+                count bits packed 8 per byte as in a Modbus write multiple
+                coils request.
             schema:
                 id: RegisterJSON
                 type: object
@@ -546,15 +1303,42 @@ def slave_write(slave_id, address):
                 description: The result of the write operation
     """
     global sim
-    if slave_id not in sim.slaves:
+    if not sim.has_slave(slave_id):
         return "Slave does not exist", 400
     slave = sim.server.get_slave(slave_id)
 
-    if 30000 <= address < 30001 + config.getint('slave-config', 'input_register_count'):
-        block = 'input_registers'
-    elif 40000 <= address < 40001 + config.getint('slave-config', 'holding_register_count'):
-        block = 'holding_registers'
-    else:
+    if request.headers['Content-Type'] == 'application/octet-stream':
+        data = request.get_data()
+        block = get_register_block(slave_id, address)
+        if block is not None and slave.is_bit_block(block):
+            # bits packed 8 per byte, as many as count says or all of them
+            try:
+                count = int(request.args.get('count', 8 * len(data)))
+            except ValueError:
+                return "Could not convert count to integer", 400
+            if count <= 0 or len(data) != (count + 7) // 8:
+                return "Body must hold count bits packed 8 per byte", 400
+            return write_register_range(slave_id, address, count,
+                                        lambda block: slave.set_bytes(block, address, data, count))
+        if len(data) == 0 or len(data) % 2:
+            return "Body must hold big endian 16 bit values", 400
+        return write_register_range(slave_id, address, len(data) // 2,
+                                    lambda block: slave.set_bytes(block, address, data))
+
+    if request.headers['Content-Type'] == 'application/json' and isinstance(request.get_json(), list):
+        values = request.get_json()
+        try:
+            data = registers_to_bytes(values)
+        except ConversionError:
+            data = b''
+        if len(data) == 0:
+            return "Body must be a non empty array of 16 bit unsigned integers", 400
+        return write_register_range(slave_id, address, len(values),
+                                    lambda block: slave.set_values(block, address, values)
+                                    if slave.is_bit_block(block) else slave.set_bytes(block, address, data))
+
+    block = get_register_block(slave_id, address)
+    if block is None:
         return "Address is out of range", 400
 
     if request.headers['Content-Type'] == 'text/plain':
@@ -581,6 +1365,678 @@ def slave_write(slave_id, address):
     return "Success", 200
 
 
+@app.route('/slave/<int:slave_id>/generators')
+def slave_generators(slave_id):
+    """
+        ModbusSim API / Register Generators
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the generators animating registers of a slave"
+        produces:
+          - "application/json"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+        responses:
+          200:
+            description: The generator specs with their block type and address
+    """
+    global sim
+    if not sim.has_slave(slave_id):
+        return "Slave does not exist", 400
+    return jsonify(sim.server.get_slave(slave_id).get_generators())
+
+
+@app.route('/slave/<int:slave_id>/<int:address>/generator', methods=['POST'])
+def set_slave_generator(slave_id, address):
+    """
+        ModbusSim API / Animate Register
+        ---
+        tags:
+          - modbus-sim
+        summary: "Animates a register with a generator evaluated whenever it is read"
+        consumes:
+          - "application/json"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+          - name: address
+            in: path
+            type: integer
+            required: true
+            description: the register address
+          - name: "Generator"
+            in: body
+            required: true
+            description: The generator spec. type is one of sine, ramp, step,
+                noise, random_walk or counter, the other keys are its parameters
+                with times in seconds.
+            schema:
+                type: object
+                required:
+                - type
+                properties:
+                    type:
+                        type: string
+                        example: "sine"
+                example: {"type": "sine", "amplitude": 500, "offset": 1000, "period": 60}
+        responses:
+            200:
+                description: The register is animated
+            400:
+                description: Invalid spec, or the address is not a register
+    """
+    global sim
+    if not sim.has_slave(slave_id):
+        return "Slave does not exist", 400
+    spec = request.get_json(silent=True)
+    if spec is None:
+        return "Body must be a JSON generator spec", 400
+    try:
+        sim.server.get_slave(slave_id).set_generator(address, spec)
+    except (GeneratorError, OutOfModbusBlockError, InvalidArgumentError) as e:
+        return str(e), 400
+    return "Success", 200
+
+
+@app.route('/slave/<int:slave_id>/<int:address>/generator', methods=['DELETE'])
+def remove_slave_generator(slave_id, address):
+    """
+        ModbusSim API / Stop Animating Register
+        ---
+        tags:
+          - modbus-sim
+        summary: "Removes the generator of a register, which keeps its last value"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+          - name: address
+            in: path
+            type: integer
+            required: true
+            description: the register address
+        responses:
+            200:
+                description: The generator was removed
+            404:
+                description: The register is not animated
+    """
+    global sim
+    if not sim.has_slave(slave_id):
+        return "Slave does not exist", 400
+    if not sim.server.get_slave(slave_id).remove_generator(address):
+        return "Register is not animated", 404
+    return "Success", 200
+
+
+@app.route('/slave/<int:slave_id>/points')
+def slave_points(slave_id):
+    """
+        ModbusSim API / Typed Points
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the typed points defined on the registers of a slave"
+        produces:
+          - "application/json"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+        responses:
+          200:
+            description: The point definitions sorted by address
+    """
+    global sim
+    if not sim.has_slave(slave_id):
+        return "Slave does not exist", 400
+    return jsonify(sim.get_points(slave_id))
+
+
+@app.route('/slave/<int:slave_id>/points', methods=['POST'])
+def set_slave_points(slave_id):
+    """
+        ModbusSim API / Define Typed Points
+        ---
+        tags:
+          - modbus-sim
+        summary: "Replaces the typed points of a slave"
+        consumes:
+          - "application/json"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+          - name: "Points"
+            in: body
+            required: true
+            description: The points, which may not overlap. format is a struct
+                format without byte order (h, H, i, I, q, Q, e, f, d or Ns for
+                a string of N bytes), the engineering value is the raw one times
+                scale, and byte_order and word_order are big or little.
+            schema:
+                type: array
+                items:
+                    type: object
+                    required:
+                    - name
+                    - address
+                    properties:
+                        name:
+                            type: string
+                            example: "power"
+                        address:
+                            type: integer
+                            example: 40001
+                        format:
+                            type: string
+                            example: "f"
+                        scale:
+                            type: number
+                            example: 1
+                        byte_order:
+                            type: string
+                            example: "big"
+                        word_order:
+                            type: string
+                            example: "little"
+        responses:
+            200:
+                description: The points are defined
+            400:
+                description: Invalid points
+    """
+    global sim
+    specs = request.get_json(silent=True)
+    if specs is None:
+        return "Body must be a JSON array of points", 400
+    try:
+        sim.set_points(slave_id, specs)
+    except PointError as e:
+        return str(e), 400
+    return "Success", 200
+
+
+@app.route('/slave/<int:slave_id>/points/values')
+def slave_point_values(slave_id):
+    """
+        ModbusSim API / Read Typed Points
+        ---
+        tags:
+          - modbus-sim
+        summary: "Reads typed points of a slave by name in one call"
+        produces:
+          - "application/json"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+          - name: names
+            in: query
+            type: string
+            required: false
+            description: comma separated names of the points to read, all of them by default
+        responses:
+          200:
+            description: The engineering values by point name
+          400:
+            description: Unknown point, or its registers are out of range
+    """
+    global sim
+    names = request.args.get('names')
+    try:
+        return jsonify(sim.read_points(slave_id, names.split(',') if names else None))
+    except PointError as e:
+        return str(e), 400
+
+
+@app.route('/slave/<int:slave_id>/points/values', methods=['POST'])
+def write_slave_point_values(slave_id):
+    """
+        ModbusSim API / Write Typed Points
+        ---
+        tags:
+          - modbus-sim
+        summary: "Writes typed points of a slave by name in one call"
+        description: "Every value is encoded before any register is written, so an invalid
+            value leaves all the points unchanged."
+        consumes:
+          - "application/json"
+        parameters:
+          - name: slave_id
+            in: path
+            type: integer
+            required: true
+            description: the slave ID
+          - name: "Values"
+            in: body
+            required: true
+            schema:
+                type: object
+                example: {"power": 1234.5, "serial": "SN-0042"}
+        responses:
+            200:
+                description: The points were written
+            400:
+                description: Unknown point or invalid value, nothing was written
+    """
+    global sim
+    try:
+        sim.write_points(slave_id, request.get_json(silent=True))
+    except PointError as e:
+        return str(e), 400
+    return "Success", 200
+
+
+@app.route('/templates')
+def templates():
+    """
+        ModbusSim API / Slave Templates
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the slave templates by name"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: The layout of every template and the number of registers of its image
+    """
+    global sim
+    return jsonify(sim.get_templates())
+
+
+@app.route('/template/<name>', methods=['POST'])
+def add_template(name):
+    """
+        ModbusSim API / Add Slave Template
+        ---
+        tags:
+          - modbus-sim
+        summary: "Adds a named slave template new slaves can be made from"
+        description: "The template takes the layout and register values of a slave dump, or of an
+            existing slave given by slave_id. Slaves made from it share its register image and only
+            copy the pages they write."
+        consumes:
+          - "application/json"
+        parameters:
+          - name: name
+            in: path
+            type: string
+            required: true
+            description: the template name
+          - name: slave_id
+            in: query
+            type: integer
+            required: false
+            description: the slave to take the template from, instead of a body
+          - name: "SlaveConfiguration"
+            in: body
+            required: false
+            description: A slave dump, as returned by /slave/dump/<slave_id>
+        responses:
+            200:
+                description: The template was added
+            400:
+                description: Invalid dump, unknown slave or existing template
+    """
+    global sim
+    slave_id = request.args.get('slave_id', type=int)
+    if slave_id is not None:
+        if not sim.has_slave(slave_id):
+            return "Slave does not exist", 400
+        dump = json.loads(sim.dump_slave(slave_id))
+    else:
+        dump = request.get_json(silent=True)
+        if not isinstance(dump, dict):
+            return "Body must be a JSON slave dump", 400
+    try:
+        sim.add_template(name, dump)
+    except TemplateError as e:
+        return str(e), 400
+    return "Success", 200
+
+
+@app.route('/template/<name>', methods=['DELETE'])
+def remove_template(name):
+    """
+        ModbusSim API / Remove Slave Template
+        ---
+        tags:
+          - modbus-sim
+        summary: "Removes a slave template, slaves made from it are kept"
+        parameters:
+          - name: name
+            in: path
+            type: string
+            required: true
+            description: the template name
+        responses:
+            200:
+                description: The template was removed
+            404:
+                description: There is no such template
+    """
+    global sim
+    try:
+        sim.remove_template(name)
+    except TemplateError as e:
+        return str(e), 404
+    return "Success", 200
+
+
+@app.route('/playbacks')
+def playbacks():
+    """
+        ModbusSim API / Playbacks
+        ---
+        tags:
+          - modbus-sim
+        summary: "Returns the recordings being played into registers"
+        produces:
+          - "application/json"
+        responses:
+          200:
+            description: Path, speed, looping, time range and current playback time of every playback by name
+    """
+    global sim
+    return jsonify(sim.get_playbacks())
+
+
+@app.route('/playback', methods=['POST'])
+def add_playback():
+    """
+        ModbusSim API / Start Playback
+        ---
+        tags:
+          - modbus-sim
+        summary: "Plays a recording into registers"
+        description: "A CSV recording has a header row naming its columns and the time in seconds
+            in its first column. A binary recording is made of records packed with record_format,
+            the time first. Registers return the row in effect when they are read."
+        consumes:
+          - "application/json"
+        parameters:
+          - name: "Playback"
+            in: body
+            required: true
+            schema:
+                type: object
+                required:
+                - name
+                - path
+                - mappings
+                properties:
+                    name:
+                        type: string
+                        example: "feeder"
+                    path:
+                        type: string
+                        example: "recordings/feeder.csv"
+                    speed:
+                        type: number
+                        example: 1.0
+                    loop:
+                        type: boolean
+                        example: true
+                    record_format:
+                        type: string
+                        description: struct format of the records of a binary recording
+                        example: "<dff"
+                    columns:
+                        type: array
+                        description: names of the columns of a binary recording
+                        items:
+                            type: string
+                    mappings:
+                        type: array
+                        items:
+                            type: object
+                            properties:
+                                slave_id:
+                                    type: integer
+                                    example: 10
+                                address:
+                                    type: integer
+                                    example: 40001
+                                column:
+                                    type: string
+                                    example: "voltage"
+                                format:
+                                    type: string
+                                    description: Data format in struct notation
+                                    example: ">f"
+        responses:
+            200:
+                description: The recording is playing
+            400:
+                description: Invalid recording or mappings
+    """
+    global sim
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or 'name' not in body or 'path' not in body:
+        return "Body must be a JSON object with a name, a path and mappings", 400
+    try:
+        sim.add_playback(body['name'], body['path'], body.get('mappings', []), body.get('speed', 1.0),
+                         body.get('loop', False), body.get('record_format'), body.get('columns'))
+    except (PlaybackError, DuplicatedKeyError, OutOfModbusBlockError, InvalidArgumentError) as e:
+        return str(e), 400
+    return "Success", 200
+
+
+@app.route('/playback/<name>', methods=['DELETE'])
+def remove_playback(name):
+    """
+        ModbusSim API / Stop Playback
+        ---
+        tags:
+          - modbus-sim
+        summary: "Stops a playback, its registers keep their last values"
+        parameters:
+          - name: name
+            in: path
+            type: string
+            required: true
+            description: the playback name
+        responses:
+            200:
+                description: The playback was stopped
+            404:
+                description: There is no such playback
+    """
+    global sim
+    try:
+        sim.remove_playback(name)
+    except MissingKeyError as e:
+        return str(e), 404
+    return "Success", 200
+
+
+def write_register_range(slave_id, address, count, write):
+    '''
+    Checks a range write against the count query argument and the register
+    blocks, then writes it with write(block_name)
+    '''
+    if 'count' in request.args and request.args.get('count') != str(count):
+        return "Body holds %d registers but count is %s" % (count, request.args.get('count')), 400
+    block = get_register_block(slave_id, address, count)
+    if block is None:
+        return "Address is out of range", 400
+    write(block)
+    return "Success", 200
+
+
+def get_register_block(slave_id, address, count=1):
+    '''
+    Returns the name of the block of the slave holding count registers from
+    address on, None if they are out of range
+    '''
+    route = sim.server.get_slave(slave_id).route(address, count)
+    return route[0] if route else None
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+        ModbusSim API / Batch Register Operations
+        ---
+        tags:
+          - modbus-sim
+        summary: "Reads and writes register ranges of several slaves in one request"
+        consumes:
+          - "application/json"
+        produces:
+          - "application/json"
+        parameters:
+          - name: "Batch"
+            in: body
+            required: true
+            description: The operations, applied in order. When atomic is true
+                either every operation is applied or none is, and Modbus
+                requests never see a partially applied batch.
+            schema:
+                id: Batch
+                type: object
+                required:
+                    - operations
+                properties:
+                    atomic:
+                        type: boolean
+                        example: true
+                    operations:
+                        type: array
+                        items:
+                            id: BatchOperation
+                            type: object
+                            required:
+                                - op
+                                - slave_id
+                                - address
+                            properties:
+                                op:
+                                    type: string
+                                    enum: [ "read", "write" ]
+                                slave_id:
+                                    type: integer
+                                    example: 10
+                                address:
+                                    type: integer
+                                    example: 40001
+                                count:
+                                    type: integer
+                                    description: "Number of registers to read"
+                                    example: 4
+                                values:
+                                    type: array
+                                    description: "Register values to write"
+                                    example: [ 1, 2, 3, 4 ]
+        responses:
+            200:
+                description: One result per operation, with the values of reads
+            400:
+                description: An atomic batch was rejected, nothing was applied
+    """
+    global sim
+    if request.headers['Content-Type'] != 'application/json':
+        return "Unsupported Media Type", 415
+    request_json = request.get_json()
+    if not isinstance(request_json, dict) or not isinstance(request_json.get('operations'), list):
+        return "Required 'operations' list not found.", 400
+    atomic = bool(request_json.get('atomic', False))
+    operations = [parse_batch_operation(operation) for operation in request_json['operations']]
+
+    if atomic:
+        if any('error' in operation for operation in operations):
+            return jsonify({'results': [{'status': 'error', 'error': operation['error']} if 'error' in operation
+                                        else {'status': 'skipped'} for operation in operations]}), 400
+        with sim.locked_slaves([operation['slave_id'] for operation in operations]):
+            undo = []
+            try:
+                results = [apply_batch_operation(operation, undo) for operation in operations]
+            except Exception as e:
+                for (slave, block, address, values) in reversed(undo):
+                    slave.set_values(block, address, values)
+                LOGGER.error('Atomic batch rolled back: %s', e)
+                return jsonify({'results': [], 'error': str(e)}), 400
+    else:
+        results = []
+        for operation in operations:
+            try:
+                results.append(apply_batch_operation(operation))
+            except Exception as e:
+                results.append({'status': 'error', 'error': str(e)})
+    return jsonify({'results': results})
+
+
+def parse_batch_operation(operation):
+    '''
+    Validates a batch operation and resolves its register block. Returns
+    the operation with a 'block' key, or a dict with an 'error' key
+    '''
+    if not isinstance(operation, dict):
+        return {'error': 'Operation must be an object'}
+    op = operation.get('op')
+    slave_id = operation.get('slave_id')
+    address = operation.get('address')
+    if op not in ('read', 'write'):
+        return {'error': "Unknown op %s, must be 'read' or 'write'" % (op,)}
+    if not isinstance(slave_id, int) or not sim.has_slave(slave_id):
+        return {'error': 'Slave %s does not exist' % (slave_id,)}
+    if not isinstance(address, int):
+        return {'error': 'Address must be an integer'}
+
+    if op == 'read':
+        count = operation.get('count', 1)
+        if not isinstance(count, int) or count <= 0:
+            return {'error': 'Count must be a positive integer'}
+    else:
+        values = operation.get('values')
+        if not isinstance(values, list) or len(values) == 0 \
+                or not all(isinstance(v, int) and 0 <= v <= 0xffff for v in values):
+            return {'error': 'Values must be a non empty array of 16 bit unsigned integers'}
+        count = len(values)
+
+    block = get_register_block(slave_id, address, count)
+    if block is None:
+        return {'error': 'Address %d count %d is out of range' % (address, count)}
+    return dict(operation, block=block, count=count)
+
+
+def apply_batch_operation(operation, undo=None):
+    '''
+    Applies a parsed batch operation. When undo is a list, the previous
+    values of a write are appended to it so the write can be rolled back
+    '''
+    if 'error' in operation:
+        return {'status': 'error', 'error': operation['error']}
+    slave = sim.server.get_slave(operation['slave_id'])
+    block = operation['block']
+    address = operation['address']
+    if operation['op'] == 'read':
+        values = slave.get_values(block, address, operation['count'])
+        return {'status': 'ok', 'values': list(values)}
+    if undo is not None:
+        undo.append((slave, block, address, list(slave.get_values(block, address, operation['count']))))
+    slave.set_values(block, address, operation['values'])
+    return {'status': 'ok'}
+
+
 def convert_to_shorts_tuple(value, fmt, size):
     '''
     Returns an array of short size(16 bits) values for a given register format/size
@@ -590,8 +2046,8 @@ def convert_to_shorts_tuple(value, fmt, size):
         value = value.ljust(size * 2, '\0')
         # encode to bytes as struct only accepts bytes for strings
         value = value.encode()
-    packed_data = struct.pack(fmt, value)
-    shorts_tuple = struct.unpack('>' + str(size) + 'H', packed_data)
+    packed_data = get_struct(fmt).pack(value)
+    shorts_tuple = get_struct('>%dH' % (size, )).unpack(packed_data)
     if len(shorts_tuple) == 1:
         return shorts_tuple[0]
     return shorts_tuple
@@ -610,11 +2066,26 @@ def parse_args():
     parser.add_argument('-P', '--port', type=int, default=5005, help='IP port if using TCP mode')
     parser.add_argument('-p', '--rtu_parity', type=str, choices=('even','odd','none'), default='none', help='modbus over serial parity')
     parser.add_argument('-b', '--rtu_baud', type=int, default=9600, help='baud rate for modbus')
+    parser.add_argument('-e', '--tcp_engine', type=str, choices=('select', 'asyncio'), default='select', help='modbus TCP server implementation')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='number of processes serving modbus TCP with registers in shared memory, 0 serves from this process')
+    parser.add_argument('--sharding', type=str, choices=('reuseport', 'ports'), default='reuseport', help='workers share the port, or each one serves a range of slave ids on port + worker index')
+    parser.add_argument('--shm_size', type=int, default=64, help='MB of shared memory for the registers of the workers')
+    parser.add_argument('-r', '--register_store', type=str, choices=('list', 'array'), default='list', help='storage used for register blocks')
+    parser.add_argument('-C', '--response_cache', action='store_true', help='cache encoded responses of repeated register reads')
+    parser.add_argument('-B', '--broadcast_thread', action='store_true', help='apply broadcast writes off the modbus server thread')
+    parser.add_argument('-T', '--trace_size', type=int, default=0, help='number of raw modbus frames kept for GET /trace, 0 disables tracing')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every modbus frame at debug level')
     parser.add_argument('-t', '--hostname', type=str, default='127.0.0.1', help='IP hostname or address')
     parser.add_argument('-c', '--config', type=str, default='../config/test.conf', help='modbus simulator configuration file')
     parser.add_argument('-s', '--serial', type=str, default='/dev/ttyS0', help='serial port on which to sim')
+    parser.add_argument('-L', '--line', type=str, action='append', default=[], help='serial line as PORT or PORT@SLAVE_IDS (e.g. /dev/ttyUSB0@1-16), repeat to serve several lines; port pty creates a virtual serial port')
     parser.add_argument('-n', '--slave_count', type=int, default=0, help='Number of slave devices to create')
     parser.add_argument('-d', '--slave_start_id', type=int, default=1, help='Starting id of slaves')
+    parser.add_argument('-S', '--snapshot', type=str, default=None, help='binary snapshot file to boot from and save to')
+    parser.add_argument('-z', '--lazy', action='store_true', help='only make each configured slave when a request first reaches it')
+    parser.add_argument('-J', '--journal', type=str, default=None, help='directory of a journal of register writes to restore from and keep up to date')
+    parser.add_argument('--journal_commit', type=float, default=0.05, help='seconds between commits of the journal')
+    parser.add_argument('--journal_compact', type=float, default=60.0, help='seconds between incremental snapshots of the journal')
 
     args = parser.parse_args()
     return args
@@ -635,8 +2106,27 @@ def load_config(args):
         config.rtu_baud = args.rtu_baud
     if args.hostname:
         config.hostname = args.hostname
+    if args.tcp_engine:
+        config.tcp_engine = args.tcp_engine
+    if args.register_store:
+        config.register_store = args.register_store
+    config.snapshot = args.snapshot
+    config.lazy = args.lazy or config.getboolean('slaves', 'lazy', fallback=False)
+    config.journal = args.journal
+    config.journal_commit = args.journal_commit
+    config.journal_compact = args.journal_compact
+    config.response_cache = args.response_cache
+    config.workers = args.workers
+    config.sharding = args.sharding
+    config.shm_size = args.shm_size
+    config.broadcast_thread = args.broadcast_thread
+    config.trace_size = args.trace_size
+    config.verbose = args.verbose
     if args.serial:
         config.serial = args.serial
+    config.lines = [parse_line(line) for line in args.line]
+    for line in config.lines:
+        line['parity'] = PARITIES[config.rtu_parity]
 
     if not 'slaves' in config.sections():
         config.add_section('slaves')
@@ -659,9 +2149,11 @@ def load_config(args):
 
 def signal_handler(signm, frame):
     global sim
-    log.info('Got Signal %s, exiting now.' % (str(signm)))
+    LOGGER.info('Got Signal %s, exiting now.' % (str(signm)))
+    if journal is not None:
+        journal.close()
     sim.close()
-    log.info('Stopped modbus simulator.')
+    LOGGER.info('Stopped modbus simulator.')
     sys.exit(0)
 
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures broadcast (slave id 0) writes against the number of slaves.
+
+Compares handing the request pdu to every slave (what modbus_tk does),
+the decoded broadcast applied to every slave's block, and the same with
+the broadcast thread, where only the time the server thread is blocked
+counts. Modbus unit ids stop at 247, so that is the largest fleet.
+
+    python3 test/bench_broadcast.py --slaves 10 100 247 --store list array
+'''
+import argparse
+import logging
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim.modbussim import ModbusSim  # noqa: E402
+
+
+def requests(quantity, count):
+    pdus = []
+    for i in range(count):
+        values = [(i + j) & 0xffff for j in range(quantity)]
+        pdus.append(struct.pack('>BHHB%dH' % quantity, 16, 40001, quantity, 2 * quantity, *values))
+    return pdus
+
+
+def per_slave(databank, pdus):
+    slaves = list(databank._slaves.values())
+    start = time.perf_counter()
+    for pdu in pdus:
+        for slave in slaves:
+            slave.handle_request(pdu, broadcast=True)
+    return time.perf_counter() - start
+
+
+def decoded(databank, pdus):
+    start = time.perf_counter()
+    for pdu in pdus:
+        databank.handle_broadcast(pdu)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slaves', type=int, nargs='+', default=[10, 100, 247])
+    parser.add_argument('--store', nargs='+', choices=('list', 'array'), default=['list', 'array'])
+    parser.add_argument('--registers', type=int, default=1000, help='holding registers per slave')
+    parser.add_argument('--quantity', type=int, default=123, help='registers written by each broadcast')
+    parser.add_argument('--broadcasts', type=int, default=200)
+    parser.add_argument('--port', type=int, default=15023)
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    pdus = requests(args.quantity, args.broadcasts)
+    print('%6s %8s %16s %16s %16s %16s' % ('store', 'slaves', 'per slave us', 'decoded us',
+                                           'threaded us', 'thread total us'))
+    for store in args.store:
+        for slave_count in args.slaves:
+            timings = []
+            for broadcast_thread in (False, True):
+                sim = ModbusSim(mode='tcp', port=args.port, hostname='127.0.0.1', register_store=store,
+                                broadcast_thread=broadcast_thread)
+                try:
+                    sim.slaves = {}
+                    for slave_id in range(1, slave_count + 1):
+                        sim.add_slave(slave_id, 0, args.registers)
+                    databank = sim.server.get_db()
+                    if broadcast_thread:
+                        start = time.perf_counter()
+                        timings.append(decoded(databank, pdus))
+                        databank.close()
+                        timings.append(time.perf_counter() - start)
+                    else:
+                        timings.append(per_slave(databank, pdus))
+                        timings.append(decoded(databank, pdus))
+                finally:
+                    sim.rpc.rpc_server.server_close()
+            print('%6s %8d %16.1f %16.1f %16.1f %16.1f' % ((store, slave_count) +
+                                                           tuple(1e6 * t / args.broadcasts for t in timings)))
+
+
+if __name__ == '__main__':
+    main()
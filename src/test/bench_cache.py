@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures the read response cache on a polling workload.
+
+Every slave is polled with the same handful of FC3/FC4 requests, like a
+SCADA master would, and a fraction of the requests are FC6 writes that
+invalidate part of the cached responses. The requests go straight to the
+slaves' handle_request so the numbers exclude the transport.
+
+    python3 test/bench_cache.py --slaves 10 --requests 100000 --write-ratio 0.01
+'''
+import argparse
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim.modbussim import ModbusSim  # noqa: E402
+
+
+def polls(register_count, quantity):
+    requests = []
+    for (function_code, start) in ((3, 40001), (4, 30001)):
+        for address in range(start, start + register_count - quantity + 1, quantity):
+            requests.append(struct.pack('>BHH', function_code, address, quantity))
+    return requests
+
+
+def run(sim, slave_count, requests, write_ratio, register_count, count):
+    slaves = [sim.server.get_slave(slave_id) for slave_id in range(1, slave_count + 1)]
+    rand = random.Random(0)
+    start = time.perf_counter()
+    for i in range(count):
+        slave = slaves[i % slave_count]
+        if rand.random() < write_ratio:
+            address = 40001 + rand.randrange(register_count)
+            slave.handle_request(struct.pack('>BHH', 6, address, i & 0xffff))
+        else:
+            slave.handle_request(requests[i % len(requests)])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slaves', type=int, default=10)
+    parser.add_argument('--registers', type=int, default=500, help='input and holding registers per slave')
+    parser.add_argument('--quantity', type=int, default=125, help='registers read by each poll')
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--write-ratio', type=float, nargs='+', default=[0.0, 0.01, 0.1])
+    parser.add_argument('--port', type=int, default=15022)
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    requests = polls(args.registers, args.quantity)
+    print('%8s %8s %12s %12s %10s' % ('writes', 'cache', 'req/s', 'us/req', 'hit rate'))
+    for write_ratio in args.write_ratio:
+        for cached in (False, True):
+            sim = ModbusSim(mode='tcp', port=args.port, hostname='127.0.0.1', response_cache=cached)
+            try:
+                sim.slaves = {}
+                for slave_id in range(1, args.slaves + 1):
+                    sim.add_slave(slave_id, args.registers, args.registers)
+                elapsed = run(sim, args.slaves, requests, write_ratio, args.registers, args.requests)
+                stats = sim.server.get_db().get_cache_stats().values()
+                hits = sum(stat['hits'] for stat in stats)
+                lookups = sum(stat['hits'] + stat['misses'] for stat in stats)
+                print('%8.3f %8s %12.0f %12.2f %10s' % (write_ratio, 'on' if cached else 'off',
+                                                        args.requests / elapsed, 1e6 * elapsed / args.requests,
+                                                        '%.3f' % (float(hits) / lookups) if lookups else '-'))
+            finally:
+                sim.rpc.rpc_server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures GET /dump style dumps against the number of slaves.
+
+For every slave count the streamed dump (ModbusSim.iter_dump_simulator) is
+consumed chunk by chunk and compared with building the whole document
+(ModbusSim.dump_simulator). Reports total time, time to the first chunk and
+peak traced memory of both.
+
+    python3 test/bench_dump.py --slaves 1 10 100 247 --registers 999
+'''
+import argparse
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim.modbussim import ModbusSim  # noqa: E402
+
+
+def populate(sim, slave_count, register_count):
+    for slave_id in list(sim.slaves):
+        sim.server.remove_slave(slave_id)
+    sim.slaves = {}
+    for slave_id in range(1, slave_count + 1):
+        sim.add_slave(slave_id, register_count, register_count)
+        sim.server.get_slave(slave_id).set_values('holding_registers', 40001,
+                                                  list(range(register_count)))
+
+
+def measure(fct):
+    tracemalloc.start()
+    start = time.perf_counter()
+    first = fct()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, first, peak
+
+
+def stream(sim):
+    first = None
+    start = time.perf_counter()
+    for chunk in sim.iter_dump_simulator():
+        if first is None:
+            first = time.perf_counter() - start
+    return first
+
+
+def whole(sim):
+    start = time.perf_counter()
+    sim.dump_simulator()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slaves', type=int, nargs='+', default=[1, 10, 100, 247])
+    parser.add_argument('--registers', type=int, default=999, help='input and holding registers per slave')
+    parser.add_argument('--port', type=int, default=15021)
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    sim = ModbusSim(mode='tcp', port=args.port, hostname='127.0.0.1')
+    try:
+        print('%8s %14s %14s %14s %14s %14s' % ('slaves', 'stream ms', 'first byte ms', 'stream peak KB',
+                                                'whole ms', 'whole peak KB'))
+        for slave_count in args.slaves:
+            populate(sim, slave_count, args.registers)
+            stream_time, first, stream_peak = measure(lambda: stream(sim))
+            whole_time, _, whole_peak = measure(lambda: whole(sim))
+            print('%8d %14.2f %14.3f %14.0f %14.2f %14.0f' % (slave_count, 1000 * stream_time, 1000 * first,
+                                                              stream_peak / 1024.0, 1000 * whole_time,
+                                                              whole_peak / 1024.0))
+    finally:
+        sim.rpc.rpc_server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures the cost of journaling register writes and the time to restore.
+
+Builds a fleet of slaves, then writes single registers at random addresses
+as fast as it can, without and with a journal, and reports the write rate
+and what the journal wrote. After an incremental compaction and more
+writes it drops every slave and restores them from the journal, as a
+restart would, and checks the registers came back.
+
+    python3 test/bench_journal.py --slaves 247 --registers 10000 --writes 200000
+'''
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim.journal import Journal  # noqa: E402
+from modbussim.modbussim import ModbusSim  # noqa: E402
+
+
+def write(sim, slave_count, register_count, writes, seed):
+    rng = random.Random(seed)
+    slaves = [sim.server.get_slave(slave_id) for slave_id in range(1, slave_count + 1)]
+    start = time.perf_counter()
+    for i in range(writes):
+        slaves[rng.randrange(slave_count)].set_values('holding_registers', 40001 + rng.randrange(register_count),
+                                                      [i % 65536])
+    return writes / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slaves', type=int, default=247)
+    parser.add_argument('--registers', type=int, default=10000, help='holding registers per slave')
+    parser.add_argument('--writes', type=int, default=200000)
+    parser.add_argument('--store', choices=['list', 'array'], default='array')
+    parser.add_argument('--port', type=int, default=15025)
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim', 'modbussim.journal'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    sim = ModbusSim(mode='tcp', port=args.port, hostname='127.0.0.1', register_store=args.store)
+    sim.slaves = {}
+    directory = tempfile.mkdtemp(prefix='bench_journal_')
+    try:
+        for slave_id in range(1, args.slaves + 1):
+            sim.add_slave(slave_id, 0, args.registers)
+        print('writes/s without journal %12.0f' % (write(sim, args.slaves, args.registers, args.writes, 1), ))
+
+        journal = Journal(sim, directory)
+        start = time.perf_counter()
+        journal.start()
+        print('base snapshot            %12.2f s' % (time.perf_counter() - start, ))
+        print('writes/s with journal    %12.0f' % (write(sim, args.slaves, args.registers, args.writes, 2), ))
+        journal._compact()
+        write(sim, args.slaves, args.registers, args.writes // 10, 3)
+        journal.close()
+        stats = journal.get_stats()
+        print('journal                  %12d records %d bytes %d commits' %
+              (stats['records'], stats['bytes'], stats['commits']))
+        print('directory                %12d bytes' %
+              (sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)), ))
+
+        expected = dict((slave_id, sim.server.get_slave(slave_id).get_bytes('holding_registers', 40001,
+                                                                            args.registers))
+                        for slave_id in sim.slaves)
+        sim.server.remove_all_slaves()
+        sim.slaves = {}
+        start = time.perf_counter()
+        Journal(sim, directory).restore()
+        print('restore                  %12.2f s' % (time.perf_counter() - start, ))
+        assert all(sim.server.get_slave(slave_id).get_bytes('holding_registers', 40001, args.registers) == image
+                   for (slave_id, image) in expected.items())
+    finally:
+        shutil.rmtree(directory)
+        sim.rpc.rpc_server.server_close()
+
+
+if __name__ == '__main__':
+    main()
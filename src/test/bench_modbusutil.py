@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures the bulk converters of modbusutil against the scalar ones.
+
+Converts a register image of --registers values both ways, one register at
+a time with number_to_bytes and bytes_to_number, then in one call with the
+bulk converters, on array and on NumPy when it is installed. Reports the
+best time of --repeat runs in microseconds.
+
+    python3 test/bench_modbusutil.py --registers 10000 --decimals 0 1
+'''
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim import modbusutil  # noqa: E402
+
+
+def scalar_encode(numbers, decimals):
+    return b''.join(modbusutil.number_to_bytes(number, decimals) for number in numbers)
+
+
+def scalar_decode(image, decimals):
+    return [modbusutil.bytes_to_number(image[i:i + 2], decimals) for i in range(0, len(image), 2)]
+
+
+def bulk_encode(numbers, decimals):
+    return modbusutil.numbers_to_bytes(numbers, decimals)
+
+
+def bulk_decode(image, decimals):
+    return modbusutil.bytes_to_numbers(image, decimals)
+
+
+def best(function, argument, decimals, repeat):
+    return min(timeit.repeat(lambda: function(argument, decimals), number=1, repeat=repeat)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--registers', type=int, default=10000)
+    parser.add_argument('--decimals', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    numpy = modbusutil.numpy
+    engines = [('array', None)] + ([('numpy', numpy)] if numpy is not None else [])
+    print('%8s %8s %12s %12s %12s %12s' % ('decimals', 'engine', 'encode us', 'scalar us', 'decode us', 'scalar us'))
+    try:
+        for decimals in args.decimals:
+            numbers = [(i % 6553) / float(10 ** decimals) for i in range(args.registers)]
+            image = scalar_encode(numbers, decimals)
+            scalar = (best(scalar_encode, numbers, decimals, args.repeat),
+                      best(scalar_decode, image, decimals, args.repeat))
+            for (engine, module) in engines:
+                modbusutil.numpy = module
+                assert bulk_encode(numbers, decimals) == image
+                assert bulk_decode(image, decimals) == scalar_decode(image, decimals)
+                print('%8d %8s %12.0f %12.0f %12.0f %12.0f' %
+                      (decimals, engine, best(bulk_encode, numbers, decimals, args.repeat), scalar[0],
+                       best(bulk_decode, image, decimals, args.repeat), scalar[1]))
+    finally:
+        modbusutil.numpy = numpy
+
+
+if __name__ == '__main__':
+    main()
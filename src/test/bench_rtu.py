@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures RTU transactions per second at the standard baud rates over a pty
+pair.
+
+Compares the length based frame reader with the modbus_tk reader and the
+timeouts ModbusSim used to set. A pty moves bytes at memory speed, so what
+is measured is the time each reader adds to a transaction. With --paced
+the requests are written a character at a time at the baud rate, as they
+arrive from a real line, and requests which got no answer are counted.
+
+    python3 test/bench_rtu.py --bauds 9600 19200 38400 57600 115200 --seconds 3
+    python3 test/bench_rtu.py --paced
+'''
+import argparse
+import logging
+import os
+import struct
+import sys
+import time
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbus_tk.modbus_rtu import RtuServer  # noqa: E402
+from modbus_tk.utils import calculate_crc, calculate_rtu_inter_char  # noqa: E402
+
+from loadgen import PtyPort  # noqa: E402
+from modbussim.modbussim import ModbusDatabank, ModbusRtuServer  # noqa: E402
+
+
+class LegacyRtuServer(ModbusRtuServer):
+    '''
+    The modbus_tk reader with the timeouts ModbusSim used to set
+    '''
+    _do_run = RtuServer._do_run
+
+    def __init__(self, serial, databank=None):
+        ModbusRtuServer.__init__(self, serial, databank)
+        # the timeouts were set on the port only, so _do_run restored the
+        # port timeout to 0 after the first byte
+        self._timeout = 0
+        t0 = calculate_rtu_inter_char(serial.baudrate)
+        serial.timeout = 2 * 10 * t0
+        serial.inter_byte_timeout = 2 * 1.5 * t0
+
+
+SERVERS = {
+    'legacy': LegacyRtuServer,
+    'framed': ModbusRtuServer,
+}
+
+
+def request(slave_id, count):
+    frame = struct.pack('>BBHH', slave_id, 3, 40001, count)
+    return frame + struct.pack('>H', calculate_crc(frame))
+
+
+def write_paced(client, frame, baud):
+    # spins, sleeping is too coarse for the character time at high baud rates
+    character_time = 11.0 / baud
+    start = time.perf_counter()
+    for (i, byte) in enumerate(frame):
+        while time.perf_counter() < start + i * character_time:
+            pass
+        client.write(frame[i:i + 1])
+
+
+def run(server_class, baud, seconds, count, paced):
+    master, slave = os.openpty()
+    port = serial.Serial(os.ttyname(slave), baudrate=baud)
+    databank = ModbusDatabank()
+    databank.add_slave(1).add_block('holding_registers', 3, 40001, 100)
+    server = server_class(port, databank)
+    server.start()
+    client = PtyPort(master, 0.2)
+    frame = request(1, count)
+    response_length = 5 + 2 * count
+    transactions = 0
+    lost = 0
+    try:
+        start = time.perf_counter()
+        deadline = start + seconds
+        while time.perf_counter() < deadline:
+            if paced:
+                write_paced(client, frame, baud)
+            else:
+                client.write(frame)
+            if len(client.read(response_length)) == response_length:
+                transactions += 1
+            else:
+                lost += 1
+                client.reset_input_buffer()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+        server.close()
+        os.close(slave)
+        client.close()
+    return (transactions / elapsed, lost)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bauds', type=int, nargs='+', default=[9600, 19200, 38400, 57600, 115200])
+    parser.add_argument('--seconds', type=float, default=3.0, help='duration of every run')
+    parser.add_argument('--count', type=int, default=10, help='holding registers read by every request')
+    parser.add_argument('--paced', action='store_true', help='write requests at the baud rate')
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim'):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+    print('%8s %12s %12s %12s %12s' % ('baud', 'legacy tx/s', 'legacy lost', 'framed tx/s', 'framed lost'))
+    for baud in args.bauds:
+        results = [run(SERVERS[name], baud, args.seconds, args.count, args.paced) for name in ('legacy', 'framed')]
+        print('%8d %12.0f %12d %12.0f %12d' % ((baud, ) + results[0] + results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Compares the select based modbus_tk TcpServer with the asyncio AsyncTcpServer.
+
+Every client connection polls a window of holding registers back to back and
+the aggregate request rate and mean latency are reported for each engine.
+
+    python3 test/bench_tcp.py --connections 10 100 500 --requests 200
+'''
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim.modbussim import ModbusDatabank, TCP_ENGINES  # noqa: E402
+
+
+def read_request(transaction_id, slave_id, address, count):
+    return struct.pack('>HHHBBHH', transaction_id, 0, 6, slave_id, 3, address, count)
+
+
+async def client(host, port, requests, latencies, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        for transaction_id in range(requests):
+            start = time.perf_counter()
+            writer.write(read_request(transaction_id, 1, 40001, 10))
+            header = await asyncio.wait_for(reader.readexactly(6), timeout)
+            (length, ) = struct.unpack('>H', header[4:6])
+            await asyncio.wait_for(reader.readexactly(length), timeout)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_clients(host, port, connections, requests, timeout=5.0):
+    latencies = []
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client(host, port, requests, latencies, timeout)
+                                     for _ in range(connections)],
+                                   return_exceptions=True)
+    errors = len([result for result in results if isinstance(result, Exception)])
+    return time.perf_counter() - start, latencies, errors
+
+
+def bench(engine, host, port, connections, requests):
+    databank = ModbusDatabank()
+    slave = databank.add_slave(1)
+    slave.add_block('holding_registers', 3, 40001, 100)
+    server = TCP_ENGINES[engine](address=host, port=port, databank=databank)
+    server.start()
+    time.sleep(0.2)
+    try:
+        elapsed, latencies, errors = asyncio.run(run_clients(host, port, connections, requests))
+    finally:
+        server.stop()
+    return len(latencies) / elapsed, 1000 * sum(latencies) / max(len(latencies), 1), errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=15020)
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--requests', type=int, default=200, help='requests per connection')
+    parser.add_argument('--engines', type=str, nargs='+', default=sorted(TCP_ENGINES))
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim', 'modbussim.asynctcp'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print('%-8s %12s %12s %12s %12s' % ('engine', 'connections', 'req/s', 'mean ms', 'failed conn'))
+    for connections in args.connections:
+        for port_offset, engine in enumerate(args.engines):
+            rate, latency, errors = bench(engine, args.host, args.port + port_offset,
+                                          connections, args.requests)
+            print('%-8s %12d %12.0f %12.3f %12d' % (engine, connections, rate, latency, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures standing up a fleet of identical slaves with and without a template.
+
+Without a template every slave gets fresh blocks which are then written with
+the common register image, as init_sim plus a dump load would do. With a
+template the slaves share the image and copy a page on first write. Reports
+the time to create the fleet and the memory it holds, then the memory after
+every slave had one register written. Unit ids limit a simulator to 247
+slaves, larger fleets are several simulators and scale the same way.
+
+    python3 test/bench_templates.py --slaves 50 247 --registers 10000
+'''
+import argparse
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modbussim.modbussim import ModbusSim  # noqa: E402
+
+
+def image(register_count):
+    return {
+        'input_register_count': register_count,
+        'input_registers': [i % 65536 for i in range(register_count)],
+        'holding_register_count': register_count,
+        'holding_registers': [(7 * i) % 65536 for i in range(register_count)],
+    }
+
+
+def dense(sim, slave_count, dump):
+    register_count = dump['holding_register_count']
+    for slave_id in range(1, slave_count + 1):
+        sim.add_slave(slave_id, register_count, register_count)
+        slave = sim.server.get_slave(slave_id)
+        slave.set_values('input_registers', 30001, dump['input_registers'])
+        slave.set_values('holding_registers', 40001, dump['holding_registers'])
+
+
+def templated(sim, slave_count, dump):
+    sim.add_template('bench', dump)
+    for slave_id in range(1, slave_count + 1):
+        sim.add_slave_from_template(slave_id, 'bench')
+
+
+def write_one(sim, slave_count):
+    for slave_id in range(1, slave_count + 1):
+        sim.server.get_slave(slave_id).set_values('holding_registers', 40001, [slave_id % 65536])
+
+
+def run(sim, populate, slave_count, dump):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    populate(sim, slave_count, dump)
+    elapsed = time.perf_counter() - start
+    created = tracemalloc.get_traced_memory()[0]
+    write_one(sim, slave_count)
+    written = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    sim.server.remove_all_slaves()
+    sim.slaves = {}
+    sim.templates = {}
+    return (elapsed, created, written)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slaves', type=int, nargs='+', default=[50, 247])
+    parser.add_argument('--registers', type=int, default=10000, help='input and holding registers per slave')
+    parser.add_argument('--store', choices=['list', 'array'], default='array', help='register store of dense slaves')
+    parser.add_argument('--port', type=int, default=15022)
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    sim = ModbusSim(mode='tcp', port=args.port, hostname='127.0.0.1', register_store=args.store)
+    sim.slaves = {}
+    dump = image(args.registers)
+    try:
+        print('%8s %10s %14s %14s %10s %14s %14s' % ('slaves', 'dense s', 'dense MB', 'written MB',
+                                                     'cow s', 'cow MB', 'written MB'))
+        for slave_count in args.slaves:
+            results = run(sim, dense, slave_count, dump) + run(sim, templated, slave_count, dump)
+            print('%8d %10.2f %14.1f %14.1f %10.2f %14.1f %14.1f' %
+                  ((slave_count, ) + tuple(value / 1048576.0 if i % 3 else value for (i, value) in enumerate(results))))
+    finally:
+        sim.rpc.rpc_server.server_close()
+
+
+if __name__ == '__main__':
+    main()
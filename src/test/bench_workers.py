@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+'''
+Measures Modbus TCP throughput against the number of worker processes.
+
+For every worker count a simulator is started (0 workers serves from the
+simulator process itself with the asyncio engine) and loaded by several
+loadgen.py client processes at once, so the clients are not the
+bottleneck. Throughput only scales with workers up to the number of cores
+left once the clients took theirs.
+
+    python3 test/bench_workers.py --workers 0 1 2 4 --clients 4 --duration 5
+'''
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SRC)
+
+from modbussim.modbussim import ModbusSim  # noqa: E402
+
+
+def load(port, clients, connections, duration, slaves):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, 'client%d.json' % (i, )) for i in range(clients)]
+        processes = [subprocess.Popen([sys.executable, os.path.join(SRC, 'loadgen.py'), '-P', str(port),
+                                       '-c', str(connections), '-d', str(duration), '--slaves', slaves,
+                                       '--seed', str(i), '--save', path],
+                                      stdout=subprocess.DEVNULL)
+                     for (i, path) in enumerate(paths)]
+        for process in processes:
+            process.wait()
+        results = []
+        for path in paths:
+            with open(path) as f:
+                results.append(json.load(f)['results'])
+    throughput = sum(result['throughput'] for result in results)
+    p99 = max(result['latency_ms'].get('p99', 0.0) for result in results)
+    errors = sum(result['timeouts'] + result['errors'] for result in results)
+    return throughput, p99, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--clients', type=int, default=max(os.cpu_count() // 2, 1), help='loadgen processes')
+    parser.add_argument('--connections', type=int, default=10, help='connections per loadgen process')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--slaves', type=int, default=10)
+    parser.add_argument('--port', type=int, default=15024)
+    args = parser.parse_args()
+
+    for name in ('modbus_tk', 'modbussim.modbussim', 'modbussim.asynctcp', 'modbussim.workers'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    print('%d cores, %d loadgen processes' % (os.cpu_count(), args.clients))
+    print('%8s %12s %12s %10s' % ('workers', 'req/s', 'p99 ms', 'errors'))
+    for (i, workers) in enumerate(args.workers):
+        port = args.port + 2 * i
+        sim = ModbusSim(mode='tcp', port=port, hostname='127.0.0.1', tcp_engine='asyncio', register_store='array',
+                        workers=workers)
+        try:
+            sim.slaves = {}
+            for slave_id in range(1, args.slaves + 1):
+                sim.add_slave(slave_id, 100, 100)
+            sim.server.start()
+            time.sleep(0.5)
+            throughput, p99, errors = load(port, args.clients, args.connections, args.duration,
+                                           '1-%d' % (args.slaves, ))
+            print('%8d %12.0f %12.3f %10d' % (workers, throughput, p99, errors))
+        finally:
+            sim.server.stop()
+            sim.server.get_db().close()
+            sim.rpc.rpc_server.server_close()
+
+
+if __name__ == '__main__':
+    main()